@@ -1,5 +1,30 @@
 from django.contrib import admin
 
+from .models import AgregadoDia, DiaRee, RegistroRee, TrabajoScrap
+
 
 # Register your models here.
 
+@admin.register(RegistroRee)
+class RegistroReeAdmin(admin.ModelAdmin):
+    list_display = ("tipo", "fecha_hora")
+    list_filter = ("tipo",)
+    date_hierarchy = "fecha_hora"
+
+
+@admin.register(DiaRee)
+class DiaReeAdmin(admin.ModelAdmin):
+    list_display = ("tipo", "fecha", "filas", "completo", "actualizado")
+    list_filter = ("tipo", "completo")
+
+
+@admin.register(TrabajoScrap)
+class TrabajoScrapAdmin(admin.ModelAdmin):
+    list_display = ("tipo", "estado", "dias_hechos", "dias_total", "creado")
+    list_filter = ("tipo", "estado")
+
+
+@admin.register(AgregadoDia)
+class AgregadoDiaAdmin(admin.ModelAdmin):
+    list_display = ("fuente", "columna", "fecha", "maximo", "minimo", "cuenta")
+    list_filter = ("fuente", "columna")
@@ -0,0 +1,94 @@
+"""
+Resúmenes diarios por columna para las estadísticas de las gráficas.
+
+Cada vez que se guardan datos de un día (histórico de REE o precios de OMIE) se
+actualiza su fila en AgregadoDia: máximo y mínimo con su instante, suma y número
+de valores. Las estadísticas de un rango se combinan con una fila por día en
+lugar de recorrer todos los valores de cinco minutos.
+"""
+import pandas as pd
+
+from .models import AgregadoDia
+
+
+def actualizar(fuente: str, df: pd.DataFrame) -> int:
+    """
+    Recalcula los resúmenes de los días que aparecen en df (DataFrame canónico: índice
+    FechaHora con la zona peninsular) para cada una de sus columnas. Devuelve las filas escritas.
+    """
+    df = df[df.index.notna()]
+    if df.empty:
+        return 0
+
+    agregados = []
+    for columna in df.columns:
+        serie = pd.to_numeric(df[columna], errors="coerce").dropna()
+        if serie.empty:
+            continue
+        # normalize() da la medianoche peninsular de cada instante: un grupo por día
+        por_dia = serie.groupby(serie.index.normalize())
+        resumen = pd.DataFrame({
+            "maximo": por_dia.max(),
+            "i_maximo": por_dia.idxmax(),
+            "minimo": por_dia.min(),
+            "i_minimo": por_dia.idxmin(),
+            "suma": por_dia.sum(),
+            "cuenta": por_dia.count(),
+        })
+        for dia, fila in resumen.iterrows():
+            agregados.append(AgregadoDia(
+                fuente=fuente,
+                columna=columna,
+                fecha=dia.date(),
+                maximo=float(fila["maximo"]),
+                hora_maximo=fila["i_maximo"].to_pydatetime(),
+                minimo=float(fila["minimo"]),
+                hora_minimo=fila["i_minimo"].to_pydatetime(),
+                suma=float(fila["suma"]),
+                cuenta=int(fila["cuenta"]),
+            ))
+
+    if agregados:
+        AgregadoDia.objects.bulk_create(
+            agregados,
+            update_conflicts=True,
+            unique_fields=["fuente", "columna", "fecha"],
+            update_fields=["maximo", "hora_maximo", "minimo", "hora_minimo", "suma", "cuenta"],
+        )
+    return len(agregados)
+
+
+def estadisticas(fuentes: dict, start_date, end_date, filas: int):
+    """
+    Estadísticas de cada columna entre start_date y end_date a partir de los resúmenes:
+    {columna: {"max", "hora_max", "min", "hora_min", "mean"}}. `fuentes` es {columna: fuente}.
+
+    Las columnas cuyos resúmenes no suman exactamente `filas` valores (faltan días,
+    o los datos se han filtrado o cruzado con otros) no se devuelven: esas hay que
+    calcularlas sobre las filas.
+    """
+    resumenes = {}
+    consulta = AgregadoDia.objects.filter(
+        columna__in=list(fuentes), fuente__in=set(fuentes.values()), fecha__range=(start_date, end_date),
+    ).order_by("fecha")
+    for agregado in consulta:
+        if fuentes.get(agregado.columna) == agregado.fuente:
+            resumenes.setdefault(agregado.columna, []).append(agregado)
+
+    stats = {}
+    for columna in fuentes:
+        dias = resumenes.get(columna, [])
+        cuenta = sum(a.cuenta for a in dias)
+        if not dias or cuenta != filas:
+            continue
+        # max/min se quedan con el primer día en caso de empate, como idxmax/idxmin
+        dia_max = max(dias, key=lambda a: a.maximo)
+        dia_min = min(dias, key=lambda a: a.minimo)
+        stats[columna] = {
+            "max": dia_max.maximo,
+            "hora_max": dia_max.hora_maximo,
+            "min": dia_min.minimo,
+            "hora_min": dia_min.hora_minimo,
+            "mean": sum(a.suma for a in dias) / cuenta,
+        }
+    return stats
@@ -0,0 +1,128 @@
+"""
+Alineación en el tiempo de series con distinta resolución (REE cada 5 minutos,
+OMIE cada hora o cada cuarto de hora) para la comparativa.
+
+Las series se cruzan por instante (los enteros int64 en nanosegundos UTC del índice
+FechaHora) y todo se hace con operaciones de numpy sobre arrays:
+  - "asof": se toma la rejilla de la serie más fina y a cada instante se le da
+    el último valor de las demás dentro de su periodo (el precio de una hora vale
+    para sus doce cincominutales).
+  - "media": todas las series se agregan a medias horarias y se cruzan por hora.
+  - "interpolar": las series más gruesas se interpolan linealmente sobre la
+    rejilla de la más fina.
+Solo se devuelven los instantes en los que todas las series tienen valor.
+"""
+import numpy as np
+import pandas as pd
+
+from . import historico, metricas
+
+MODOS = {
+    "asof": "Valor vigente en cada instante",
+    "media": "Medias horarias",
+    "interpolar": "Interpolación lineal",
+}
+
+HORA_NS = 3600 * 10**9
+
+
+def _instantes(df: pd.DataFrame):
+    """
+    (instantes int64 ordenados, valores float, columnas) de un DataFrame canónico.
+    Las filas sin instante válido se descartan.
+    """
+    validas = df.index.notna()
+    t = df.index[validas].asi8
+    columnas = list(df.columns)
+    valores = df[validas].apply(pd.to_numeric, errors="coerce").to_numpy(dtype=float)
+    orden = np.argsort(t, kind="stable")
+    return t[orden], valores[orden], columnas
+
+
+def _paso(t: np.ndarray) -> int:
+    if len(t) < 2:
+        return HORA_NS
+    return int(np.median(np.diff(t)))
+
+
+def _media_horaria(t: np.ndarray, valores: np.ndarray):
+    horas, inversa = np.unique(t // HORA_NS, return_inverse=True)
+    cuenta = np.zeros((len(horas), valores.shape[1]))
+    suma = np.zeros((len(horas), valores.shape[1]))
+    presentes = ~np.isnan(valores)
+    np.add.at(suma, inversa, np.where(presentes, valores, 0.0))
+    np.add.at(cuenta, inversa, presentes)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return horas * HORA_NS, suma / cuenta
+
+
+def _asof(base: np.ndarray, t: np.ndarray, valores: np.ndarray) -> np.ndarray:
+    # Último instante de la serie <= cada instante de la base, si sigue dentro de su periodo
+    i = np.searchsorted(t, base, side="right") - 1
+    dentro = (i >= 0) & (base - t[np.clip(i, 0, None)] < _paso(t))
+    resultado = np.full((len(base), valores.shape[1]), np.nan)
+    resultado[dentro] = valores[i[dentro]]
+    return resultado
+
+
+def _interpolar(base: np.ndarray, t: np.ndarray, valores: np.ndarray) -> np.ndarray:
+    # Sin extrapolar fuera de la serie ni rellenar huecos de más de dos periodos
+    paso = _paso(t)
+    derecha = np.clip(np.searchsorted(t, base, side="left"), 0, len(t) - 1)
+    izquierda = np.clip(derecha - 1, 0, None)
+    exacto = t[derecha] == base
+    valido = exacto | ((base > t[0]) & (base < t[-1]) & (t[derecha] - t[izquierda] <= 2 * paso))
+
+    resultado = np.full((len(base), valores.shape[1]), np.nan)
+    for j in range(valores.shape[1]):
+        presentes = ~np.isnan(valores[:, j])
+        if presentes.sum() < 1:
+            continue
+        resultado[:, j] = np.interp(base, t[presentes], valores[presentes, j])
+    resultado[~valido] = np.nan
+    return resultado
+
+
+def alinear(partes: list, modo: str = "asof") -> pd.DataFrame:
+    """
+    Cruza por instante los DataFrames canónicos según `modo` y devuelve uno solo
+    (también canónico) con todas las columnas.
+    """
+    with metricas.etapa("alineacion"):
+        return _alinear(partes, modo)
+
+
+def _alinear(partes: list, modo: str) -> pd.DataFrame:
+    if modo not in MODOS:
+        raise ValueError(f"Modo de alineación desconocido: {modo}")
+    partes = [p for p in partes if p is not None and not p.empty]
+    if not partes:
+        return historico.marco_vacio()
+
+    series = [_instantes(p) for p in partes]
+    columnas = [c for _, _, cols in series for c in cols]
+
+    if modo == "media":
+        horarias = [_media_horaria(t, valores) for t, valores, _ in series]
+        base = horarias[0][0]
+        for t, _ in horarias[1:]:
+            base = np.intersect1d(base, t, assume_unique=True)
+        bloques = [valores[np.searchsorted(t, base)] for t, valores in horarias]
+    else:
+        # La rejilla es la de la serie más fina; el resto se lleva a ella
+        fina = min(range(len(series)), key=lambda k: _paso(series[k][0]))
+        base = series[fina][0]
+        bloques = []
+        for k, (t, valores, _) in enumerate(series):
+            if k == fina or len(t) == 0:
+                bloques.append(valores if k == fina else np.full((len(base), valores.shape[1]), np.nan))
+            elif modo == "asof":
+                bloques.append(_asof(base, t, valores))
+            else:
+                bloques.append(_interpolar(base, t, valores))
+
+    matriz = np.hstack(bloques) if bloques else np.empty((0, 0))
+    completas = ~np.isnan(matriz).any(axis=1)
+    base, matriz = base[completas], matriz[completas]
+
+    return pd.DataFrame(matriz, columns=columnas, index=historico.indice(base.astype(np.int64)))
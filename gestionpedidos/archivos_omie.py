@@ -0,0 +1,224 @@
+"""
+Carga masiva de precios de OMIE desde sus archivos comprimidos (un zip con los
+marginalpdbc de muchos días, p. ej. uno por año).
+
+El zip se lee de principio a fin como un flujo, sin guardarlo en disco ni saltar
+al directorio central del final: cada archivo del zip se descomprime y se procesa
+según llega, así que sirve igual para un archivo local que para la respuesta de
+una descarga HTTP. Los días se guardan por lotes en la caché Parquet (y sus
+resúmenes diarios), con pocas escrituras grandes en lugar de una por día.
+"""
+import logging
+import re
+import struct
+import zlib
+from datetime import datetime
+
+import pandas as pd
+from django.conf import settings
+
+from . import columnar
+from .utils_scrap import guardar_precio, obtener_sesion_omie, parsear_marginalpdbc
+
+logger = logging.getLogger(__name__)
+
+OMIE_URL_ARCHIVO = "https://www.omie.es/es/file-download?parents=marginalpdbc&filename=marginalpdbc_{}.zip"
+
+# marginalpdbc_AAAAMMDD.V: de un mismo día vale la versión más alta
+_NOMBRE_DIARIO = re.compile(r"marginalpdbc_(\d{8})\.(\d+)$")
+
+_FIRMA_LOCAL = 0x04034B50
+_FIRMA_DESCRIPTOR = 0x08074B50
+# Lo que puede venir tras un descriptor sin firma: otro archivo, el directorio central o su final
+_FIRMAS_SIGUIENTE = (_FIRMA_LOCAL, 0x02014B50, 0x06054B50)
+_TAM_BLOQUE = 64 * 1024
+
+
+class _Lector:
+    """
+    Lectura exacta de bytes sobre cualquier flujo (archivo o respuesta HTTP),
+    con la posibilidad de devolver lo que se ha leído de más.
+    """
+    def __init__(self, flujo):
+        self.flujo = flujo
+        self.pendiente = b""
+
+    def leer(self, n: int) -> bytes:
+        partes = [self.pendiente[:n]]
+        self.pendiente = self.pendiente[n:]
+        falta = n - len(partes[0])
+        while falta > 0:
+            trozo = self.flujo.read(max(falta, _TAM_BLOQUE))
+            if not trozo:
+                break
+            partes.append(trozo[:falta])
+            self.pendiente = trozo[falta:]
+            falta -= len(trozo[:falta])
+        return b"".join(partes)
+
+    def trozo(self) -> bytes:
+        if self.pendiente:
+            datos, self.pendiente = self.pendiente, b""
+            return datos
+        return self.flujo.read(_TAM_BLOQUE)
+
+    def devolver(self, datos: bytes):
+        self.pendiente = datos + self.pendiente
+
+
+def _leer_deflate(lector: _Lector) -> bytes:
+    # El propio flujo deflate marca dónde acaba: lo que sobra es del siguiente archivo
+    descompresor = zlib.decompressobj(-zlib.MAX_WBITS)
+    partes = []
+    while not descompresor.eof:
+        trozo = lector.trozo()
+        if not trozo:
+            raise ValueError("el zip termina a mitad de un archivo")
+        partes.append(descompresor.decompress(trozo))
+    lector.devolver(descompresor.unused_data)
+    return b"".join(partes)
+
+
+def _leer_hasta_descriptor(lector: _Lector) -> bytes:
+    """
+    Datos de un archivo guardado sin comprimir cuyo tamaño solo viene en el descriptor
+    que lo sigue. Se busca la firma del descriptor (o, si el descriptor no lleva firma,
+    la cabecera que viene detrás) y vale el primero cuyo crc y tamaños cuadran con lo
+    leído hasta ahí. Consume también el descriptor.
+    """
+    datos = bytearray()
+    desde = 0
+    while True:
+        trozo = lector.trozo()
+        if not trozo:
+            raise ValueError("el zip termina a mitad de un archivo")
+        datos += trozo
+        while True:
+            i = datos.find(b"PK", desde)
+            # Hace falta ver el descriptor entero (16 bytes desde la firma) para comprobarlo
+            if i < 0 or i + 16 > len(datos):
+                break
+            firma = struct.unpack("<I", datos[i:i + 4])[0]
+            if firma == _FIRMA_DESCRIPTOR:
+                fin, campos, resto = i, datos[i + 4:i + 16], i + 16
+            elif firma in _FIRMAS_SIGUIENTE and i >= 12:
+                fin, campos, resto = i - 12, datos[i - 12:i], i
+            else:
+                desde = i + 1
+                continue
+            crc, comprimido, tamano = struct.unpack("<III", campos)
+            if comprimido == tamano == fin and zlib.crc32(datos[:fin]) == crc:
+                lector.devolver(bytes(datos[resto:]))
+                return bytes(datos[:fin])
+            desde = i + 1
+        desde = max(desde, len(datos) - 15)
+
+
+def miembros_zip(flujo):
+    """
+    Generador de (nombre, contenido) de cada archivo de un zip leído en orden,
+    desde sus cabeceras locales. Admite archivos guardados sin comprimir o con deflate,
+    también con los tamaños en un descriptor tras los datos (zip escritos como flujo).
+    """
+    lector = _Lector(flujo)
+    while True:
+        cabecera = lector.leer(30)
+        if len(cabecera) < 30 or struct.unpack("<I", cabecera[:4])[0] != _FIRMA_LOCAL:
+            # Directorio central (o fin del flujo): ya no quedan archivos
+            return
+        (_, _, flags, metodo, _, _, _, comprimido, _, largo_nombre, largo_extra) = struct.unpack("<IHHHHHIIIHH", cabecera)
+        nombre = lector.leer(largo_nombre).decode("cp437" if not flags & 0x800 else "utf-8")
+        lector.leer(largo_extra)
+
+        if metodo == 0 and flags & 0x08:
+            yield nombre, _leer_hasta_descriptor(lector)
+            continue
+        if metodo == 8:
+            contenido = _leer_deflate(lector)
+        elif metodo == 0:
+            contenido = lector.leer(comprimido)
+        else:
+            raise ValueError(f"{nombre}: método de compresión {metodo} no soportado")
+
+        if flags & 0x08:
+            # Descriptor tras los datos (crc y tamaños), con o sin firma
+            descriptor = lector.leer(4)
+            if struct.unpack("<I", descriptor)[0] == _FIRMA_DESCRIPTOR:
+                lector.leer(12)
+            else:
+                lector.leer(8)
+        yield nombre, contenido
+
+
+def _abrir(origen):
+    """
+    Flujo de bytes de un zip local (ruta) o remoto (URL http/https), y la función
+    que lo cierra.
+    """
+    if str(origen).startswith(("http://", "https://")):
+        resp = obtener_sesion_omie().get(origen, stream=True, timeout=getattr(settings, "OMIE_TIMEOUT", (5, 30)))
+        resp.raise_for_status()
+        resp.raw.decode_content = True
+        return resp.raw, resp.close
+    archivo = open(origen, "rb")
+    return archivo, archivo.close
+
+
+def importar(origen, lote: int = None, desde=None, hasta=None) -> dict:
+    """
+    Lee un zip de archivos marginalpdbc (ruta local o URL) y guarda sus precios en
+    la caché Parquet, `lote` días cada vez (por defecto OMIE_ARCHIVO_LOTE).
+    Con `desde` y `hasta` (date) solo se guardan los días de ese rango.
+    Devuelve {"dias": días guardados, "filas": filas escritas, "errores": [archivos que no se pudieron leer]}.
+    """
+    if not columnar.disponible():
+        raise RuntimeError("la carga de archivos de OMIE necesita el paquete pyarrow")
+    if lote is None:
+        lote = getattr(settings, "OMIE_ARCHIVO_LOTE", 92)
+
+    resumen = {"dias": 0, "filas": 0, "errores": []}
+    versiones = {}
+    pendientes = {}
+
+    def volcar():
+        if pendientes:
+            df = pd.concat(pendientes.values()).sort_index(kind="stable")
+            guardar_precio(df)
+            resumen["dias"] += len(pendientes)
+            resumen["filas"] += len(df)
+            pendientes.clear()
+
+    flujo, cerrar = _abrir(origen)
+    try:
+        for nombre, contenido in miembros_zip(flujo):
+            encontrado = _NOMBRE_DIARIO.search(nombre)
+            if not encontrado:
+                continue
+            dia = datetime.strptime(encontrado.group(1), "%Y%m%d").date()
+            version = int(encontrado.group(2))
+            if (desde and dia < desde) or (hasta and dia > hasta) or version < versiones.get(dia, 0):
+                continue
+            try:
+                df = parsear_marginalpdbc(contenido.decode("latin-1"))
+            except Exception as e:
+                logger.error("No se pudo procesar %s: %s", nombre, e, extra={"archivo": nombre})
+                resumen["errores"].append(nombre)
+                continue
+            if df.empty:
+                continue
+            if dia in versiones and dia not in pendientes:
+                # Versión más reciente de un día ya guardado: se vuelve a escribir
+                resumen["dias"] -= 1
+            versiones[dia] = version
+            pendientes[dia] = df
+            if len(pendientes) >= lote:
+                volcar()
+        volcar()
+    finally:
+        cerrar()
+
+    logger.info(
+        "Archivo de OMIE %s: %s días, %s filas", origen, resumen["dias"], resumen["filas"],
+        extra={"origen": str(origen), "dias": resumen["dias"], "filas": resumen["filas"]},
+    )
+    return resumen
@@ -0,0 +1,288 @@
+"""
+Formato columnar (Parquet) para las descargas y para la caché local en disco.
+
+La caché guarda un archivo por tipo de dato y mes:
+PARQUET_DIR/tipo=<tipo>/mes=<aaaa-mm>/datos.parquet, con la columna FechaHora
+(instante con zona horaria) y las columnas numéricas, en un grupo de filas por día.
+Al leer un rango solo se abren los meses que lo tocan, solo se leen los grupos
+de los días pedidos y solo las columnas pedidas.
+
+Escribir un mes es leerlo, combinarlo y reescribirlo entero. Como lo pueden hacer
+a la vez varios procesos (los del servidor web y manage.py precargar o
+importar_omie), cada escritura toma un bloqueo de archivo (datos.parquet.lock)
+además del bloqueo entre hilos. Las lecturas no lo necesitan: el archivo se
+sustituye de una vez.
+
+pyarrow es opcional: sin él no hay descarga en Parquet y los datos se leen
+como siempre (histórico en la base de datos y archivos de OMIE).
+"""
+import os
+import threading
+import time
+from contextlib import contextmanager
+from datetime import date, timedelta
+
+import numpy as np
+import pandas as pd
+from django.conf import settings
+from django.http import StreamingHttpResponse
+
+from . import historico
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pq = None
+
+try:
+    import fcntl
+except ImportError:
+    # Windows
+    fcntl = None
+    import msvcrt
+
+_escritura_lock = threading.Lock()
+
+
+def disponible() -> bool:
+    return pq is not None
+
+
+# -----------------------------
+# Descarga en Parquet
+# -----------------------------
+class _Salida:
+    """
+    Destino de ParquetWriter que guarda lo escrito hasta que se entrega al cliente.
+    """
+    def __init__(self):
+        self.trozos = []
+        self.posicion = 0
+        self.closed = False
+
+    def write(self, datos):
+        datos = bytes(datos)
+        self.trozos.append(datos)
+        self.posicion += len(datos)
+        return len(datos)
+
+    def tell(self):
+        return self.posicion
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def vaciar(self) -> bytes:
+        datos = b"".join(self.trozos)
+        self.trozos = []
+        return datos
+
+
+def _tabla_arrow(df: pd.DataFrame, esquema=None):
+    if esquema is not None:
+        df = df.reindex(columns=esquema.names)
+        for campo in esquema:
+            if pa.types.is_floating(campo.type):
+                df[campo.name] = pd.to_numeric(df[campo.name], errors="coerce").astype("float64")
+        return pa.Table.from_pandas(df, schema=esquema, preserve_index=False)
+
+    # Primer bloque: las columnas numéricas siempre como float, aunque un día vengan enteras
+    df = df.copy()
+    for col in df.columns:
+        if pd.api.types.is_numeric_dtype(df[col]) and not pd.api.types.is_bool_dtype(df[col]):
+            df[col] = df[col].astype("float64")
+    return pa.Table.from_pandas(df, preserve_index=False)
+
+
+def respuesta_parquet(filename, bloques):
+    """
+    Descarga Parquet que se escribe bloque a bloque (un DataFrame canónico por día,
+    un grupo de filas por bloque) sin tener el rango entero en memoria.
+    El índice se escribe como columna FechaHora de tipo timestamp con zona horaria;
+    las demás columnas las fija el primer bloque con datos.
+    """
+    if not disponible():
+        raise RuntimeError("la descarga en Parquet necesita el paquete pyarrow")
+
+    def trozos():
+        salida = _Salida()
+        writer = None
+        for df in bloques:
+            if df is None or df.empty:
+                continue
+            df = df.reset_index()
+            if writer is None:
+                tabla = _tabla_arrow(df)
+                writer = pq.ParquetWriter(salida, tabla.schema, compression="zstd")
+            else:
+                tabla = _tabla_arrow(df, writer.schema)
+            writer.write_table(tabla)
+            yield salida.vaciar()
+        if writer is None:
+            writer = pq.ParquetWriter(salida, pa.schema([]))
+        writer.close()
+        yield salida.vaciar()
+
+    response = StreamingHttpResponse(trozos(), content_type="application/vnd.apache.parquet")
+    response["Content-Disposition"] = f'attachment; filename="{filename}"'
+    return response
+
+
+# -----------------------------
+# Caché en disco por tipo y mes
+# -----------------------------
+def _directorio():
+    return getattr(settings, "PARQUET_DIR", settings.CACHE_DIR / "parquet")
+
+
+def _ruta(tipo: str, mes: date):
+    return os.path.join(_directorio(), f"tipo={tipo}", f"mes={mes:%Y-%m}", "datos.parquet")
+
+
+def _meses(start_date: date, end_date: date):
+    mes = start_date.replace(day=1)
+    while mes <= end_date:
+        yield mes
+        mes = (mes + timedelta(days=32)).replace(day=1)
+
+
+def _leer_mes(ruta, columnas=None, filtros=None) -> pd.DataFrame:
+    # Un solo descriptor para el esquema y los datos: si otro proceso sustituye el
+    # archivo mientras tanto, se sigue leyendo el que se abrió
+    try:
+        f = open(ruta, "rb")
+    except FileNotFoundError:
+        return pd.DataFrame()
+    with f:
+        if columnas is not None:
+            existentes = set(pq.read_schema(f).names)
+            columnas = ["FechaHora"] + [c for c in columnas if c in existentes and c != "FechaHora"]
+            f.seek(0)
+        return pq.read_table(f, columns=columnas, filters=filtros).to_pandas()
+
+
+def _instante(dia: date):
+    # Mismo tipo que la columna FechaHora del archivo, para que pyarrow pueda comparar
+    return pd.Timestamp(historico.inicio_dia(dia)).tz_convert("UTC").as_unit("ns")
+
+
+def _filtros_rango(start_date: date, end_date: date) -> list:
+    return [
+        ("FechaHora", ">=", _instante(start_date)),
+        ("FechaHora", "<", _instante(end_date + timedelta(days=1))),
+    ]
+
+
+def dias_guardados(tipo: str, start_date: date, end_date: date) -> set:
+    """
+    Días del rango que ya están en la caché (leyendo solo la columna FechaHora).
+    """
+    if not disponible():
+        return set()
+    dias = set()
+    for mes in _meses(start_date, end_date):
+        df = _leer_mes(_ruta(tipo, mes), columnas=[], filtros=_filtros_rango(start_date, end_date))
+        if not df.empty:
+            dias.update(d.date() for d in historico.dias_locales(df["FechaHora"]).unique())
+    return dias
+
+
+def leer(tipo: str, start_date: date, end_date: date, columnas: list = None) -> pd.DataFrame:
+    """
+    Filas de la caché entre start_date y end_date (ambos incluidos) como DataFrame
+    canónico: índice FechaHora y las columnas numéricas (solo `columnas` si se indican).
+    """
+    partes = [
+        _leer_mes(_ruta(tipo, mes), columnas=columnas, filtros=_filtros_rango(start_date, end_date))
+        for mes in _meses(start_date, end_date)
+    ]
+    partes = [p for p in partes if not p.empty]
+    if not partes:
+        return historico.marco_vacio(columnas or ())
+
+    df = pd.concat(partes, ignore_index=True)
+    df = df.set_index(historico.indice(df.pop("FechaHora")))
+    return df.sort_index(kind="stable")
+
+
+def guardar(tipo: str, df: pd.DataFrame) -> int:
+    """
+    Añade a la caché los días de df (DataFrame canónico). Las filas nuevas sustituyen
+    a las que ya hubiera del mismo instante. Devuelve el número de días guardados.
+    """
+    if not disponible() or df.empty or not isinstance(df.index, pd.DatetimeIndex):
+        return 0
+    df = df[df.index.notna()]
+    if df.empty:
+        return 0
+
+    dias = historico.dias_locales(df.index)
+    mes_de = dias.year * 100 + dias.month
+    # En el archivo los instantes van en UTC; al leerlos se pasan a la hora peninsular
+    df = df.apply(pd.to_numeric, errors="coerce").astype("float64").reset_index()
+    df["FechaHora"] = df["FechaHora"].dt.tz_convert("UTC")
+
+    with _escritura_lock:
+        for mes, nuevo in df.groupby(mes_de):
+            ruta = _ruta(tipo, date(mes // 100, mes % 100, 1))
+            with _bloqueo_archivo(ruta):
+                anterior = _leer_mes(ruta)
+                if not anterior.empty:
+                    anterior["FechaHora"] = anterior["FechaHora"].dt.tz_convert("UTC")
+                combinado = pd.concat([anterior, nuevo], ignore_index=True)
+                combinado = (
+                    combinado.drop_duplicates(subset="FechaHora", keep="last")
+                    .sort_values("FechaHora", ignore_index=True)
+                )
+                _escribir_mes(ruta, combinado)
+    return dias.nunique()
+
+
+@contextmanager
+def _bloqueo_archivo(ruta):
+    """
+    Bloqueo exclusivo entre procesos del archivo de un mes mientras se lee y se reescribe.
+    """
+    os.makedirs(os.path.dirname(ruta), exist_ok=True)
+    with open(f"{ruta}.lock", "a+b") as f:
+        if fcntl is not None:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        else:
+            # msvcrt.locking deja de esperar a los 10 segundos: se vuelve a intentar
+            f.seek(0)
+            while True:
+                try:
+                    msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+                    break
+                except OSError:
+                    time.sleep(0.1)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+            else:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+def _escribir_mes(ruta, df: pd.DataFrame):
+    """
+    Escribe el archivo del mes con un grupo de filas por día, en un temporal que
+    luego sustituye al anterior para que nadie lea un archivo a medias.
+    """
+    os.makedirs(os.path.dirname(ruta), exist_ok=True)
+    tabla = pa.Table.from_pandas(df, preserve_index=False)
+    # Las filas van ordenadas, así que los días salen en orden
+    _, filas_dia = np.unique(historico.dias_locales(df["FechaHora"]).asi8, return_counts=True)
+    temporal = f"{ruta}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with pq.ParquetWriter(temporal, tabla.schema, compression="zstd") as writer:
+        inicio = 0
+        for n in filas_dia:
+            writer.write_table(tabla.slice(inicio, n))
+            inicio += n
+    os.replace(temporal, ruta)
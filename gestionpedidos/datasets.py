@@ -0,0 +1,55 @@
+"""
+Caché en servidor de los resultados de scraping que usan las vistas de gráficas.
+En la sesión solo se guarda una referencia pequeña; el DataFrame se guarda
+serializado en binario y comprimido en la caché "datasets", que lo descarta
+por antigüedad o cuando se llena (ver CACHES en settings).
+"""
+import hashlib
+import json
+import pickle
+import zlib
+
+import pandas as pd
+from django.core.cache import caches
+
+from . import metricas
+
+# Subir al cambiar el formato de los DataFrame guardados: las referencias que
+# todavía estén en alguna sesión con otro formato se tratan como caducadas
+VERSION_DATASETS = 2
+
+
+def _cache():
+    return caches["datasets"]
+
+
+def guardar(tipo: str, df: pd.DataFrame, **parametros) -> dict:
+    """
+    Guarda el DataFrame y devuelve la referencia que va a la sesión (con los parámetros,
+    para saber de qué rango son los datos). La clave depende del tipo, de los parámetros (rango, columnas...) y del contenido,
+    así que dos consultas con el mismo resultado comparten entrada.
+    """
+    with metricas.etapa("sesion"):
+        datos = zlib.compress(pickle.dumps(df, protocol=pickle.HIGHEST_PROTOCOL))
+        huella = hashlib.sha1(datos).hexdigest()
+        consulta = hashlib.sha1(json.dumps([tipo, parametros], sort_keys=True).encode()).hexdigest()
+        clave = f"dataset:v{VERSION_DATASETS}:{tipo}:{consulta[:16]}:{huella[:16]}"
+        _cache().set(clave, datos)
+    return {
+        "clave": clave, "huella": huella, "tipo": tipo, "filas": len(df),
+        "parametros": parametros, "version": VERSION_DATASETS,
+    }
+
+
+def cargar(referencia) -> pd.DataFrame:
+    """
+    DataFrame de una referencia guardada en la sesión, o None si ya no está en la caché.
+    """
+    if not isinstance(referencia, dict) or "clave" not in referencia:
+        return None
+    if referencia.get("version") != VERSION_DATASETS:
+        return None
+    datos = _cache().get(referencia["clave"])
+    if datos is None:
+        return None
+    return pickle.loads(zlib.decompress(datos))
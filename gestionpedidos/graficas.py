@@ -0,0 +1,146 @@
+"""
+Utilidades para las vistas de gráficas.
+
+Las figuras se crean con Figure y un lienzo Agg propio, sin pyplot: no hay estado
+global compartido y varias peticiones pueden dibujar a la vez en el mismo proceso.
+
+Antes de dibujar, las series largas se reducen a lo que cabe en el ancho de la
+figura: las barras con la media de cada tramo y las líneas con el mínimo y el
+máximo de cada tramo, para no perder los picos.
+
+Las gráficas ya generadas se guardan en la caché "graficas" con una clave que
+depende del contenido del dataset (su huella), del tipo de gráfica y de sus opciones,
+así que repetir una vista o abrir un enlace compartido no vuelve a pasar por matplotlib.
+"""
+import base64
+import hashlib
+import io
+import json
+
+import matplotlib.dates as mdates
+import numpy as np
+import pandas as pd
+from django.core.cache import caches
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.collections import PolyCollection
+from matplotlib.figure import Figure
+from matplotlib.patches import Patch
+
+from . import metricas
+
+# Subir al cambiar cómo se dibujan las gráficas para no servir imágenes antiguas
+VERSION_GRAFICAS = 3
+
+# Las figuras miden 12 pulgadas a 100 ppp: unos 1000 píxeles útiles de eje X
+PUNTOS_MAX = 600
+
+
+def reducir_medias(df: pd.DataFrame, columnas: list, x: str = "FechaHora", max_puntos: int = PUNTOS_MAX) -> pd.DataFrame:
+    """
+    Agrupa filas consecutivas en como mucho `max_puntos` tramos y devuelve la media
+    de cada columna por tramo, con el primer instante del tramo en `x`.
+    """
+    n = len(df)
+    if n <= max_puntos:
+        return df[[x] + list(columnas)].reset_index(drop=True)
+    tam = -(-n // max_puntos)
+    tramos = np.arange(n) // tam
+    reducido = df[list(columnas)].groupby(tramos).mean()
+    reducido.insert(0, x, df[x].to_numpy()[::tam])
+    return reducido.reset_index(drop=True)
+
+
+def reducir_min_max(x, y, max_puntos: int = PUNTOS_MAX):
+    """
+    Reduce una serie a los puntos mínimo y máximo de cada tramo (como mucho 2 * max_puntos).
+    Devuelve (x, y) listos para ax.plot.
+    """
+    x = np.asarray(x)
+    y = np.asarray(y, dtype=float)
+    n = len(y)
+    if n <= 2 * max_puntos:
+        return x, y
+    tam = -(-n // max_puntos)
+    relleno = (-n) % tam
+    tramos = np.pad(y, (0, relleno), constant_values=np.nan).reshape(-1, tam)
+    base = np.arange(tramos.shape[0]) * tam
+    i_min = base + np.argmin(np.where(np.isnan(tramos), np.inf, tramos), axis=1)
+    i_max = base + np.argmax(np.where(np.isnan(tramos), -np.inf, tramos), axis=1)
+    indices = np.unique(np.concatenate([i_min, i_max]))
+    indices = indices[indices < n]
+    return x[indices], y[indices]
+
+
+def ancho_barras(x) -> float:
+    """
+    Ancho de barra (en días, la unidad de matplotlib para fechas) igual al paso entre puntos.
+    """
+    x = pd.to_datetime(pd.Series(x))
+    if len(x) < 2:
+        return 5 / (24 * 60)
+    paso = x.diff().median()
+    return paso / pd.Timedelta(days=1)
+
+
+def nueva_figura(figsize=(12, 5)):
+    """
+    Figura con su propio lienzo Agg y un único eje. Devuelve (fig, ax).
+    """
+    fig = Figure(figsize=figsize)
+    FigureCanvasAgg(fig)
+    return fig, fig.add_subplot()
+
+
+def png_base64(fig) -> str:
+    buf = io.BytesIO()
+    with metricas.etapa("savefig"):
+        fig.tight_layout()
+        fig.savefig(buf, format="png")
+    with metricas.etapa("base64"):
+        return base64.b64encode(buf.getvalue()).decode("utf-8")
+
+
+def apilar(ax, x, df: pd.DataFrame, columnas: list) -> list:
+    """
+    Dibuja las columnas como áreas apiladas en una sola PolyCollection.
+    Las alturas se calculan de una vez con una suma acumulada; devuelve los
+    elementos de la leyenda (uno por columna, con los colores de siempre).
+    """
+    xs = mdates.date2num(pd.to_datetime(pd.Series(x)).to_numpy())
+    valores = np.nan_to_num(df[list(columnas)].to_numpy(dtype=float))
+    techo = np.cumsum(valores, axis=1).T
+    suelo = techo - valores.T
+
+    # Cada capa: el suelo de izquierda a derecha y el techo de vuelta
+    n_capas = len(columnas)
+    ida = np.stack([np.broadcast_to(xs, (n_capas, len(xs))), suelo], axis=-1)
+    vuelta = np.stack([np.broadcast_to(xs[::-1], (n_capas, len(xs))), techo[:, ::-1]], axis=-1)
+    colores = [f"C{i}" for i in range(n_capas)]
+
+    ax.xaxis_date()
+    ax.add_collection(PolyCollection(np.concatenate([ida, vuelta], axis=1), facecolors=colores, edgecolors="none"))
+    ax.autoscale_view()
+    return [Patch(facecolor=color, label=col) for color, col in zip(colores, columnas)]
+
+
+def _clave(referencia, tipo: str, opciones: dict):
+    if not isinstance(referencia, dict) or "huella" not in referencia:
+        return None
+    texto = json.dumps([VERSION_GRAFICAS, referencia["huella"], tipo, opciones], sort_keys=True)
+    return "grafica:" + hashlib.sha1(texto.encode()).hexdigest()
+
+
+def leer_cache(referencia, tipo: str, **opciones):
+    """
+    Contexto ya renderizado (gráfico en base64 y estadísticas) o None si no está en la caché.
+    """
+    clave = _clave(referencia, tipo, opciones)
+    if clave is None:
+        return None
+    return caches["graficas"].get(clave)
+
+
+def guardar_cache(referencia, tipo: str, contexto: dict, **opciones):
+    clave = _clave(referencia, tipo, opciones)
+    if clave is not None:
+        caches["graficas"].set(clave, contexto)
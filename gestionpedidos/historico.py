@@ -0,0 +1,300 @@
+"""
+Histórico local de las tablas de REE.
+Cada día se descarga una sola vez; después se sirve desde la base de datos.
+"""
+import warnings
+from datetime import date, datetime, time, timedelta
+from zoneinfo import ZoneInfo
+
+import numpy as np
+import pandas as pd
+from django.db import transaction
+from django.utils import timezone
+from django.db.models.fields.json import KeyTransform
+
+from . import agregados
+from .models import DiaRee, RegistroRee
+
+ZONA_REE = ZoneInfo("Europe/Madrid")
+
+# Nombre de cada tabla de REE en la caché Parquet y en los resúmenes diarios
+NOMBRES_REE = {
+    1: "demanda",
+    2: "generacion",
+    4: "almacenamiento",
+}
+
+
+# Columnas de previsión: REE las revisa durante el día, también en horas ya guardadas
+COLUMNAS_PREVISION = ("Prevista", "Programada")
+
+
+def hoy_local() -> date:
+    return datetime.now(ZONA_REE).date()
+
+
+def inicio_dia(dia: date) -> datetime:
+    """
+    Medianoche peninsular del día (con zona).
+    """
+    return datetime.combine(dia, time.min, tzinfo=ZONA_REE)
+
+
+def dias_pendientes(url_tipo: int, start_date: date, end_date: date) -> list:
+    """
+    Días del rango que todavía no están completos en el histórico.
+    """
+    completos = set(
+        DiaRee.objects.filter(tipo=url_tipo, fecha__range=(start_date, end_date), completo=True)
+        .values_list("fecha", flat=True)
+    )
+    dias = []
+    day = start_date
+    while day <= end_date:
+        if day not in completos:
+            dias.append(day)
+        day += timedelta(days=1)
+    return dias
+
+
+# Los datos se manejan en un DataFrame canónico: índice FechaHora con instantes en la
+# zona peninsular (datetime64 con zona) y solo columnas numéricas. Las cadenas Fecha
+# y Hora solo se generan al mostrar o exportar los datos (ver con_fecha_hora).
+INDICE = "FechaHora"
+
+# Con el nombre de la zona pandas usa su tabla de cambios de hora (mucho más rápido que
+# ZoneInfo), y todos los índices comparten el mismo tipo al concatenarlos
+ZONA_PANDAS = ZONA_REE.key
+
+_DIA_NS = 24 * 3600 * 10**9
+_MINUTO_NS = 60 * 10**9
+
+# "HH:MM" de cada minuto del día, para formatear sin strftime fila a fila
+_HORAS = np.array([f"{m // 60:02d}:{m % 60:02d}" for m in range(24 * 60)], dtype=object)
+
+
+def marco_vacio(columnas=()) -> pd.DataFrame:
+    return pd.DataFrame(columns=list(columnas), index=pd.DatetimeIndex([], tz=ZONA_PANDAS, name=INDICE), dtype="float64")
+
+
+def indice(instantes) -> pd.DatetimeIndex:
+    """
+    Índice canónico a partir de instantes con zona o de enteros en nanosegundos UTC.
+    """
+    if isinstance(instantes, np.ndarray) and instantes.dtype.kind == "i":
+        instantes = pd.DatetimeIndex(instantes.astype("datetime64[ns]"), tz="UTC")
+    return pd.DatetimeIndex(instantes).tz_convert(ZONA_PANDAS).rename(INDICE)
+
+
+def localizar(horas_locales) -> pd.DatetimeIndex:
+    """
+    Índice canónico a partir de horas peninsulares sin zona (en orden, para deducir
+    la hora repetida del cambio de hora de octubre).
+    """
+    horas_locales = pd.DatetimeIndex(horas_locales)
+    try:
+        resultado = horas_locales.tz_localize(ZONA_PANDAS, ambiguous="infer", nonexistent="shift_forward")
+    except Exception:
+        # Cambio de hora de octubre sin orden suficiente para deducir la hora repetida
+        resultado = horas_locales.tz_localize(ZONA_PANDAS, ambiguous="NaT", nonexistent="shift_forward")
+    return resultado.rename(INDICE)
+
+
+def instantes(valores) -> pd.DatetimeIndex:
+    """
+    Índice canónico a partir de las horas tal como llegan de REE: cadenas ISO con o
+    sin desfase horario. Las que no se pueden interpretar quedan como NaT.
+    """
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        try:
+            resultado = pd.DatetimeIndex(pd.to_datetime(valores, errors="coerce"))
+        except (TypeError, ValueError):
+            # Desfases distintos en el mismo día (cambio de hora): se pasa por UTC
+            resultado = pd.DatetimeIndex(pd.to_datetime(valores, errors="coerce", utc=True))
+    if resultado.tz is None:
+        return localizar(resultado)
+    return indice(resultado)
+
+
+def dias_locales(fechas_hora) -> pd.DatetimeIndex:
+    """
+    Medianoche peninsular (sin zona) del día de cada instante, para agrupar o filtrar por días.
+    """
+    return pd.DatetimeIndex(fechas_hora).tz_convert(ZONA_PANDAS).tz_localize(None).normalize()
+
+
+def formatear(fechas_hora):
+    """
+    Columnas Fecha (dd/mm/aaaa) y Hora (HH:MM) en hora peninsular de unos instantes con zona.
+    Solo se formatea cada día distinto; las horas salen de una tabla.
+    """
+    local = pd.DatetimeIndex(fechas_hora).tz_convert(ZONA_PANDAS).tz_localize(None).asi8
+    dias, inversa = np.unique(local // _DIA_NS, return_inverse=True)
+    fechas = pd.DatetimeIndex(dias * _DIA_NS).strftime("%d/%m/%Y").to_numpy(dtype=object)[inversa]
+    horas = _HORAS[(local % _DIA_NS) // _MINUTO_NS]
+    return fechas, horas
+
+
+def con_fecha_hora(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Copia de un DataFrame canónico con las columnas Fecha y Hora en texto delante,
+    para las tablas de las páginas y las descargas en CSV.
+    """
+    fechas, horas = formatear(df.index)
+    tabla = df.reset_index(drop=True)
+    tabla.insert(0, "Fecha", fechas)
+    tabla.insert(1, "Hora", horas)
+    return tabla
+
+
+def guardar_dia(url_tipo: int, dia: date, df: pd.DataFrame) -> int:
+    """
+    Guarda (o actualiza) las filas de la tabla de un día (DataFrame canónico)
+    y lo marca como descargado. Devuelve el número de filas guardadas.
+    """
+    return guardar_dias(url_tipo, {dia: df})
+
+
+def filas_medidas(df: pd.DataFrame) -> np.ndarray:
+    """
+    Máscara de las filas con datos medidos. En las tablas con previsiones las horas
+    futuras ya vienen, pero con el resto de columnas a 0.
+    """
+    medidas = [c for c in df.columns if c not in COLUMNAS_PREVISION]
+    if len(medidas) == len(df.columns):
+        return np.ones(len(df), dtype=bool)
+    return (df[medidas] != 0).any(axis=1).to_numpy()
+
+
+def ultimo_medido(df: pd.DataFrame):
+    """
+    Instante de la última fila de df con datos medidos, o None.
+    """
+    df = df[filas_medidas(df)]
+    if df.empty:
+        return None
+    return df.index.max().to_pydatetime()
+
+
+def guardar_dias(url_tipo: int, tablas: dict) -> int:
+    """
+    Como guardar_dia para varios días a la vez ({día: DataFrame canónico}), en una
+    sola transacción y con una inserción por tabla. Devuelve el número de filas guardadas.
+    """
+    registros = []
+    filas_dia = {}
+    ultimos = {}
+    partes = []
+    for dia, df in tablas.items():
+        filas_dia[dia] = 0
+        if df.empty or not isinstance(df.index, pd.DatetimeIndex):
+            continue
+        df = df[df.index.notna()]
+        for fecha_hora, valores in zip(df.index, df.to_dict("records")):
+            registros.append(RegistroRee(tipo=url_tipo, fecha_hora=fecha_hora.to_pydatetime(), valores=valores))
+        filas_dia[dia] = len(df)
+        ultimos[dia] = ultimo_medido(df)
+        partes.append(df)
+
+    hoy = hoy_local()
+    with transaction.atomic():
+        if registros:
+            RegistroRee.objects.bulk_create(
+                registros,
+                update_conflicts=True,
+                unique_fields=["tipo", "fecha_hora"],
+                update_fields=["valores"],
+            )
+            agregados.actualizar(NOMBRES_REE[url_tipo], pd.concat(partes))
+        # El día de hoy (o un día sin filas) se volverá a pedir en la próxima consulta
+        DiaRee.objects.bulk_create(
+            [
+                DiaRee(tipo=url_tipo, fecha=dia, filas=filas, completo=bool(filas) and dia < hoy, ultimo=ultimos.get(dia))
+                for dia, filas in filas_dia.items()
+            ],
+            update_conflicts=True,
+            unique_fields=["tipo", "fecha"],
+            update_fields=["filas", "completo", "ultimo", "actualizado"],
+        )
+    return len(registros)
+
+
+def estado_dia(url_tipo: int, dia: date):
+    """
+    DiaRee de un día, o None si todavía no se ha descargado nunca.
+    """
+    return DiaRee.objects.filter(tipo=url_tipo, fecha=dia).first()
+
+
+def recien_actualizado(url_tipo: int, dia: date, segundos: float) -> bool:
+    """
+    Si el día se guardó hace menos de `segundos` (para no volver a pedir a REE
+    el día en curso en cada consulta).
+    """
+    if not segundos:
+        return False
+    return DiaRee.objects.filter(
+        tipo=url_tipo, fecha=dia, actualizado__gte=timezone.now() - timedelta(seconds=segundos)
+    ).exists()
+
+
+def guardar_cambios(url_tipo: int, dia: date, df: pd.DataFrame) -> int:
+    """
+    Refresco incremental de un día ya guardado: df (canónico) trae solo las filas
+    nuevas o revisadas, que se insertan o sustituyen sin tocar el resto. Los
+    resúmenes del día se recalculan con el día completo ya actualizado.
+    Devuelve el número de filas escritas.
+    """
+    df = df[df.index.notna()]
+    registros = [
+        RegistroRee(tipo=url_tipo, fecha_hora=fecha_hora.to_pydatetime(), valores=valores)
+        for fecha_hora, valores in zip(df.index, df.to_dict("records"))
+    ]
+    with transaction.atomic():
+        estado = DiaRee.objects.select_for_update().get(tipo=url_tipo, fecha=dia)
+        if registros:
+            RegistroRee.objects.bulk_create(
+                registros,
+                update_conflicts=True,
+                unique_fields=["tipo", "fecha_hora"],
+                update_fields=["valores"],
+            )
+            agregados.actualizar(NOMBRES_REE[url_tipo], leer_rango(url_tipo, dia, dia))
+            ultimo = ultimo_medido(df)
+            if ultimo is not None and (estado.ultimo is None or ultimo > estado.ultimo):
+                estado.ultimo = ultimo
+            estado.filas = RegistroRee.objects.filter(
+                tipo=url_tipo, fecha_hora__gte=inicio_dia(dia), fecha_hora__lt=inicio_dia(dia + timedelta(days=1))
+            ).count()
+        # Aunque no haya cambios se guarda, para que cuente como recién actualizado
+        estado.save()
+    return len(registros)
+
+
+def leer_rango(url_tipo: int, start_date: date, end_date: date, columnas: list = None) -> pd.DataFrame:
+    """
+    Devuelve las filas guardadas entre start_date y end_date (ambos incluidos)
+    como DataFrame canónico (índice FechaHora y columnas numéricas).
+    Con `columnas` solo se extraen esas claves del JSON, en la propia consulta.
+    """
+    consulta = RegistroRee.objects.filter(
+        tipo=url_tipo,
+        fecha_hora__gte=inicio_dia(start_date),
+        fecha_hora__lt=inicio_dia(end_date + timedelta(days=1)),
+    ).order_by("fecha_hora")
+
+    if columnas is None:
+        filas = list(consulta.values_list("fecha_hora", "valores"))
+        if not filas:
+            return marco_vacio()
+        df = pd.DataFrame.from_records([v for _, v in filas], index=indice([f for f, _ in filas]))
+    else:
+        alias = {f"c{i}": KeyTransform(col, "valores") for i, col in enumerate(columnas)}
+        filas = list(consulta.annotate(**alias).values_list("fecha_hora", *alias))
+        if not filas:
+            return marco_vacio()
+        df = pd.DataFrame.from_records([f[1:] for f in filas], columns=columnas, index=indice([f[0] for f in filas]))
+        # Las columnas que no existen en este tipo de tabla no se devuelven
+        df = df.dropna(axis=1, how="all")
+    return df
@@ -0,0 +1,40 @@
+from datetime import datetime
+
+from django.core.management.base import BaseCommand, CommandError
+
+from gestionpedidos import archivos_omie
+
+
+def _fecha(texto):
+    return datetime.strptime(texto, "%Y-%m-%d").date()
+
+
+class Command(BaseCommand):
+    help = (
+        "Carga en la caché local los precios de OMIE de uno o varios archivos zip "
+        "de marginalpdbc (rutas locales, URLs o años con --anio)."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("origenes", nargs="*", help="Rutas o URLs de los zip")
+        parser.add_argument("--anio", type=int, action="append", default=[],
+                            help="Año a descargar de OMIE (se puede repetir)")
+        parser.add_argument("--desde", type=_fecha, help="Primer día a guardar (aaaa-mm-dd)")
+        parser.add_argument("--hasta", type=_fecha, help="Último día a guardar (aaaa-mm-dd)")
+        parser.add_argument("--lote", type=int, help="Días que se guardan de cada vez")
+
+    def handle(self, *args, **options):
+        origenes = options["origenes"] + [archivos_omie.OMIE_URL_ARCHIVO.format(anio) for anio in options["anio"]]
+        if not origenes:
+            raise CommandError("Indica al menos un archivo, una URL o --anio.")
+
+        for origen in origenes:
+            try:
+                resumen = archivos_omie.importar(
+                    origen, lote=options["lote"], desde=options["desde"], hasta=options["hasta"]
+                )
+            except Exception as e:
+                raise CommandError(f"No se pudo importar {origen}: {e}")
+            self.stdout.write(f"{origen}: {resumen['dias']} días, {resumen['filas']} filas")
+            for nombre in resumen["errores"]:
+                self.stderr.write(f"  no se pudo leer {nombre}")
@@ -0,0 +1,61 @@
+from datetime import datetime, timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+
+from gestionpedidos import historico, precarga
+
+
+def _fecha(texto):
+    return datetime.strptime(texto, "%Y-%m-%d").date()
+
+
+class Command(BaseCommand):
+    help = (
+        "Descarga por adelantado el histórico de REE y los precios de OMIE de un rango "
+        "de días. Los días ya guardados se saltan y una precarga interrumpida sigue "
+        "donde se quedó."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--desde", type=_fecha, required=True, help="Primer día (aaaa-mm-dd)")
+        parser.add_argument("--hasta", type=_fecha, help="Último día (aaaa-mm-dd); por defecto ayer")
+        parser.add_argument("--fuente", choices=precarga.FUENTES, action="append",
+                            help="Datos a precargar (se puede repetir); por defecto todos")
+        parser.add_argument("--concurrencia", type=int,
+                            help="Días que se descargan a la vez (por defecto SCRAP_NAVEGADORES u OMIE_DESCARGAS)")
+        parser.add_argument("--lote", type=int, help="Días que se guardan de cada vez")
+        parser.add_argument("--reiniciar", action="store_true",
+                            help="Olvida el punto de control y vuelve a pedir los precios de los días vacíos")
+
+    def handle(self, *args, **options):
+        desde = options["desde"]
+        hasta = options["hasta"] or historico.hoy_local() - timedelta(days=1)
+        if hasta < desde:
+            raise CommandError("--hasta no puede ser anterior a --desde.")
+
+        fallos = 0
+        for fuente in options["fuente"] or precarga.FUENTES:
+            if options["reiniciar"]:
+                precarga.borrar_control(fuente)
+
+            def progreso(hechos, total, fuente=fuente):
+                self.stdout.write(f"  {fuente}: {hechos}/{total} días")
+
+            try:
+                resumen = precarga.precargar(
+                    fuente, desde, hasta,
+                    concurrencia=options["concurrencia"], lote=options["lote"], progreso=progreso,
+                )
+            except Exception as e:
+                raise CommandError(f"No se pudo precargar {fuente}: {e}")
+            self.stdout.write(
+                f"{fuente}: {resumen['dias']} días, {resumen['filas']} filas, "
+                f"{resumen['vacios']} sin datos, {len(resumen['errores'])} con error"
+            )
+            if resumen["errores"]:
+                dias = ", ".join(f"{dia:%Y-%m-%d}" for dia in sorted(resumen["errores"]))
+                self.stderr.write(f"  no se pudieron descargar: {dias}")
+            fallos += len(resumen["errores"])
+
+        if fallos:
+            raise CommandError(f"{fallos} días no se pudieron descargar; vuelve a lanzar la precarga para reintentarlos.")
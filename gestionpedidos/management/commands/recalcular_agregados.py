@@ -0,0 +1,49 @@
+from datetime import datetime, timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+
+from gestionpedidos import agregados, columnar, historico
+
+FUENTES = ["demanda", "generacion", "almacenamiento", "precio"]
+
+
+def _fecha(texto):
+    return datetime.strptime(texto, "%Y-%m-%d").date()
+
+
+class Command(BaseCommand):
+    help = (
+        "Recalcula los resúmenes diarios (AgregadoDia) de un rango de días a partir de "
+        "los datos guardados: el histórico de REE y la caché Parquet de precios de OMIE. "
+        "Sirve para los días que se guardaron antes de que existieran los resúmenes."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--desde", type=_fecha, required=True, help="Primer día (aaaa-mm-dd)")
+        parser.add_argument("--hasta", type=_fecha, help="Último día (aaaa-mm-dd); por defecto ayer")
+        parser.add_argument("--fuente", choices=FUENTES, action="append",
+                            help="Datos a recalcular (se puede repetir); por defecto todos")
+
+    def handle(self, *args, **options):
+        desde = options["desde"]
+        hasta = options["hasta"] or historico.hoy_local() - timedelta(days=1)
+        if hasta < desde:
+            raise CommandError("--hasta no puede ser anterior a --desde.")
+
+        tipos_ree = {nombre: tipo for tipo, nombre in historico.NOMBRES_REE.items()}
+        for fuente in options["fuente"] or FUENTES:
+            if fuente == "precio" and not columnar.disponible():
+                self.stderr.write("precio: la caché Parquet necesita el paquete pyarrow")
+                continue
+            filas = 0
+            inicio = desde
+            # De mes en mes, para no tener el rango entero en memoria
+            while inicio <= hasta:
+                fin = min(hasta, (inicio.replace(day=1) + timedelta(days=32)).replace(day=1) - timedelta(days=1))
+                if fuente == "precio":
+                    df = columnar.leer("precio", inicio, fin, ["PrecioZonaEspañola"])
+                else:
+                    df = historico.leer_rango(tipos_ree[fuente], inicio, fin)
+                filas += agregados.actualizar(fuente, df)
+                inicio = fin + timedelta(days=1)
+            self.stdout.write(f"{fuente}: {filas} resúmenes")
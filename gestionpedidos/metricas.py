@@ -0,0 +1,245 @@
+"""
+Medición del tiempo de cada etapa (navegador, goto, espera de la tabla, extracción,
+conversión con pandas, alineación, figura, savefig, base64, escritura de la sesión...)
+y registro estructurado.
+
+  - etapa(nombre): bloque `with` que mide una etapa. Cada medición va a un
+    histograma del proceso y, si hay una petición en curso, a su cabecera
+    Server-Timing (sumando las veces que se repite la etapa).
+  - MiddlewareTiempos: abre la medición de cada petición, añade la cabecera
+    Server-Timing a la respuesta y mide la petición entera por vista.
+  - exposicion(): los histogramas en formato de texto de Prometheus, para la
+    vista /metricas/. Son del proceso: con varios procesos cada uno tiene los suyos.
+  - FormatoJSON: formateador de logging que escribe cada mensaje como una línea
+    JSON con sus campos extra y el identificador de la petición.
+
+Las etapas que se ejecutan en otros hilos (pool de navegadores, descargas de
+OMIE) cuentan para la petición si se ejecutan con propagar() o en_peticion().
+"""
+import contextvars
+import json
+import logging
+import math
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+from django.conf import settings
+
+# Límites superiores (segundos) de los cubos de los histogramas
+CUBOS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, math.inf)
+
+
+# -----------------------------
+# Histogramas del proceso
+# -----------------------------
+class _Histograma:
+    def __init__(self):
+        self.cuentas = [0] * len(CUBOS)
+        self.suma = 0.0
+        self.total = 0
+
+    def observar(self, segundos: float):
+        for i, limite in enumerate(CUBOS):
+            if segundos <= limite:
+                self.cuentas[i] += 1
+                break
+        self.suma += segundos
+        self.total += 1
+
+
+# (métrica, etiqueta, valor) -> _Histograma
+_histogramas = {}
+_histogramas_lock = threading.Lock()
+
+
+def observar(metrica: str, etiqueta: str, valor: str, segundos: float):
+    with _histogramas_lock:
+        clave = (metrica, etiqueta, valor)
+        if clave not in _histogramas:
+            _histogramas[clave] = _Histograma()
+        _histogramas[clave].observar(segundos)
+
+
+def _escapar(valor: str) -> str:
+    return str(valor).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def exposicion() -> str:
+    """
+    Histogramas en formato de texto de Prometheus (acumulados por cubo, con _sum y _count).
+    """
+    with _histogramas_lock:
+        copia = {
+            clave: (list(h.cuentas), h.suma, h.total) for clave, h in sorted(_histogramas.items())
+        }
+
+    lineas = []
+    metricas = sorted({metrica for metrica, _, _ in copia})
+    for metrica in metricas:
+        lineas.append(f"# TYPE {metrica} histogram")
+        for (nombre, etiqueta, valor), (cuentas, suma, total) in copia.items():
+            if nombre != metrica:
+                continue
+            base = f'{etiqueta}="{_escapar(valor)}"'
+            acumulado = 0
+            for limite, cuenta in zip(CUBOS, cuentas):
+                acumulado += cuenta
+                le = "+Inf" if limite == math.inf else repr(float(limite))
+                lineas.append(f'{metrica}_bucket{{{base},le="{le}"}} {acumulado}')
+            lineas.append(f"{metrica}_sum{{{base}}} {suma:.6f}")
+            lineas.append(f"{metrica}_count{{{base}}} {total}")
+    return "\n".join(lineas) + "\n"
+
+
+# -----------------------------
+# Medición por petición
+# -----------------------------
+class _Medicion:
+    """
+    Tiempos de las etapas de una petición: nombre -> (segundos, veces).
+    Pueden sumar desde varios hilos a la vez.
+    """
+    def __init__(self):
+        self.id = uuid.uuid4().hex[:12]
+        self.etapas = {}
+        self._lock = threading.Lock()
+
+    def sumar(self, nombre: str, segundos: float):
+        with self._lock:
+            total, veces = self.etapas.get(nombre, (0.0, 0))
+            self.etapas[nombre] = (total + segundos, veces + 1)
+
+    def server_timing(self, total: float) -> str:
+        with self._lock:
+            etapas = list(self.etapas.items())
+        partes = [
+            f'{nombre};dur={segundos * 1000:.1f}' + (f';desc="x{veces}"' if veces > 1 else "")
+            for nombre, (segundos, veces) in etapas
+        ]
+        partes.append(f"total;dur={total * 1000:.1f}")
+        return ", ".join(partes)
+
+
+_medicion = contextvars.ContextVar("medicion", default=None)
+
+
+def id_peticion():
+    medicion = _medicion.get()
+    return medicion.id if medicion is not None else None
+
+
+@contextmanager
+def etapa(nombre: str):
+    """
+    Mide el bloque como la etapa `nombre` (también si termina con una excepción).
+    """
+    inicio = time.perf_counter()
+    try:
+        yield
+    finally:
+        registrar(nombre, time.perf_counter() - inicio)
+
+
+def registrar(nombre: str, segundos: float):
+    """
+    Anota una etapa ya medida: en su histograma y, si hay petición, en su Server-Timing.
+    """
+    observar("tienda_etapa_segundos", "etapa", nombre, segundos)
+    medicion = _medicion.get()
+    if medicion is not None:
+        medicion.sumar(nombre, segundos)
+
+
+def actual():
+    """
+    Medición de la petición en curso (o None), para pasarla a otro hilo con en_peticion().
+    """
+    return _medicion.get()
+
+
+@contextmanager
+def en_peticion(medicion):
+    """
+    Bloque cuyas etapas cuentan para `medicion` aunque se ejecute en otro hilo.
+    """
+    token = _medicion.set(medicion)
+    try:
+        yield
+    finally:
+        _medicion.reset(token)
+
+
+def propagar(funcion):
+    """
+    Envuelve `funcion` para que, ejecutada en otro hilo, sus etapas cuenten para
+    la petición que la ha enviado.
+    """
+    medicion = _medicion.get()
+    if medicion is None:
+        return funcion
+
+    def envuelta(*args, **kwargs):
+        with en_peticion(medicion):
+            return funcion(*args, **kwargs)
+
+    return envuelta
+
+
+class MiddlewareTiempos:
+    """
+    Mide cada petición y añade la cabecera Server-Timing con sus etapas
+    (METRICAS_SERVER_TIMING). Va el primero de MIDDLEWARE para que el total
+    incluya a los demás (p. ej. el guardado de la sesión).
+    """
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        medicion = _Medicion()
+        token = _medicion.set(medicion)
+        inicio = time.perf_counter()
+        try:
+            response = self.get_response(request)
+        finally:
+            _medicion.reset(token)
+        total = time.perf_counter() - inicio
+
+        coincidencia = getattr(request, "resolver_match", None)
+        vista = coincidencia.url_name if coincidencia and coincidencia.url_name else "otra"
+        observar("tienda_peticion_segundos", "vista", vista, total)
+        if getattr(settings, "METRICAS_SERVER_TIMING", True):
+            response["Server-Timing"] = medicion.server_timing(total)
+        return response
+
+
+# -----------------------------
+# Registro estructurado
+# -----------------------------
+# Atributos que tiene cualquier LogRecord: el resto son los campos de `extra`
+_ATRIBUTOS_REGISTRO = set(vars(logging.LogRecord("", 0, "", 0, "", None, None))) | {"message", "asctime"}
+
+
+class FormatoJSON(logging.Formatter):
+    """
+    Una línea JSON por mensaje: instante, nivel, logger, mensaje, identificador de
+    la petición (si hay) y los campos pasados en `extra`.
+    """
+    def format(self, record):
+        datos = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "nivel": record.levelname,
+            "logger": record.name,
+            "mensaje": record.getMessage(),
+        }
+        peticion = id_peticion()
+        if peticion:
+            datos["peticion"] = peticion
+        for clave, valor in vars(record).items():
+            if clave not in _ATRIBUTOS_REGISTRO and not clave.startswith("_"):
+                datos[clave] = valor
+        if record.exc_info:
+            datos["excepcion"] = self.formatException(record.exc_info)
+        return json.dumps(datos, ensure_ascii=False, default=str)
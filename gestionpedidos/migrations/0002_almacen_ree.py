@@ -0,0 +1,47 @@
+# Generated by Django 5.2.6 on 2026-10-18 01:32
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('gestionpedidos', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DiaRee',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('tipo', models.PositiveSmallIntegerField(choices=[(1, 'Demanda'), (2, 'Generación'), (4, 'Almacenamiento')])),
+                ('fecha', models.DateField()),
+                ('filas', models.PositiveIntegerField(default=0)),
+                ('completo', models.BooleanField(default=False)),
+                ('actualizado', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'ordering': ['tipo', 'fecha'],
+            },
+        ),
+        migrations.CreateModel(
+            name='RegistroRee',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('tipo', models.PositiveSmallIntegerField(choices=[(1, 'Demanda'), (2, 'Generación'), (4, 'Almacenamiento')])),
+                ('fecha_hora', models.DateTimeField()),
+                ('valores', models.JSONField()),
+            ],
+            options={
+                'ordering': ['tipo', 'fecha_hora'],
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='diaree',
+            constraint=models.UniqueConstraint(fields=('tipo', 'fecha'), name='dia_ree_unico'),
+        ),
+        migrations.AddConstraint(
+            model_name='registroree',
+            constraint=models.UniqueConstraint(fields=('tipo', 'fecha_hora'), name='registro_ree_unico'),
+        ),
+    ]
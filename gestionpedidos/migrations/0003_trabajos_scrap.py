@@ -0,0 +1,31 @@
+# Generated by Django 5.2.6 on 2026-10-18 01:36
+
+import uuid
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('gestionpedidos', '0002_almacen_ree'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TrabajoScrap',
+            fields=[
+                ('id', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
+                ('tipo', models.CharField(max_length=20)),
+                ('parametros', models.JSONField(default=dict)),
+                ('estado', models.CharField(choices=[('pendiente', 'Pendiente'), ('en_curso', 'En curso'), ('terminado', 'Terminado'), ('error', 'Error')], default='pendiente', max_length=10)),
+                ('dias_total', models.PositiveIntegerField(default=0)),
+                ('dias_hechos', models.PositiveIntegerField(default=0)),
+                ('error', models.TextField(blank=True)),
+                ('creado', models.DateTimeField(auto_now_add=True)),
+                ('actualizado', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'ordering': ['-creado'],
+            },
+        ),
+    ]
@@ -0,0 +1,35 @@
+# Generated by Django 5.2.6 on 2026-10-18 01:50
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('gestionpedidos', '0003_trabajos_scrap'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AgregadoDia',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('fuente', models.CharField(choices=[('demanda', 'Demanda'), ('generacion', 'Generación'), ('almacenamiento', 'Almacenamiento'), ('precio', 'Precio OMIE')], max_length=20)),
+                ('columna', models.CharField(max_length=50)),
+                ('fecha', models.DateField()),
+                ('maximo', models.FloatField()),
+                ('hora_maximo', models.DateTimeField()),
+                ('minimo', models.FloatField()),
+                ('hora_minimo', models.DateTimeField()),
+                ('suma', models.FloatField()),
+                ('cuenta', models.PositiveIntegerField()),
+            ],
+            options={
+                'ordering': ['fuente', 'columna', 'fecha'],
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='agregadodia',
+            constraint=models.UniqueConstraint(fields=('fuente', 'columna', 'fecha'), name='agregado_dia_unico'),
+        ),
+    ]
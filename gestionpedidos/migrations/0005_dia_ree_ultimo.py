@@ -0,0 +1,18 @@
+# Generated by Django 5.2.6 on 2026-10-18 02:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('gestionpedidos', '0004_agregados_dia'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='diaree',
+            name='ultimo',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
@@ -1,3 +1,119 @@
+import uuid
+
 from django.db import models
 
 # Create your models here
+
+TIPOS_REE = [
+    (1, "Demanda"),
+    (2, "Generación"),
+    (4, "Almacenamiento"),
+]
+
+
+class RegistroRee(models.Model):
+    """
+    Fila de una tabla de REE para un instante concreto.
+    Las columnas numéricas de la tabla (Real, Eólica, Nuclear...) se guardan en `valores`.
+    """
+    tipo = models.PositiveSmallIntegerField(choices=TIPOS_REE)
+    fecha_hora = models.DateTimeField()
+    valores = models.JSONField()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["tipo", "fecha_hora"], name="registro_ree_unico"),
+        ]
+        ordering = ["tipo", "fecha_hora"]
+
+    def __str__(self):
+        return f"{self.get_tipo_display()} {self.fecha_hora:%d/%m/%Y %H:%M}"
+
+
+class DiaRee(models.Model):
+    """
+    Marca que la tabla de un día ya se ha descargado de REE.
+    Solo se marca como completo cuando el día ya ha terminado.
+    `ultimo` es el instante de la última fila con datos medidos (no solo previsiones),
+    para refrescar el día en curso añadiendo solo las filas nuevas.
+    """
+    tipo = models.PositiveSmallIntegerField(choices=TIPOS_REE)
+    fecha = models.DateField()
+    filas = models.PositiveIntegerField(default=0)
+    completo = models.BooleanField(default=False)
+    ultimo = models.DateTimeField(null=True, blank=True)
+    actualizado = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["tipo", "fecha"], name="dia_ree_unico"),
+        ]
+        ordering = ["tipo", "fecha"]
+
+    def __str__(self):
+        return f"{self.get_tipo_display()} {self.fecha:%d/%m/%Y}"
+
+
+class TrabajoScrap(models.Model):
+    """
+    Scraping largo que se ejecuta en segundo plano (ver trabajos.py).
+    `dias_hechos` de `dias_total` indica el progreso día a día.
+    """
+    PENDIENTE = "pendiente"
+    EN_CURSO = "en_curso"
+    TERMINADO = "terminado"
+    ERROR = "error"
+    ESTADOS = [
+        (PENDIENTE, "Pendiente"),
+        (EN_CURSO, "En curso"),
+        (TERMINADO, "Terminado"),
+        (ERROR, "Error"),
+    ]
+
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    tipo = models.CharField(max_length=20)
+    parametros = models.JSONField(default=dict)
+    estado = models.CharField(max_length=10, choices=ESTADOS, default=PENDIENTE)
+    dias_total = models.PositiveIntegerField(default=0)
+    dias_hechos = models.PositiveIntegerField(default=0)
+    error = models.TextField(blank=True)
+    creado = models.DateTimeField(auto_now_add=True)
+    actualizado = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        ordering = ["-creado"]
+
+    def __str__(self):
+        return f"{self.tipo} {self.parametros} ({self.estado})"
+
+
+class AgregadoDia(models.Model):
+    """
+    Resumen de una columna en un día: máximo y mínimo con su instante, suma y número de valores.
+    Las estadísticas de un rango se combinan a partir de estos resúmenes (ver agregados.py).
+    """
+    FUENTES = [
+        ("demanda", "Demanda"),
+        ("generacion", "Generación"),
+        ("almacenamiento", "Almacenamiento"),
+        ("precio", "Precio OMIE"),
+    ]
+
+    fuente = models.CharField(max_length=20, choices=FUENTES)
+    columna = models.CharField(max_length=50)
+    fecha = models.DateField()
+    maximo = models.FloatField()
+    hora_maximo = models.DateTimeField()
+    minimo = models.FloatField()
+    hora_minimo = models.DateTimeField()
+    suma = models.FloatField()
+    cuenta = models.PositiveIntegerField()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["fuente", "columna", "fecha"], name="agregado_dia_unico"),
+        ]
+        ordering = ["fuente", "columna", "fecha"]
+
+    def __str__(self):
+        return f"{self.get_fuente_display()} {self.columna} {self.fecha:%d/%m/%Y}"
@@ -0,0 +1,137 @@
+"""
+Pool de navegadores Playwright compartido por todo el proceso.
+La API síncrona de Playwright solo puede usarse desde el hilo que la arrancó,
+así que cada navegador vive en su propio hilo y recibe las tareas por una cola.
+"""
+import atexit
+import queue
+import threading
+from concurrent.futures import Future
+
+from django.conf import settings
+from playwright.sync_api import Error as PlaywrightError
+from playwright.sync_api import TimeoutError as PlaywrightTimeoutError
+from playwright.sync_api import sync_playwright
+
+from . import metricas
+
+
+class _Trabajador(threading.Thread):
+    """
+    Hilo dueño de un navegador Firefox. Lo lanza la primera vez que hace falta
+    y lo recicla tras `max_paginas` páginas o si se ha caído.
+    """
+
+    def __init__(self, tareas: queue.Queue, max_paginas: int, numero: int):
+        super().__init__(name=f"playwright-{numero}", daemon=True)
+        self._tareas = tareas
+        self._max_paginas = max_paginas
+        self._playwright = None
+        self._navegador = None
+        self._paginas = 0
+
+    def run(self):
+        try:
+            while True:
+                tarea = self._tareas.get()
+                if tarea is None:
+                    break
+                funcion, args, futuro, medicion = tarea
+                if not futuro.set_running_or_notify_cancel():
+                    continue
+                try:
+                    # Las etapas (también el arranque del navegador) cuentan para la petición que envió la tarea
+                    with metricas.en_peticion(medicion):
+                        futuro.set_result(self._ejecutar(funcion, args))
+                except BaseException as e:
+                    futuro.set_exception(e)
+        finally:
+            self._cerrar_navegador()
+            if self._playwright is not None:
+                self._playwright.stop()
+
+    def _obtener_navegador(self):
+        if self._navegador is not None and (
+            self._paginas >= self._max_paginas or not self._navegador.is_connected()
+        ):
+            self._cerrar_navegador()
+        if self._navegador is None:
+            with metricas.etapa("navegador"):
+                if self._playwright is None:
+                    self._playwright = sync_playwright().start()
+                self._navegador = self._playwright.firefox.launch(headless=True)
+            self._paginas = 0
+        return self._navegador
+
+    def _cerrar_navegador(self):
+        if self._navegador is None:
+            return
+        try:
+            self._navegador.close()
+        except PlaywrightError:
+            pass
+        self._navegador = None
+
+    def _ejecutar(self, funcion, args):
+        navegador = self._obtener_navegador()
+        contexto = navegador.new_context()
+        try:
+            return funcion(contexto.new_page(), *args)
+        except PlaywrightTimeoutError:
+            raise
+        except PlaywrightError:
+            # Navegador caído o en mal estado: se relanza en la siguiente tarea
+            self._cerrar_navegador()
+            raise
+        finally:
+            self._paginas += 1
+            try:
+                contexto.close()
+            except PlaywrightError:
+                pass
+
+
+class PoolNavegadores:
+    """
+    Reparte funciones `funcion(page, *args)` entre `navegadores` hilos,
+    cada uno con su propio Firefox. Cada tarea recibe una página en un
+    contexto nuevo, que se cierra al terminar.
+    """
+
+    def __init__(self, navegadores: int = 1, max_paginas: int = 50):
+        self._tareas = queue.Queue()
+        self._trabajadores = [
+            _Trabajador(self._tareas, max_paginas, i) for i in range(max(1, navegadores))
+        ]
+        for trabajador in self._trabajadores:
+            trabajador.start()
+
+    def enviar(self, funcion, *args) -> Future:
+        futuro = Future()
+        self._tareas.put((funcion, args, futuro, metricas.actual()))
+        return futuro
+
+    def cerrar(self, timeout: float = 10):
+        for _ in self._trabajadores:
+            self._tareas.put(None)
+        for trabajador in self._trabajadores:
+            trabajador.join(timeout)
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def obtener_pool() -> PoolNavegadores:
+    """
+    Pool único del proceso, configurado con SCRAP_NAVEGADORES y SCRAP_PAGINAS_POR_NAVEGADOR.
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = PoolNavegadores(
+                navegadores=getattr(settings, "SCRAP_NAVEGADORES", 1),
+                max_paginas=getattr(settings, "SCRAP_PAGINAS_POR_NAVEGADOR", 50),
+            )
+            atexit.register(_pool.cerrar)
+    return _pool
@@ -0,0 +1,95 @@
+"""
+Plazos, reintentos y corte de las descargas de REE.
+
+  - Plazo: tiempo total que tiene una petición para descargar sus días. De él sale
+    el tiempo de cada día, de modo que una petición nunca espera más que su presupuesto.
+  - espera_reintento: pausa antes de repetir un día fallido, exponencial y con
+    azar para que los reintentos de varias peticiones no lleguen a la vez.
+  - Interruptor: tras varios fallos seguidos deja de mandar descargas durante un
+    rato (REE caído o muy lento) y luego prueba con una sola antes de volver a abrir.
+"""
+import math
+import random
+import threading
+import time
+
+
+class PlazoAgotado(Exception):
+    pass
+
+
+class Plazo:
+    """
+    Fin de un presupuesto de `segundos` contados desde ahora (None: sin límite).
+    Los instantes son de time.monotonic(), válidos en cualquier hilo del proceso.
+    """
+    def __init__(self, segundos: float = None):
+        self.fin = None if segundos is None else time.monotonic() + segundos
+
+    def restante(self) -> float:
+        if self.fin is None:
+            return math.inf
+        return max(0.0, self.fin - time.monotonic())
+
+    def agotado(self) -> bool:
+        return self.restante() <= 0
+
+
+def limite_dia(segundos: float, fin: float = None) -> float:
+    """
+    Instante límite de una descarga que empieza ahora: `segundos` como mucho
+    y nunca más allá del fin del plazo de la petición.
+    """
+    limite = time.monotonic() + segundos
+    return limite if fin is None else min(limite, fin)
+
+
+def espera_reintento(intento: int, base: float = 1.0, maximo: float = 30.0) -> float:
+    # Backoff exponencial con jitter completo: entre 0 y base * 2^intento segundos
+    return random.uniform(0, min(maximo, base * 2 ** intento))
+
+
+class Interruptor:
+    """
+    Corte tras `fallos_max` fallos seguidos. Abierto, permitir() devuelve False
+    durante `segundos_abierto`; después deja pasar una prueba: si sale bien se cierra
+    y si falla vuelve a abrirse. Una prueba sin respuesta (p. ej. cancelada) caduca
+    al cabo de otros `segundos_abierto`.
+    """
+    def __init__(self, fallos_max: int = 5, segundos_abierto: float = 60):
+        self.fallos_max = fallos_max
+        self.segundos_abierto = segundos_abierto
+        self._fallos = 0
+        self._abierto_hasta = None
+        self._prueba = None
+        self._lock = threading.Lock()
+
+    def permitir(self) -> bool:
+        with self._lock:
+            if self._abierto_hasta is None:
+                return True
+            ahora = time.monotonic()
+            if ahora < self._abierto_hasta:
+                return False
+            if self._prueba is not None and ahora - self._prueba < self.segundos_abierto:
+                return False
+            self._prueba = ahora
+            return True
+
+    def exito(self):
+        with self._lock:
+            self._fallos = 0
+            self._abierto_hasta = None
+            self._prueba = None
+
+    def fallo(self):
+        with self._lock:
+            self._fallos += 1
+            if self._prueba is not None or self._fallos >= self.fallos_max:
+                self._abierto_hasta = time.monotonic() + self.segundos_abierto
+            self._prueba = None
+
+    @property
+    def abierto(self) -> bool:
+        with self._lock:
+            return self._abierto_hasta is not None and time.monotonic() < self._abierto_hasta
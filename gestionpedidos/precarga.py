@@ -0,0 +1,235 @@
+"""
+Precarga del histórico (manage.py precargar): descarga por adelantado un rango de
+días de REE (demanda, generación, almacenamiento) y de precios de OMIE para que
+las consultas no tengan que ir a la red.
+
+  - Los días que ya están guardados no se vuelven a pedir.
+  - Los días se descargan en paralelo (el pool de navegadores para REE, hilos
+    sobre la sesión HTTP para OMIE) y se guardan por lotes: una transacción y una
+    escritura en la caché Parquet por cada `lote` días.
+  - Una precarga interrumpida sigue donde se quedó: los días guardados ya no
+    están pendientes. Los precios de OMIE de días sin datos se anotan tras cada
+    lote en un punto de control por fuente en PRECARGA_DIR para no volver a
+    pedirlos. Una tabla de REE vacía no se anota: puede ser un fallo pasajero
+    de la página, así que se vuelve a pedir en la próxima precarga.
+"""
+import json
+import logging
+import os
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from datetime import date, timedelta
+
+import pandas as pd
+from django.conf import settings
+
+from . import columnar, historico
+from .utils_scrap import (
+    archivo_omie,
+    enviar_tabla,
+    escribir_atomico,
+    guardar_precio,
+    interruptor_ree,
+    parsear_marginalpdbc,
+    tabla_a_dataframe,
+)
+
+logger = logging.getLogger(__name__)
+
+FUENTES = ["demanda", "generacion", "almacenamiento", "precio"]
+
+# url_tipo de REE de cada fuente
+_TIPOS_REE = {nombre: tipo for tipo, nombre in historico.NOMBRES_REE.items()}
+
+
+# -----------------------------
+# Puntos de control
+# -----------------------------
+def _ruta_control(fuente: str) -> str:
+    directorio = getattr(settings, "PRECARGA_DIR", settings.CACHE_DIR / "precarga")
+    return os.path.join(directorio, f"{fuente}.json")
+
+
+def leer_control(fuente: str) -> dict:
+    """
+    Punto de control de una fuente: {"vacios": [días aaaa-mm-dd sin datos]}.
+    """
+    try:
+        with open(_ruta_control(fuente), encoding="utf-8") as f:
+            control = json.load(f)
+    except (OSError, ValueError):
+        control = {}
+    return {"vacios": control.get("vacios", [])}
+
+
+def _guardar_control(fuente: str, control: dict):
+    ruta = _ruta_control(fuente)
+    os.makedirs(os.path.dirname(ruta), exist_ok=True)
+    control = {clave: sorted(set(dias)) for clave, dias in control.items()}
+    escribir_atomico(ruta, json.dumps(control).encode("utf-8"))
+
+
+def borrar_control(fuente: str):
+    try:
+        os.remove(_ruta_control(fuente))
+    except FileNotFoundError:
+        pass
+
+
+# -----------------------------
+# Precarga
+# -----------------------------
+def _rango(start_date: date, end_date: date) -> list:
+    return [start_date + timedelta(days=i) for i in range((end_date - start_date).days + 1)]
+
+
+def dias_pendientes(fuente: str, start_date: date, end_date: date) -> list:
+    """
+    Días del rango que faltan por precargar: ni guardados ni marcados como vacíos
+    en el punto de control (solo precios). Hoy y los días futuros nunca se precargan.
+    """
+    end_date = min(end_date, historico.hoy_local() - timedelta(days=1))
+    if end_date < start_date:
+        return []
+    vacios = set(leer_control(fuente)["vacios"])
+    if fuente == "precio":
+        guardados = columnar.dias_guardados("precio", start_date, end_date)
+        dias = [d for d in _rango(start_date, end_date) if d not in guardados]
+    else:
+        dias = historico.dias_pendientes(_TIPOS_REE[fuente], start_date, end_date)
+    return [d for d in dias if d.isoformat() not in vacios]
+
+
+def _lotes_ree(url_tipo: int, dias: list, concurrencia: int, lote: int, resumen: dict):
+    """
+    Generador de lotes {día: DataFrame} de REE, con hasta `concurrencia` días en
+    el pool de navegadores a la vez. Los días que fallan se anotan en resumen["errores"].
+    """
+    pendientes = list(reversed(dias))
+    en_curso = {}
+    tablas = {}
+    try:
+        while pendientes or en_curso:
+            while pendientes and len(en_curso) < concurrencia:
+                if not interruptor_ree.permitir():
+                    # REE caído: si hay días en vuelo (entre ellos la prueba del corte)
+                    # se recogen primero; si no, se espera a que el corte deje pasar otra
+                    if en_curso:
+                        break
+                    time.sleep(1)
+                    continue
+                day = pendientes.pop()
+                en_curso[enviar_tabla(day.strftime("%Y-%m-%d"), url_tipo)] = day
+
+            hechos, _ = wait(en_curso, return_when=FIRST_COMPLETED)
+            for futuro in hechos:
+                day = en_curso.pop(futuro)
+                try:
+                    headers, rows_data = futuro.result()
+                except Exception as e:
+                    interruptor_ree.fallo()
+                    logger.error(
+                        "No se pudo precargar %s (tipo %s): %s", day, url_tipo, e,
+                        extra={"fecha": day.isoformat(), "url_tipo": url_tipo},
+                    )
+                    resumen["errores"].append(day)
+                    continue
+                interruptor_ree.exito()
+                tablas[day] = tabla_a_dataframe(headers, rows_data)
+
+            if len(tablas) >= lote:
+                yield tablas
+                tablas = {}
+    finally:
+        # Interrupción: lo que no ha empezado se cancela (los lotes ya guardados quedan en el control)
+        for futuro in en_curso:
+            futuro.cancel()
+    if tablas:
+        yield tablas
+
+
+def _lotes_precio(dias: list, concurrencia: int, lote: int, resumen: dict):
+    """
+    Generador de lotes {día: DataFrame} de precios de OMIE. A diferencia de las
+    consultas, un día que no se puede descargar no cuenta como vacío: queda en
+    resumen["errores"] y se vuelve a intentar en la próxima precarga.
+    """
+    with ThreadPoolExecutor(max_workers=concurrencia) as executor:
+        for i in range(0, len(dias), lote):
+            bloque = dias[i:i + lote]
+            futuros = {executor.submit(archivo_omie, pd.Timestamp(d)): d for d in bloque}
+            tablas = {}
+            for futuro, day in futuros.items():
+                try:
+                    tablas[day] = parsear_marginalpdbc(futuro.result())
+                except Exception as e:
+                    logger.error("No se pudo precargar el precio de %s: %s", day, e, extra={"fecha": day.isoformat()})
+                    resumen["errores"].append(day)
+            yield tablas
+
+
+def _guardar_lote(fuente: str, tablas: dict) -> tuple:
+    """
+    Guarda un lote y devuelve (días con datos, días vacíos, filas).
+    """
+    con_datos = {d: df for d, df in tablas.items() if df is not None and not df.empty}
+    vacios = [d for d in tablas if d not in con_datos]
+    filas = 0
+    if con_datos:
+        df = pd.concat(con_datos.values()).sort_index(kind="stable")
+        if fuente == "precio":
+            guardar_precio(df)
+            filas = len(df)
+        else:
+            filas = historico.guardar_dias(_TIPOS_REE[fuente], con_datos)
+            # Los días ya están cerrados: pasan directamente a la caché Parquet
+            columnar.guardar(fuente, df)
+    return list(con_datos), vacios, filas
+
+
+def precargar(fuente: str, start_date: date, end_date: date, concurrencia: int = None,
+              lote: int = None, progreso=None) -> dict:
+    """
+    Descarga y guarda los días pendientes de `fuente` entre start_date y end_date.
+    `progreso(hechos, total)` se llama tras cada lote guardado.
+    Devuelve {"dias", "filas", "vacios", "errores": [días que fallaron]}.
+    """
+    if fuente not in FUENTES:
+        raise ValueError(f"Fuente desconocida: {fuente}")
+    if fuente == "precio" and not columnar.disponible():
+        raise RuntimeError("la precarga de precios de OMIE necesita el paquete pyarrow")
+    if lote is None:
+        lote = getattr(settings, "PRECARGA_LOTE", 31)
+
+    dias = dias_pendientes(fuente, start_date, end_date)
+    resumen = {"dias": 0, "filas": 0, "vacios": 0, "errores": []}
+    if not dias:
+        return resumen
+
+    if fuente == "precio":
+        concurrencia = concurrencia or getattr(settings, "OMIE_DESCARGAS", 8)
+        lotes = _lotes_precio(dias, max(1, concurrencia), lote, resumen)
+    else:
+        concurrencia = concurrencia or getattr(settings, "SCRAP_NAVEGADORES", 1)
+        lotes = _lotes_ree(_TIPOS_REE[fuente], dias, max(1, concurrencia), lote, resumen)
+
+    control = leer_control(fuente)
+    try:
+        for tablas in lotes:
+            con_datos, vacios, filas = _guardar_lote(fuente, tablas)
+            if fuente == "precio" and vacios:
+                control["vacios"] += [d.isoformat() for d in vacios]
+                _guardar_control(fuente, control)
+            resumen["dias"] += len(con_datos)
+            resumen["vacios"] += len(vacios)
+            resumen["filas"] += filas
+            if progreso:
+                progreso(resumen["dias"] + resumen["vacios"] + len(resumen["errores"]), len(dias))
+    finally:
+        lotes.close()
+
+    logger.info(
+        "Precarga de %s: %s días, %s filas", fuente, resumen["dias"], resumen["filas"],
+        extra={"fuente": fuente, "dias": resumen["dias"], "filas": resumen["filas"]},
+    )
+    return resumen
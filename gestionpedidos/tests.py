@@ -1,3 +1,742 @@
-from django.test import TestCase
+import io
+import json
+import os
+import shutil
+import tempfile
+import threading
+import zipfile
+from concurrent.futures import Future
+from datetime import date, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock, skipUnless
 
-# Create your tests here.
+import pandas as pd
+from django.test import TestCase, override_settings
+from django.utils import timezone
+
+from . import agregados, alineacion, archivos_omie, columnar, historico, plazos, trabajos, utils_scrap, views
+from .models import TrabajoScrap
+from .utils_scrap import parsear_marginalpdbc
+
+
+def _marginalpdbc(dia: date, periodos: int = 24) -> bytes:
+    filas = "".join(
+        f"{dia.year};{dia.month:02d};{dia.day:02d};{p};{50 + p:.2f};{40 + p:.2f};\n"
+        for p in range(1, periodos + 1)
+    )
+    return f"MARGINALPDBC;\n{filas}*\n".encode("latin-1")
+
+
+class _SinSeek(io.RawIOBase):
+    """
+    Destino que no admite seek: zipfile escribe los tamaños en un descriptor tras los datos.
+    """
+    def __init__(self):
+        self.datos = bytearray()
+
+    def writable(self):
+        return True
+
+    def write(self, datos):
+        self.datos += datos
+        return len(datos)
+
+
+def _zip(contenidos: dict, metodo: int, flujo: bool) -> bytes:
+    destino = _SinSeek() if flujo else io.BytesIO()
+    with zipfile.ZipFile(destino, "w", metodo) as z:
+        for nombre, contenido in contenidos.items():
+            with z.open(nombre, "w") as f:
+                f.write(contenido)
+    return bytes(destino.datos) if flujo else destino.getvalue()
+
+
+# -----------------------------
+# Archivos marginalpdbc y formato de fechas
+# -----------------------------
+class ParsearMarginalpdbcTests(TestCase):
+    def _comprobar_dia(self, dia: date, periodos: int, minutos: int):
+        df = parsear_marginalpdbc(_marginalpdbc(dia, periodos).decode("latin-1"))
+
+        self.assertEqual(list(df.columns), ["PrecioZonaEspañola"])
+        self.assertEqual(df.index.name, historico.INDICE)
+        self.assertEqual(str(df.index.tz), historico.ZONA_PANDAS)
+        self.assertEqual(len(df), periodos)
+        self.assertEqual(df["PrecioZonaEspañola"].tolist(), [40.0 + p for p in range(1, periodos + 1)])
+        # Periodos consecutivos de la misma duración en tiempo real, de medianoche a medianoche
+        self.assertTrue((df.index[1:] - df.index[:-1] == pd.Timedelta(minutes=minutos)).all())
+        self.assertEqual(df.index[0], historico.inicio_dia(dia))
+        self.assertEqual(df.index[-1] + pd.Timedelta(minutes=minutos), historico.inicio_dia(dia + timedelta(days=1)))
+        return df
+
+    def test_dia_normal_por_horas_y_cuartos(self):
+        self._comprobar_dia(date(2025, 1, 15), 24, 60)
+        self._comprobar_dia(date(2025, 10, 1), 96, 15)
+
+    def test_cambio_a_horario_de_verano(self):
+        df = self._comprobar_dia(date(2025, 3, 30), 23, 60)
+        _, horas = historico.formatear(df.index)
+        self.assertEqual(list(horas[:3]), ["00:00", "01:00", "03:00"])
+
+        df = self._comprobar_dia(date(2025, 3, 30), 92, 15)
+        _, horas = historico.formatear(df.index)
+        self.assertEqual(list(horas[7:9]), ["01:45", "03:00"])
+
+    def test_cambio_a_horario_de_invierno(self):
+        df = self._comprobar_dia(date(2025, 10, 26), 25, 60)
+        _, horas = historico.formatear(df.index)
+        self.assertEqual(list(horas[:5]), ["00:00", "01:00", "02:00", "02:00", "03:00"])
+
+        df = self._comprobar_dia(date(2025, 10, 26), 100, 15)
+        _, horas = historico.formatear(df.index)
+        self.assertEqual(list(horas[11:13]), ["02:45", "02:00"])
+        self.assertTrue(df.index.is_unique)
+
+    def test_precio_portugues_si_falta_el_espanol(self):
+        texto = "MARGINALPDBC;\n2025;01;15;1;55.5;;\n2025;01;15;2;56.0;57.0;\n*\n"
+        df = parsear_marginalpdbc(texto)
+        self.assertEqual(df["PrecioZonaEspañola"].tolist(), [55.5, 57.0])
+
+    def test_archivo_sin_filas(self):
+        self.assertTrue(parsear_marginalpdbc("MARGINALPDBC;\n").empty)
+        self.assertTrue(parsear_marginalpdbc("").empty)
+        with self.assertRaises(ValueError):
+            parsear_marginalpdbc("MARGINALPDBC;\n*\n")
+
+
+class FormatearTests(TestCase):
+    def test_fecha_y_hora_peninsulares(self):
+        instantes = pd.DatetimeIndex(
+            ["2024-12-31 23:00", "2025-03-30 00:55", "2025-03-30 01:00", "2025-06-30 22:05"], tz="UTC"
+        )
+        fechas, horas = historico.formatear(instantes)
+        self.assertEqual(list(fechas), ["01/01/2025", "30/03/2025", "30/03/2025", "01/07/2025"])
+        self.assertEqual(list(horas), ["00:00", "01:55", "03:00", "00:05"])
+
+    def test_con_fecha_hora(self):
+        df = pd.DataFrame(
+            {"Real": [1.0, 2.0]},
+            index=historico.indice(pd.DatetimeIndex(["2025-01-01 00:00", "2025-01-01 00:05"], tz="UTC").asi8),
+        )
+        tabla = historico.con_fecha_hora(df)
+        self.assertEqual(list(tabla.columns), ["Fecha", "Hora", "Real"])
+        self.assertEqual(tabla.iloc[1].tolist(), ["01/01/2025", "01:05", 2.0])
+
+
+def _serie(inicio: str, periodos: int, minutos: int, columna: str, valores) -> pd.DataFrame:
+    """
+    DataFrame canónico con `periodos` instantes cada `minutos` desde `inicio` (hora peninsular).
+    """
+    horas = pd.date_range(inicio, periods=periodos, freq=f"{minutos}min", tz=historico.ZONA_PANDAS)
+    return pd.DataFrame({columna: [float(v) for v in valores]}, index=historico.indice(horas.asi8))
+
+
+# -----------------------------
+# Alineación de la comparativa
+# -----------------------------
+class AlinearTests(TestCase):
+    def setUp(self):
+        # Demanda cada 5 minutos de 00:00 a 01:55 y precio horario a las 00:00 y 01:00
+        self.demanda = _serie("2025-01-15 00:00", 24, 5, "Real", range(24))
+        self.precio = _serie("2025-01-15 00:00", 2, 60, "PrecioZonaEspañola", [10, 22])
+
+    def test_asof(self):
+        df = alineacion.alinear([self.demanda, self.precio], "asof")
+        self.assertEqual(list(df.columns), ["Real", "PrecioZonaEspañola"])
+        self.assertTrue(df.index.equals(self.demanda.index))
+        self.assertEqual(df["PrecioZonaEspañola"].tolist(), [10.0] * 12 + [22.0] * 12)
+
+    def test_interpolar(self):
+        df = alineacion.alinear([self.demanda, self.precio], "interpolar")
+        # Sin extrapolar: después de la última muestra de precio no hay filas
+        self.assertTrue(df.index.equals(self.demanda.index[:13]))
+        self.assertEqual(df["PrecioZonaEspañola"].tolist(), [10.0 + p for p in range(13)])
+
+    def test_interpolar_no_cruza_huecos(self):
+        # Precio horario sin las 02:00 ni las 03:00: de 01:00 a 04:00 no se interpola
+        precio = _serie("2025-01-15 00:00", 6, 60, "PrecioZonaEspañola", range(6))
+        precio = precio.iloc[[0, 1, 4, 5]]
+        demanda = _serie("2025-01-15 00:00", 61, 5, "Real", range(61))
+        df = alineacion.alinear([demanda, precio], "interpolar")
+        self.assertTrue(df.index.equals(demanda.index[:13].append(demanda.index[48:])))
+
+    def test_media(self):
+        df = alineacion.alinear([self.demanda, self.precio], "media")
+        self.assertTrue(df.index.equals(self.precio.index))
+        self.assertEqual(df["Real"].tolist(), [5.5, 17.5])
+        self.assertEqual(df["PrecioZonaEspañola"].tolist(), [10.0, 22.0])
+
+    def test_solo_instantes_con_todas_las_series(self):
+        otra = _serie("2025-01-15 00:30", 6, 5, "Eólica", range(6))
+        df = alineacion.alinear([self.demanda, otra], "asof")
+        self.assertTrue(df.index.equals(otra.index))
+        self.assertEqual(df["Real"].tolist(), [6.0, 7.0, 8.0, 9.0, 10.0, 11.0])
+
+    def test_modo_desconocido_y_sin_datos(self):
+        with self.assertRaises(ValueError):
+            alineacion.alinear([self.demanda, self.precio], "otro")
+        self.assertTrue(alineacion.alinear([historico.marco_vacio(["Real"])], "asof").empty)
+
+
+class BloquesComparativaTests(TestCase):
+    """
+    La comparativa día a día de las descargas tiene que coincidir con la del rango entero.
+    """
+    def setUp(self):
+        # Tres días con el cambio a horario de verano en medio (el 30 de marzo tiene 23 horas)
+        self.demanda = _serie("2025-03-29 00:00", 3 * 288 - 12, 5, "Real", [(7 * i) % 61 for i in range(3 * 288 - 12)])
+        self.precio = _serie("2025-03-29 00:00", 71, 60, "PrecioZonaEspañola", [(13 * i) % 29 for i in range(71)])
+        for nombre, df in (("scrap_rango_parcial", self.demanda), ("scrap_rango_precio_omie", self.precio)):
+            parche = mock.patch.object(views, nombre, side_effect=self._leer(df, con_faltan=nombre == "scrap_rango_parcial"))
+            parche.start()
+            self.addCleanup(parche.stop)
+
+    @staticmethod
+    def _leer(df, con_faltan: bool):
+        def leer(fecha_inicio, fecha_fin, **kwargs):
+            inicio = historico.inicio_dia(date.fromisoformat(fecha_inicio))
+            fin = historico.inicio_dia(date.fromisoformat(fecha_fin) + timedelta(days=1))
+            parte = df[(df.index >= inicio) & (df.index < fin)]
+            return (parte, []) if con_faltan else parte
+        return leer
+
+    def test_igual_que_el_rango_entero(self):
+        for modo in alineacion.MODOS:
+            with self.subTest(modo=modo):
+                entero = alineacion.alinear([self.demanda, self.precio], modo)
+                bloques = list(views._bloques_comparativa("demanda", "precio", "2025-03-29", "2025-03-31", modo))
+                self.assertEqual(len(bloques), 3)
+                pd.testing.assert_frame_equal(pd.concat(bloques), entero)
+
+                # Entre las 23:00 y medianoche solo se puede interpolar con la primera
+                # muestra del día siguiente: esas filas tienen que estar en cada bloque
+                for bloque, dia in zip(bloques[:-1], ("2025-03-29", "2025-03-30")):
+                    ultima = "23:00" if modo == "media" else "23:55"
+                    self.assertEqual(bloque.index[-1], pd.Timestamp(f"{dia} {ultima}", tz=historico.ZONA_PANDAS))
+
+
+# -----------------------------
+# Corte de REE y resúmenes diarios
+# -----------------------------
+class InterruptorTests(TestCase):
+    def setUp(self):
+        self.ahora = 1000.0
+        reloj = mock.patch.object(plazos.time, "monotonic", side_effect=lambda: self.ahora)
+        reloj.start()
+        self.addCleanup(reloj.stop)
+        self.corte = plazos.Interruptor(fallos_max=2, segundos_abierto=60)
+
+    def _abrir(self):
+        self.corte.fallo()
+        self.assertTrue(self.corte.permitir())
+        self.corte.fallo()
+        self.assertTrue(self.corte.abierto)
+        self.assertFalse(self.corte.permitir())
+
+    def test_se_abre_tras_fallos_seguidos(self):
+        self.corte.fallo()
+        self.corte.exito()
+        self.corte.fallo()
+        # Un éxito en medio reinicia la cuenta
+        self.assertFalse(self.corte.abierto)
+        self.assertTrue(self.corte.permitir())
+        self.corte.fallo()
+        self.assertTrue(self.corte.abierto)
+        self.assertFalse(self.corte.permitir())
+
+    def test_prueba_correcta_cierra(self):
+        self._abrir()
+        self.ahora += 61
+        self.assertFalse(self.corte.abierto)
+        self.assertTrue(self.corte.permitir())
+        # Solo una prueba a la vez
+        self.assertFalse(self.corte.permitir())
+        self.corte.exito()
+        self.assertTrue(self.corte.permitir())
+        self.assertTrue(self.corte.permitir())
+
+    def test_prueba_fallida_vuelve_a_abrir(self):
+        self._abrir()
+        self.ahora += 61
+        self.assertTrue(self.corte.permitir())
+        self.corte.fallo()
+        self.assertTrue(self.corte.abierto)
+        self.assertFalse(self.corte.permitir())
+        self.ahora += 61
+        self.assertTrue(self.corte.permitir())
+
+    def test_prueba_sin_respuesta_caduca(self):
+        self._abrir()
+        self.ahora += 61
+        self.assertTrue(self.corte.permitir())
+        self.ahora += 30
+        self.assertFalse(self.corte.permitir())
+        self.ahora += 31
+        self.assertTrue(self.corte.permitir())
+
+
+class EstadisticasTests(TestCase):
+    def setUp(self):
+        # Dos días de demanda cada hora; el máximo el segundo día y el mínimo repetido
+        self.df = pd.concat([
+            _serie("2025-01-15 00:00", 24, 60, "Real", [5] + [10] * 22 + [5]),
+            _serie("2025-01-16 00:00", 24, 60, "Real", [20] * 12 + [30] + [20] * 11),
+        ])
+        agregados.actualizar("demanda", self.df)
+
+    def test_combina_los_resumenes(self):
+        stats = agregados.estadisticas({"Real": "demanda"}, date(2025, 1, 15), date(2025, 1, 16), len(self.df))
+        real = stats["Real"]
+        self.assertEqual(real["max"], self.df["Real"].max())
+        self.assertEqual(real["hora_max"], self.df["Real"].idxmax())
+        self.assertEqual(real["min"], self.df["Real"].min())
+        self.assertEqual(real["hora_min"], self.df["Real"].idxmin())
+        self.assertAlmostEqual(real["mean"], self.df["Real"].mean())
+
+    def test_sin_resumenes_que_cuadren(self):
+        # Filas de más (datos cruzados o filtrados), días sin resumen o columna de otra fuente
+        self.assertEqual(agregados.estadisticas({"Real": "demanda"}, date(2025, 1, 15), date(2025, 1, 16), 47), {})
+        self.assertEqual(agregados.estadisticas({"Real": "demanda"}, date(2025, 1, 15), date(2025, 1, 17), 72), {})
+        self.assertEqual(agregados.estadisticas({"Real": "precio"}, date(2025, 1, 15), date(2025, 1, 16), 48), {})
+
+    def test_cada_columna_por_separado(self):
+        # Prevista solo tiene resumen del primer día: sale de las filas, Real de los resúmenes
+        agregados.actualizar("demanda", _serie("2025-01-15 00:00", 24, 60, "Prevista", [7] * 24))
+        fuentes = {"Real": "demanda", "Prevista": "demanda"}
+        stats = agregados.estadisticas(fuentes, date(2025, 1, 15), date(2025, 1, 16), len(self.df))
+        self.assertEqual(list(stats), ["Real"])
+
+        # Las filas no coinciden con los resúmenes de Real: así se ve de dónde sale cada columna
+        df = self.df.assign(Real=1.0, Prevista=[3.0] * 47 + [9.0])
+        referencia = {"parametros": {"fecha_inicio": "2025-01-15", "fecha_fin": "2025-01-16"}}
+        resultado = views._estadisticas(df, referencia, fuentes, "%d/%m/%Y %H:%M")
+        self.assertEqual(list(resultado), ["Real", "Prevista"])
+        self.assertEqual((resultado["Real"]["max_val"], resultado["Real"]["hora_max"]), (30.0, "16/01/2025 12:00"))
+        self.assertEqual((resultado["Prevista"]["max_val"], resultado["Prevista"]["hora_max"]), (9.0, "16/01/2025 23:00"))
+        self.assertEqual(resultado["Prevista"]["mean_val"], round((3.0 * 47 + 9.0) / 48, 2))
+
+    def test_actualizar_sustituye_el_dia(self):
+        agregados.actualizar("demanda", _serie("2025-01-16 00:00", 24, 60, "Real", [1] * 24))
+        stats = agregados.estadisticas({"Real": "demanda"}, date(2025, 1, 16), date(2025, 1, 16), 24)
+        self.assertEqual((stats["Real"]["max"], stats["Real"]["min"], stats["Real"]["mean"]), (1.0, 1.0, 1.0))
+
+
+# -----------------------------
+# Tablas de REE desde la respuesta de datos
+# -----------------------------
+class _PaginaFalsa:
+    """
+    Página del pool con una tabla en el DOM y una respuesta de datos (JSONP) al cargar.
+    """
+    def __init__(self, cabeceras: list, filas: list, texto: str):
+        self.tabla = [cabeceras, filas]
+        self.texto = texto
+        self.lecturas_dom = 0
+
+    def route(self, patron, manejador):
+        pass
+
+    def on(self, evento, manejador):
+        self.manejador = manejador
+
+    def goto(self, url, timeout):
+        self.manejador(mock.Mock(url="https://demanda.ree.es/WSvisiona/datos", **{"text.return_value": self.texto}))
+
+    def wait_for_selector(self, selector, timeout):
+        self.lecturas_dom += 1
+
+    def eval_on_selector(self, selector, js):
+        return self.tabla
+
+
+@override_settings(SCRAP_MODO="red", SCRAP_PATRON_DATOS="WSvisiona")
+class ColumnasRedTests(TestCase):
+    CABECERAS = ["Hora", "Real", "Prevista"]
+    FILAS = [["2025-01-15 00:00", "28.000,5", "27.900"], ["2025-01-15 00:05", "27.800", "27.750"]]
+
+    def setUp(self):
+        for parche in (
+            mock.patch.dict(utils_scrap._COLUMNAS_RED, clear=True),
+            mock.patch.dict(utils_scrap._CANDIDATOS_RED, clear=True),
+        ):
+            parche.start()
+            self.addCleanup(parche.stop)
+
+    @staticmethod
+    def _jsonp(registros: list) -> str:
+        return f"callback({json.dumps({'valoresHorarios': registros})});"
+
+    def _extraer(self, pagina):
+        return utils_scrap._extraer_tabla(pagina, "https://demanda.ree.es/tabla", "tabla_prueba")
+
+    def test_registros_json(self):
+        registros = [{"ts": "2025-01-15 00:00", "dem": 1}, {"ts": "2025-01-15 00:05", "dem": 2}]
+        texto = "callback(" + json.dumps({"otros": [{"ts": "x"}], "datos": {"serie": registros}}) + ");"
+        self.assertEqual(utils_scrap._registros_json(texto), registros)
+        self.assertEqual(utils_scrap._registros_json("callback(no es json);"), [])
+
+    def test_aprende_columnas_que_cuadran_con_la_tabla(self):
+        texto = self._jsonp([
+            {"ts": "2025-01-15 00:00", "dem": 28000.5, "prev": 27900, "prog": 1},
+            {"ts": "2025-01-15 00:05", "dem": 27800, "prev": 27750, "prog": 1},
+        ])
+        pagina = _PaginaFalsa(self.CABECERAS, self.FILAS, texto)
+
+        # La primera vez se lee el DOM y se aprende qué clave es cada columna
+        self.assertEqual(self._extraer(pagina), (self.CABECERAS, self.FILAS))
+        self.assertEqual(pagina.lecturas_dom, 1)
+        self.assertEqual(utils_scrap._columnas_aprendidas("tabla_prueba")[1], {"Real": "dem", "Prevista": "prev"})
+
+        # Después la tabla sale del JSON sin esperar al DOM
+        self.assertEqual(self._extraer(pagina), (
+            self.CABECERAS,
+            [["2025-01-15 00:00", 28000.5, 27900.0], ["2025-01-15 00:05", 27800.0, 27750.0]],
+        ))
+        self.assertEqual(pagina.lecturas_dom, 1)
+
+    def test_respuesta_ambigua_no_enseña_nada(self):
+        # Dos claves con los mismos valores: no se sabe cuál es la columna Real
+        texto = self._jsonp([
+            {"ts": "2025-01-15 00:00", "dem": 28000.5, "dem2": 28000.5, "prev": 27900},
+            {"ts": "2025-01-15 00:05", "dem": 27800, "dem2": 27800, "prev": 27750},
+        ])
+        pagina = _PaginaFalsa(self.CABECERAS, self.FILAS, texto)
+        for lecturas in (1, 2):
+            self.assertEqual(self._extraer(pagina), (self.CABECERAS, self.FILAS))
+            self.assertEqual(pagina.lecturas_dom, lecturas)
+        self.assertIsNone(utils_scrap._columnas_aprendidas("tabla_prueba"))
+        self.assertIsNone(utils_scrap._tabla_desde_red("tabla_prueba", utils_scrap._registros_json(texto)))
+
+
+# -----------------------------
+# Descarga de un rango con plazo
+# -----------------------------
+def _futuro(resultado=None, error: Exception = None) -> Future:
+    futuro = Future()
+    if error is not None:
+        futuro.set_exception(error)
+    elif resultado is not None:
+        futuro.set_result(resultado)
+    return futuro
+
+
+@override_settings(SCRAP_CONCURRENCIA=3, SCRAP_REINTENTOS=2, SCRAP_TIMEOUT_DIA=60)
+class ScrapRangoParcialTests(TestCase):
+    def setUp(self):
+        directorio = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directorio)
+        ajustes = override_settings(PARQUET_DIR=os.path.join(directorio, "parquet"))
+        ajustes.enable()
+        self.addCleanup(ajustes.disable)
+        for parche in (
+            mock.patch.object(utils_scrap, "interruptor_ree", plazos.Interruptor(fallos_max=5, segundos_abierto=60)),
+            mock.patch.object(plazos, "espera_reintento", return_value=0.0),
+        ):
+            parche.start()
+            self.addCleanup(parche.stop)
+
+    @staticmethod
+    def _tabla(fecha: str):
+        return ["Hora", "Real"], [[f"{fecha}T{h:02d}:00", f"{100 + h},0"] for h in range(24)]
+
+    def test_dia_sin_respuesta_y_dia_reintentado(self):
+        llamadas = []
+
+        def enviar_tabla(fecha, url_tipo, fin=None):
+            llamadas.append(fecha)
+            if fecha == "2025-01-14":
+                # REE no contesta: el día se queda en curso hasta que se acaba el plazo
+                return _futuro()
+            if fecha == "2025-01-15" and llamadas.count(fecha) == 1:
+                return _futuro(error=RuntimeError("tabla no encontrada"))
+            return _futuro(self._tabla(fecha))
+
+        hechos = []
+        with (
+            mock.patch.object(utils_scrap, "enviar_tabla", side_effect=enviar_tabla),
+            self.assertLogs("gestionpedidos.utils_scrap", "INFO") as registro,
+        ):
+            df, faltan = utils_scrap.scrap_rango_parcial(
+                "2025-01-13", "2025-01-15", url_tipo=1, progreso=hechos.append, presupuesto=1.0
+            )
+
+        self.assertIn("Reintento 1 de 2025-01-15", registro.output[0])
+        self.assertEqual(faltan, [date(2025, 1, 14)])
+        self.assertEqual(sorted(llamadas), ["2025-01-13", "2025-01-14", "2025-01-15", "2025-01-15"])
+        self.assertEqual(sorted(hechos), [date(2025, 1, 13), date(2025, 1, 14), date(2025, 1, 15)])
+        self.assertEqual(len(df), 48)
+        self.assertEqual(sorted(set(df.index.date)), [date(2025, 1, 13), date(2025, 1, 15)])
+        self.assertEqual(df["Real"].tolist(), [100.0 + h for h in range(24)] * 2)
+        # El día que faltó sigue pendiente para la próxima petición
+        self.assertEqual(historico.dias_pendientes(1, date(2025, 1, 13), date(2025, 1, 15)), [date(2025, 1, 14)])
+
+
+# -----------------------------
+# Lectura de zip de OMIE como flujo
+# -----------------------------
+class MiembrosZipTests(TestCase):
+    contenidos = {
+        "marginalpdbc_20250101.1": _marginalpdbc(date(2025, 1, 1)),
+        # Datos que contienen la firma del descriptor: no deben cortar el archivo
+        "marginalpdbc_20250102.1": b"PK\x07\x08" + bytes(range(256)) * 3 + _marginalpdbc(date(2025, 1, 2)),
+        "vacio.txt": b"",
+        "marginalpdbc_20250103.2": _marginalpdbc(date(2025, 1, 3), 96),
+    }
+
+    def setUp(self):
+        self.directorio = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directorio)
+
+    def _leer_archivo(self, datos: bytes) -> dict:
+        ruta = os.path.join(self.directorio, "marginalpdbc.zip")
+        with open(ruta, "wb") as f:
+            f.write(datos)
+        with open(ruta, "rb") as f:
+            return dict(archivos_omie.miembros_zip(f))
+
+    def test_metodos_con_y_sin_descriptor(self):
+        for metodo in (zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED):
+            for flujo in (False, True):
+                with self.subTest(metodo=metodo, flujo=flujo):
+                    datos = _zip(self.contenidos, metodo, flujo)
+                    # Con flujo, zipfile marca el descriptor (bit 3) en cada cabecera local
+                    self.assertEqual(bool(datos[6] & 0x08), flujo)
+                    self.assertEqual(self._leer_archivo(datos), self.contenidos)
+
+    def test_zip_cortado(self):
+        datos = _zip(self.contenidos, zipfile.ZIP_STORED, True)
+        with self.assertRaises(ValueError):
+            dict(archivos_omie.miembros_zip(io.BytesIO(datos[:200])))
+
+
+class _ServidorZip(BaseHTTPRequestHandler):
+    datos = b""
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header("Content-Type", "application/zip")
+        self.end_headers()
+        # Sin Content-Length ni seek: se lee como un flujo hasta que se cierra la conexión
+        for i in range(0, len(self.datos), 1000):
+            self.wfile.write(self.datos[i:i + 1000])
+
+    def log_message(self, *args):
+        pass
+
+
+@skipUnless(columnar.disponible(), "necesita pyarrow")
+class ImportarTests(TestCase):
+    def setUp(self):
+        directorio = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directorio)
+        ajustes = override_settings(PARQUET_DIR=os.path.join(directorio, "parquet"))
+        ajustes.enable()
+        self.addCleanup(ajustes.disable)
+
+    def test_importar_por_http(self):
+        contenidos = {
+            "marginalpdbc_20250101.1": _marginalpdbc(date(2025, 1, 1)),
+            "marginalpdbc_20250102.1": _marginalpdbc(date(2025, 1, 2)),
+            # Versión más reciente del mismo día: sustituye a la anterior
+            "marginalpdbc_20250102.2": _marginalpdbc(date(2025, 1, 2), 96),
+        }
+        _ServidorZip.datos = _zip(contenidos, zipfile.ZIP_STORED, True)
+        servidor = ThreadingHTTPServer(("127.0.0.1", 0), _ServidorZip)
+        threading.Thread(target=servidor.serve_forever, daemon=True).start()
+        self.addCleanup(servidor.server_close)
+        self.addCleanup(servidor.shutdown)
+
+        resumen = archivos_omie.importar(f"http://127.0.0.1:{servidor.server_port}/marginalpdbc_2025.zip")
+
+        self.assertEqual(resumen["dias"], 2)
+        self.assertEqual(resumen["errores"], [])
+        df = columnar.leer("precio", date(2025, 1, 1), date(2025, 1, 2))
+        self.assertEqual(len(df), 24 + 96)
+        self.assertEqual(columnar.dias_guardados("precio", date(2025, 1, 1), date(2025, 1, 3)),
+                         {date(2025, 1, 1), date(2025, 1, 2)})
+
+
+# -----------------------------
+# Refresco incremental del día en curso
+# -----------------------------
+class CambiosHoyTests(TestCase):
+    DIA = date(2025, 1, 15)
+    CABECERAS = ["Hora", "Real", "Prevista", "Programada"]
+
+    def setUp(self):
+        hoy = mock.patch.object(historico, "hoy_local", return_value=self.DIA)
+        hoy.start()
+        self.addCleanup(hoy.stop)
+        # Medidas hasta las 00:10; el resto de la hora solo trae previsiones
+        self.filas = [
+            [f"2025-01-15T00:{m:02d}", "100,5" if m <= 10 else "0", f"{200 + m},0", "300"]
+            for m in range(0, 30, 5)
+        ]
+        self.assertEqual(utils_scrap._guardar_tabla(1, self.DIA, self.CABECERAS, self.filas), 6)
+
+    def _ultimo(self):
+        return pd.Timestamp(historico.estado_dia(1, self.DIA).ultimo).tz_convert(historico.ZONA_PANDAS)
+
+    def _guardado(self, hora: str, columna: str) -> float:
+        df = historico.leer_rango(1, self.DIA, self.DIA)
+        return df.loc[pd.Timestamp(f"2025-01-15 {hora}", tz=historico.ZONA_PANDAS), columna]
+
+    def test_solo_intervalos_nuevos(self):
+        self.filas[3][1] = "110,0"
+        cambios = utils_scrap._cambios_hoy(1, self.DIA, self.CABECERAS, self.filas)
+        self.assertEqual(list(cambios.index), [pd.Timestamp("2025-01-15 00:15", tz=historico.ZONA_PANDAS)])
+
+        self.assertEqual(utils_scrap._guardar_tabla(1, self.DIA, self.CABECERAS, self.filas), 1)
+        self.assertEqual(self._ultimo(), pd.Timestamp("2025-01-15 00:15", tz=historico.ZONA_PANDAS))
+        self.assertEqual(self._guardado("00:15", "Real"), 110.0)
+        self.assertEqual(len(historico.leer_rango(1, self.DIA, self.DIA)), 6)
+
+    def test_prevision_revisada(self):
+        self.filas[4][2] = "250,0"
+        self.assertEqual(utils_scrap._guardar_tabla(1, self.DIA, self.CABECERAS, self.filas), 1)
+        self.assertEqual(self._guardado("00:20", "Prevista"), 250.0)
+        # Una previsión no es una medida: la última hora medida no se mueve
+        self.assertEqual(self._ultimo(), pd.Timestamp("2025-01-15 00:10", tz=historico.ZONA_PANDAS))
+
+    def test_sin_cambios(self):
+        with mock.patch.object(agregados, "actualizar") as actualizar:
+            self.assertEqual(utils_scrap._guardar_tabla(1, self.DIA, self.CABECERAS, self.filas), 0)
+        actualizar.assert_not_called()
+        self.assertEqual(self._ultimo(), pd.Timestamp("2025-01-15 00:10", tz=historico.ZONA_PANDAS))
+        self.assertEqual(self._guardado("00:20", "Prevista"), 220.0)
+
+
+# -----------------------------
+# Trabajos en segundo plano
+# -----------------------------
+@override_settings(SCRAP_TRABAJO_LATIDO=120, SCRAP_TRABAJO_ESPERA=3600, SCRAP_TRABAJO_VIGENCIA=600)
+class TrabajosTests(TestCase):
+    PARAMETROS = {"fecha_inicio": "2025-01-01", "fecha_fin": "2025-01-02"}
+
+    def _trabajo(self, estado: str, segundos: int) -> TrabajoScrap:
+        trabajo = TrabajoScrap.objects.create(tipo="demanda", parametros=self.PARAMETROS, estado=estado)
+        # auto_now solo se aplica en save(); update() deja fijar la antigüedad
+        TrabajoScrap.objects.filter(pk=trabajo.pk).update(actualizado=timezone.now() - timedelta(seconds=segundos))
+        return trabajo
+
+    def _encolar(self) -> tuple:
+        """
+        Encola sin mandar nada al pool: devuelve el trabajo y si se ha enviado uno nuevo.
+        """
+        with (
+            mock.patch.object(trabajos, "_obtener_executor") as executor,
+            mock.patch.object(trabajos, "dias_pendientes", return_value=2),
+        ):
+            trabajo = trabajos.encolar("demanda", [1], self.PARAMETROS)
+        return trabajo, executor.return_value.submit.called
+
+    def test_pendiente_en_cola_no_se_abandona_por_falta_de_latido(self):
+        esperando = self._trabajo(TrabajoScrap.PENDIENTE, 300)
+        parado = self._trabajo(TrabajoScrap.EN_CURSO, 300)
+
+        trabajo, encolado = self._encolar()
+        self.assertEqual(trabajo.pk, esperando.pk)
+        self.assertFalse(encolado)
+        esperando.refresh_from_db()
+        parado.refresh_from_db()
+        self.assertEqual(esperando.estado, TrabajoScrap.PENDIENTE)
+        self.assertEqual(parado.estado, TrabajoScrap.ERROR)
+
+    def test_pendiente_que_no_empieza_se_abandona(self):
+        viejo = self._trabajo(TrabajoScrap.PENDIENTE, 4000)
+        self.assertEqual(trabajos.abandonar_sin_latido(), 1)
+        viejo.refresh_from_db()
+        self.assertEqual(viejo.estado, TrabajoScrap.ERROR)
+        self.assertIn("no llegó a empezar", viejo.error)
+
+    def test_tras_un_error_se_encola_otro(self):
+        self._trabajo(TrabajoScrap.EN_CURSO, 300)
+        trabajos.abandonar_sin_latido()
+        self.assertFalse(trabajos.hecho_hace_poco("demanda", self.PARAMETROS))
+
+        trabajo, encolado = self._encolar()
+        self.assertTrue(encolado)
+        self.assertEqual(trabajo.estado, TrabajoScrap.PENDIENTE)
+
+    def test_terminado_hace_poco(self):
+        self._trabajo(TrabajoScrap.TERMINADO, 700)
+        self.assertFalse(trabajos.hecho_hace_poco("demanda", self.PARAMETROS))
+        self._trabajo(TrabajoScrap.TERMINADO, 60)
+        self.assertTrue(trabajos.hecho_hace_poco("demanda", self.PARAMETROS))
+
+
+# -----------------------------
+# Caché Parquet
+# -----------------------------
+@skipUnless(columnar.disponible(), "necesita pyarrow")
+class ColumnarTests(TestCase):
+    def setUp(self):
+        directorio = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directorio)
+        ajustes = override_settings(PARQUET_DIR=os.path.join(directorio, "parquet"))
+        ajustes.enable()
+        self.addCleanup(ajustes.disable)
+
+    def test_guardar_y_leer(self):
+        columnar.guardar("precio", pd.concat([
+            _serie("2025-01-01 00:00", 24, 60, "PrecioZonaEspañola", range(24)),
+            _serie("2025-01-02 00:00", 24, 60, "PrecioZonaEspañola", range(24)),
+        ]))
+        # Otra versión del segundo día: sustituye a la anterior sin tocar el primero
+        columnar.guardar("precio", _serie("2025-01-02 00:00", 24, 60, "PrecioZonaEspañola", [100] * 24))
+
+        df = columnar.leer("precio", date(2025, 1, 1), date(2025, 1, 2))
+        self.assertEqual(df.index.name, historico.INDICE)
+        self.assertEqual(str(df.index.tz), historico.ZONA_PANDAS)
+        self.assertEqual(df["PrecioZonaEspañola"].tolist(), [float(h) for h in range(24)] + [100.0] * 24)
+        self.assertEqual(columnar.dias_guardados("precio", date(2025, 1, 1), date(2025, 1, 3)),
+                         {date(2025, 1, 1), date(2025, 1, 2)})
+        self.assertEqual(len(columnar.leer("precio", date(2025, 1, 2), date(2025, 1, 2))), 24)
+
+    DIAS = [date(2025, 1, 30), date(2025, 1, 31), date(2025, 2, 1)]
+
+    def _guardar_historico(self):
+        historico.guardar_dias(1, {dia: _serie(f"{dia} 00:00", 24, 60, "Real", range(24)) for dia in self.DIAS})
+
+    def test_iterar_rango_escribe_una_vez_por_mes(self):
+        dias = self.DIAS
+        self._guardar_historico()
+
+        with mock.patch.object(columnar, "guardar", wraps=columnar.guardar) as guardar:
+            bloques = list(utils_scrap.iterar_rango("2025-01-30", "2025-02-01", url_tipo=1))
+        self.assertEqual([len(b) for b in bloques], [24, 24, 24])
+        self.assertEqual(guardar.call_count, 2)
+        self.assertEqual(columnar.dias_guardados("demanda", dias[0], dias[-1]), set(dias))
+
+        # La segunda vez todo sale de la caché
+        with mock.patch.object(columnar, "guardar") as guardar:
+            self.assertEqual([len(b) for b in utils_scrap.iterar_rango("2025-01-30", "2025-02-01", url_tipo=1)], [24] * 3)
+        guardar.assert_not_called()
+
+    def test_comparativa_escribe_una_vez_por_mes(self):
+        self._guardar_historico()
+        with mock.patch.object(columnar, "guardar", wraps=columnar.guardar) as guardar:
+            bloques = list(views._bloques_comparativa("demanda", "demanda", "2025-01-30", "2025-02-01"))
+        self.assertEqual([len(b) for b in bloques], [24, 24, 24])
+        self.assertEqual(guardar.call_count, 2)
+        self.assertEqual(columnar.dias_guardados("demanda", self.DIAS[0], self.DIAS[-1]), set(self.DIAS))
+
+
+# -----------------------------
+# API JSON
+# -----------------------------
+class ApiTests(TestCase):
+    def test_parametros_no_validos(self):
+        base = "/api/comparativa/?fecha_inicio=2025-01-01&fecha_fin=2025-01-02"
+        for consulta in (
+            "&dato1=generacion-x&dato2=precio",
+            "&dato1=demanda",
+            "&dato1=demanda&dato2=precio&alineacion=otra",
+            "&dato1=demanda&dato2=precio&cursor=99999999999999",
+            "&dato1=demanda&dato2=precio&cursor=-99999999999999",
+        ):
+            with self.subTest(consulta=consulta):
+                respuesta = self.client.get(base + consulta)
+                self.assertEqual(respuesta.status_code, 400)
+                self.assertIn("error", respuesta.json())
+        self.assertEqual(self.client.get("/api/otra/?fecha_inicio=2025-01-01&fecha_fin=2025-01-02").status_code, 404)
@@ -0,0 +1,161 @@
+"""
+Cola de scrapings largos.
+Las vistas encolan un TrabajoScrap cuando faltan días en el histórico y devuelven
+la página de progreso al momento; el trabajo rellena el histórico en un pool de
+hilos del proceso y la página de resultado vuelve a la vista, que ya lo lee todo
+de la base de datos.
+
+Mientras se ejecuta, el trabajo renueva `actualizado` cada poco (latido). Si el
+proceso que lo tenía muere (reinicio, despliegue...), el trabajo deja de latir y,
+pasados SCRAP_TRABAJO_LATIDO segundos, se da por abandonado: se marca como error
+y la siguiente petición encola uno nuevo en lugar de esperar para siempre.
+Los pendientes no laten mientras esperan turno en el pool, así que solo se dan
+por abandonados pasados SCRAP_TRABAJO_ESPERA segundos sin empezar.
+"""
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+from django.conf import settings
+from django.db import close_old_connections
+from django.db.models import F
+from django.utils import timezone
+
+from . import historico
+from .models import TrabajoScrap
+from .utils_scrap import scrap_rango
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def _obtener_executor() -> ThreadPoolExecutor:
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=getattr(settings, "SCRAP_TRABAJOS", 2),
+                thread_name_prefix="trabajo-scrap",
+            )
+    return _executor
+
+
+def dias_pendientes(url_tipos: list, fecha_inicio: str, fecha_fin: str, solo_cerrados: bool = False) -> int:
+    """
+    Días que habría que scrapear (sumando todos los tipos) para servir el rango.
+    Con solo_cerrados no se cuentan hoy ni los días futuros, que nunca quedan completos.
+    """
+    start_date = datetime.strptime(fecha_inicio, "%Y-%m-%d").date()
+    end_date = datetime.strptime(fecha_fin, "%Y-%m-%d").date()
+    if solo_cerrados:
+        end_date = min(end_date, historico.hoy_local() - timedelta(days=1))
+    if end_date < start_date:
+        return 0
+    return sum(len(historico.dias_pendientes(t, start_date, end_date)) for t in url_tipos)
+
+
+def abandonar_sin_latido() -> int:
+    """
+    Marca como error los trabajos en curso que llevan más de SCRAP_TRABAJO_LATIDO
+    segundos sin latir y los pendientes que llevan más de SCRAP_TRABAJO_ESPERA
+    segundos sin empezar. Devuelve cuántos.
+    """
+    ahora = timezone.now()
+    sin_latido = TrabajoScrap.objects.filter(
+        estado=TrabajoScrap.EN_CURSO,
+        actualizado__lt=ahora - timedelta(seconds=getattr(settings, "SCRAP_TRABAJO_LATIDO", 120)),
+    ).update(estado=TrabajoScrap.ERROR, error="Trabajo abandonado: dejó de dar señales.", actualizado=ahora)
+    sin_empezar = TrabajoScrap.objects.filter(
+        estado=TrabajoScrap.PENDIENTE,
+        actualizado__lt=ahora - timedelta(seconds=getattr(settings, "SCRAP_TRABAJO_ESPERA", 3600)),
+    ).update(estado=TrabajoScrap.ERROR, error="Trabajo abandonado: no llegó a empezar.", actualizado=ahora)
+    return sin_latido + sin_empezar
+
+
+def hecho_hace_poco(tipo: str, parametros: dict) -> bool:
+    """
+    Si un trabajo igual ha terminado bien hace menos de SCRAP_TRABAJO_VIGENCIA segundos.
+    Los días que sigan pendientes se sirven como estén en lugar de volver a encolarlos;
+    tras un trabajo con error (o abandonado) se encola uno nuevo.
+    """
+    limite = timezone.now() - timedelta(seconds=getattr(settings, "SCRAP_TRABAJO_VIGENCIA", 600))
+    return TrabajoScrap.objects.filter(
+        tipo=tipo,
+        parametros=parametros,
+        estado=TrabajoScrap.TERMINADO,
+        actualizado__gte=limite,
+    ).exists()
+
+
+def encolar(tipo: str, url_tipos: list, parametros: dict) -> TrabajoScrap:
+    """
+    Crea el trabajo y lo manda al pool. Si ya hay uno igual sin terminar (y que
+    sigue latiendo) se reutiliza.
+    """
+    abandonar_sin_latido()
+    activo = TrabajoScrap.objects.filter(
+        tipo=tipo,
+        parametros=parametros,
+        estado__in=[TrabajoScrap.PENDIENTE, TrabajoScrap.EN_CURSO],
+    ).first()
+    if activo:
+        return activo
+
+    trabajo = TrabajoScrap.objects.create(
+        tipo=tipo,
+        parametros=parametros,
+        dias_total=dias_pendientes(url_tipos, parametros["fecha_inicio"], parametros["fecha_fin"]),
+    )
+    _obtener_executor().submit(_ejecutar, trabajo.pk, url_tipos)
+    return trabajo
+
+
+def _latir(trabajo_id, parar: threading.Event):
+    """
+    Renueva `actualizado` del trabajo hasta que se activa `parar`.
+    """
+    intervalo = max(1, getattr(settings, "SCRAP_TRABAJO_LATIDO", 120) / 4)
+    close_old_connections()
+    try:
+        while not parar.wait(intervalo):
+            TrabajoScrap.objects.filter(pk=trabajo_id, estado=TrabajoScrap.EN_CURSO).update(
+                actualizado=timezone.now()
+            )
+    finally:
+        close_old_connections()
+
+
+def _ejecutar(trabajo_id, url_tipos: list):
+    close_old_connections()
+    parar = threading.Event()
+    try:
+        trabajo = TrabajoScrap.objects.get(pk=trabajo_id)
+        # Si mientras esperaba en el pool se ha dado por abandonado, ya hay otro en su lugar
+        empezado = TrabajoScrap.objects.filter(pk=trabajo_id, estado=TrabajoScrap.PENDIENTE).update(
+            estado=TrabajoScrap.EN_CURSO, actualizado=timezone.now()
+        )
+        if not empezado:
+            return
+        threading.Thread(target=_latir, args=(trabajo_id, parar), daemon=True).start()
+
+        def progreso(dia):
+            TrabajoScrap.objects.filter(pk=trabajo_id).update(
+                dias_hechos=F("dias_hechos") + 1, actualizado=timezone.now()
+            )
+
+        for url_tipo in url_tipos:
+            scrap_rango(
+                trabajo.parametros["fecha_inicio"],
+                trabajo.parametros["fecha_fin"],
+                url_tipo=url_tipo,
+                progreso=progreso,
+            )
+
+        TrabajoScrap.objects.filter(pk=trabajo_id).update(estado=TrabajoScrap.TERMINADO, actualizado=timezone.now())
+    except Exception as e:
+        TrabajoScrap.objects.filter(pk=trabajo_id).update(
+            estado=TrabajoScrap.ERROR, error=str(e), actualizado=timezone.now()
+        )
+    finally:
+        parar.set()
+        close_old_connections()
@@ -1,169 +1,837 @@
+import numpy as np
 import pandas as pd
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
 from datetime import datetime, timedelta
-from playwright.sync_api import sync_playwright
 import requests
 import io
+import json
+import logging
+import math
+import os
+import threading
+import time
 
-def scrap_tabla(fecha: str, url_tipo: int = 1) -> pd.DataFrame:
+from playwright.sync_api import Error as PlaywrightError
+from playwright.sync_api import TimeoutError as PlaywrightTimeoutError
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from django.conf import settings
+from django.db import close_old_connections
+
+from . import agregados, columnar, historico, metricas, plazos
+from .navegador import obtener_pool
+
+logger = logging.getLogger(__name__)
+
+# Corte compartido por todas las descargas de REE del proceso
+interruptor_ree = plazos.Interruptor(
+    fallos_max=getattr(settings, "SCRAP_CORTE_FALLOS", 5),
+    segundos_abierto=getattr(settings, "SCRAP_CORTE_SEGUNDOS", 60),
+)
+
+TABLAS_REE = {
+    1: "tabla_evolucion",
+    2: "tabla_generacion",
+    4: "tabla_almacenamiento",
+}
+
+
+# Recursos que no hacen falta para leer los datos de la página
+_RECURSOS_BLOQUEADOS = {"image", "font", "stylesheet", "media"}
+
+# Columnas de cada tabla aprendidas de la respuesta de datos de REE:
+# table_id -> (cabeceras, cabecera -> clave del JSON)
+_COLUMNAS_RED = {}
+
+# Claves del JSON que todavía encajan con cada cabecera mientras se aprende
+_CANDIDATOS_RED = {}
+
+# Los hilos del pool de navegadores aprenden y consultan las columnas a la vez
+_red_lock = threading.Lock()
+
+
+def _bloquear_recursos(route):
+    if route.request.resource_type in _RECURSOS_BLOQUEADOS:
+        route.abort()
+    else:
+        route.continue_()
+
+
+def _registros_json(texto: str) -> list:
     """
-    Scraping de una tabla para una fecha concreta (yyyy-mm-dd).
-    url_tipo: 1 = demanda, 2 = generacion, 4 = almacenamiento
-    El nombre de las columnas se toma de la segunda fila de la tabla.
+    Lista más larga de registros {"ts": ..., clave: valor} dentro de una respuesta JSON o JSONP.
     """
-    url = f"https://demanda.ree.es/visiona/peninsula/nacionalau/tablas/{fecha}/{url_tipo}"
+    inicios = [i for i in (texto.find("{"), texto.find("[")) if i >= 0]
+    fin = max(texto.rfind("}"), texto.rfind("]"))
+    if not inicios or fin < min(inicios):
+        return []
+    try:
+        datos = json.loads(texto[min(inicios):fin + 1])
+    except ValueError:
+        return []
+
+    mejor = []
+    pendientes = [datos]
+    while pendientes:
+        nodo = pendientes.pop()
+        if isinstance(nodo, dict):
+            pendientes.extend(nodo.values())
+        elif isinstance(nodo, list):
+            if nodo and all(isinstance(x, dict) and "ts" in x for x in nodo):
+                if len(nodo) > len(mejor):
+                    mejor = nodo
+            else:
+                pendientes.extend(nodo)
+    return mejor
+
+
+def _registros_capturados(respuestas: list) -> list:
+    mejor = []
+    for respuesta in respuestas:
+        try:
+            registros = _registros_json(respuesta.text())
+        except PlaywrightError:
+            continue
+        if len(registros) > len(mejor):
+            mejor = registros
+    return mejor
 
-    with sync_playwright() as p:
-        browser = p.firefox.launch(headless=True)
-        page = browser.new_page()
-        page.goto(url, timeout=60000)
-        if url_tipo == 1:
-            table_id = "tabla_evolucion"
-        elif url_tipo == 2:
-            table_id = "tabla_generacion"
-        elif url_tipo == 4:
-            table_id = "tabla_almacenamiento"
 
-        else:
-            browser.close()
-            raise ValueError("url_tipo debe ser 1, 2 o 4")
+def _numero(valor):
+    try:
+        if isinstance(valor, str):
+            return float(valor.strip().replace(".", "").replace(",", ".") or 0)
+        return float(valor or 0)
+    except (TypeError, ValueError):
+        return None
 
-        page.wait_for_selector(f"table#{table_id}", timeout=60000)
+
+def _aprender_columnas(table_id: str, headers: list, rows_data: list, registros: list):
+    """
+    Empareja cada columna de la tabla con la clave del JSON que tiene los mismos valores.
+    Si alguna columna encaja con varias claves (p. ej. dos columnas siempre a 0)
+    se sigue acotando con los días siguientes hasta que no haya dudas.
+    """
+    if "Hora" not in headers:
+        return
+    i_hora = headers.index("Hora")
+    por_ts = {
+        ts: registro
+        for registro, ts in zip(registros, pd.to_datetime([r["ts"] for r in registros], errors="coerce"))
+        if not pd.isna(ts)
+    }
+    horas = pd.to_datetime([fila[i_hora] for fila in rows_data], errors="coerce")
+    parejas = [(fila, por_ts[ts]) for fila, ts in zip(rows_data, horas) if ts in por_ts]
+    if not parejas:
+        return
+
+    claves = [k for k in parejas[0][1] if k != "ts"]
+    encajan = {}
+    for i, header in enumerate(headers):
+        if i == i_hora:
+            continue
+        encajan[header] = {
+            clave for clave in claves
+            if all(
+                (a := _numero(fila[i])) is not None
+                and (b := _numero(registro.get(clave))) is not None
+                and abs(a - b) <= max(0.5, abs(b) * 0.001)
+                for fila, registro in parejas
+            )
+        }
+
+    columnas = [h for h in headers if h != "Hora"]
+    with _red_lock:
+        candidatos = _CANDIDATOS_RED.setdefault(table_id, {})
+        for header, claves_header in encajan.items():
+            candidatos[header] = candidatos[header] & claves_header if header in candidatos else claves_header
+        if all(len(candidatos.get(h, ())) == 1 for h in columnas):
+            _COLUMNAS_RED[table_id] = (list(headers), {h: next(iter(candidatos[h])) for h in columnas})
+
+
+def _columnas_aprendidas(table_id: str):
+    """
+    (cabeceras, cabecera -> clave del JSON) ya aprendidas de la tabla, o None.
+    """
+    with _red_lock:
+        return _COLUMNAS_RED.get(table_id)
+
+
+def _tabla_desde_red(table_id: str, registros: list):
+    aprendidas = _columnas_aprendidas(table_id)
+    if aprendidas is None:
+        return None
+    headers, claves = aprendidas
+    if any(clave not in registros[0] for clave in claves.values()):
+        return None
+    rows_data = [
+        [registro["ts"] if h == "Hora" else _numero(registro.get(claves[h])) or 0.0 for h in headers]
+        for registro in registros
+    ]
+    return headers, rows_data
+
+
+# Devuelve [cabeceras, filas] de la tabla en una sola llamada al navegador
+_JS_TABLA = """
+tabla => {
+    const filas = tabla.querySelectorAll("tr");
+    const cabeceras = filas.length > 1 ? Array.from(filas[1].querySelectorAll("th"), th => th.innerText) : [];
+    const cuerpo = Array.from(
+        tabla.querySelectorAll("tbody tr"),
+        tr => Array.from(tr.querySelectorAll("td"), td => td.innerText)
+    );
+    return [cabeceras, cuerpo];
+}
+"""
+
+
+def _extraer_tabla(page, url: str, table_id: str, timeout: float = 60, fin: float = None):
+    """
+    Abre la url en la página recibida del pool y devuelve (cabeceras, filas) de la tabla.
+
+    Todas las esperas del navegador comparten un mismo límite: `timeout` segundos
+    desde que empieza la tarea, sin pasar de `fin` (el plazo de la petición, en
+    time.monotonic()). Si el plazo ya se ha agotado en la cola no se abre la página.
+
+    Con SCRAP_MODO = "red" se capturan las respuestas de datos que rellenan la tabla
+    (las que contienen SCRAP_PATRON_DATOS) y, una vez aprendido qué clave del JSON
+    corresponde a cada columna, la tabla se construye desde ese JSON sin esperar
+    a que se pinte. Mientras tanto, o si el JSON no cuadra, se lee la tabla del DOM.
+    """
+    limite = plazos.limite_dia(timeout, fin)
+
+    def quedan_ms():
+        ms = int((limite - time.monotonic()) * 1000)
+        if ms <= 0:
+            raise plazos.PlazoAgotado(f"sin tiempo para {url}")
+        return ms
+
+    quedan_ms()
+    modo_red = getattr(settings, "SCRAP_MODO", "red") == "red"
+    patron = getattr(settings, "SCRAP_PATRON_DATOS", "WSvisiona")
+    respuestas = []
+    if modo_red:
+        page.route("**/*", _bloquear_recursos)
+        page.on("response", lambda r: respuestas.append(r) if patron in r.url else None)
+
+    with metricas.etapa("goto"):
+        page.goto(url, timeout=quedan_ms())
+
+    registros = []
+    if modo_red and _columnas_aprendidas(table_id) is not None:
+        if not respuestas:
+            try:
+                with metricas.etapa("espera_tabla"):
+                    respuesta = page.wait_for_response(lambda r: patron in r.url, timeout=quedan_ms())
+                if respuesta not in respuestas:
+                    respuestas.append(respuesta)
+            except PlaywrightTimeoutError:
+                pass
+        with metricas.etapa("extraccion"):
+            registros = _registros_capturados(respuestas)
+            tabla = _tabla_desde_red(table_id, registros) if registros else None
+        if tabla:
+            return tabla
+
+    with metricas.etapa("espera_tabla"):
+        page.wait_for_selector(f"table#{table_id}", timeout=quedan_ms())
+
+    with metricas.etapa("extraccion"):
+        headers, rows = page.eval_on_selector(f"table#{table_id}", _JS_TABLA)
 
         # Cabeceras: segunda fila de la tabla
-        headers_row = page.locator(f"table#{table_id} tr").nth(1)
-        headers = headers_row.locator("th").all_inner_texts()
         headers = [h.strip() for h in headers]
 
         # Filas del tbody
-        rows_data = []
-        rows = page.locator(f"table#{table_id} tbody tr")
-        for i in range(rows.count()):
-            cols = rows.nth(i).locator("td").all_inner_texts()
-            if cols:
-                cols_clean = [c.strip() if c.strip() != "" else "0" for c in cols]
-                rows_data.append(cols_clean)
+        rows_data = [[c.strip() or "0" for c in cols] for cols in rows if cols]
+
+    if modo_red and rows_data:
+        registros = registros or _registros_capturados(respuestas)
+        if registros:
+            _aprender_columnas(table_id, headers, rows_data, registros)
 
-        browser.close()
+    return headers, rows_data
 
-    if not rows_data:
-        return pd.DataFrame()
 
-    df = pd.DataFrame(rows_data, columns=headers)
+def enviar_tabla(fecha: str, url_tipo: int, fin: float = None) -> Future:
+    """
+    Encola la descarga de la tabla de un día en el pool de navegadores, con
+    SCRAP_TIMEOUT_DIA segundos como mucho y sin pasar de `fin` (ver _extraer_tabla).
+    El futuro devuelve (cabeceras, filas) sin procesar.
+    """
+    if url_tipo not in TABLAS_REE:
+        raise ValueError("url_tipo debe ser 1, 2 o 4")
+
+    url = f"https://demanda.ree.es/visiona/peninsula/nacionalau/tablas/{fecha}/{url_tipo}"
+    timeout = getattr(settings, "SCRAP_TIMEOUT_DIA", 60)
+    return obtener_pool().enviar(_extraer_tabla, url, TABLAS_REE[url_tipo], timeout, fin)
+
+
+def tabla_a_dataframe(headers: list, rows_data: list) -> pd.DataFrame:
+    """
+    DataFrame canónico (índice FechaHora con zona y columnas numéricas) de una tabla.
+    Sin columna Hora, o sin ninguna hora válida, la tabla se devuelve vacía.
+    """
+    if not rows_data or "Hora" not in headers:
+        return historico.marco_vacio()
 
+    with metricas.etapa("parseo"):
+        df = _a_numeros(pd.DataFrame(rows_data, columns=headers), excepto="Hora")
+
+        # La hora pasa a ser el índice; las filas sin hora válida se descartan
+        df = df.set_index(historico.instantes(df.pop("Hora")))
+        return df[df.index.notna()]
+
+
+def _a_numeros(df: pd.DataFrame, excepto: str = None) -> pd.DataFrame:
     # Intentar convertir todas las columnas numéricas
-    for col in df.columns[1:]:
-        df[col] = (
-            df[col].str.replace(".", "", regex=False)
-                  .str.replace(",", ".", regex=False)
-                  .replace("", "0")
-        )
+    for col in df.columns:
+        if col == excepto:
+            continue
+        # Las tablas que vienen del JSON de REE ya traen números
+        if df[col].dtype == object:
+            df[col] = (
+                df[col].str.replace(".", "", regex=False)
+                      .str.replace(",", ".", regex=False)
+                      .replace("", "0")
+            )
         df[col] = pd.to_numeric(df[col], errors="coerce").fillna(0)
+    return df
 
-    # Si hay columna Hora, convertir
-    if "Hora" in df.columns:
-        df["Hora"] = pd.to_datetime(df["Hora"], errors="coerce")
-        if not df["Hora"].isnull().all():
-            df["Fecha"] = df["Hora"].dt.strftime("%d/%m/%Y")
-            df["Hora"] = df["Hora"].dt.strftime("%H:%M")
-            df = df[["Fecha", "Hora"] + [c for c in df.columns if c not in ["Fecha", "Hora"]]]
 
-    return df
+def _cambios_hoy(url_tipo: int, day, headers: list, rows_data: list):
+    """
+    Filas de la tabla del día en curso que hay que escribir: las posteriores a la
+    última hora medida ya guardada y aquellas cuyas previsiones (Prevista,
+    Programada) han cambiado. Solo esas filas se convierten por completo.
+    Devuelve None si el día no tiene todavía nada guardado (hay que guardarlo entero).
+    """
+    estado = historico.estado_dia(url_tipo, day)
+    if estado is None or estado.ultimo is None or "Hora" not in headers or not rows_data:
+        return None
+
+    horas = historico.instantes([fila[headers.index("Hora")] for fila in rows_data])
+    cambian = np.asarray(horas > pd.Timestamp(estado.ultimo))
+
+    prevision = [c for c in historico.COLUMNAS_PREVISION if c in headers]
+    if prevision:
+        # Las horas futuras solo traen previsiones: son nuevas cuando ya tienen datos medidos
+        medidas = [i for i, h in enumerate(headers) if h != "Hora" and h not in prevision]
+        posteriores = np.flatnonzero(cambian)
+        valores = _a_numeros(pd.DataFrame([[rows_data[j][i] for i in medidas] for j in posteriores]))
+        cambian[posteriores] = (valores != 0).any(axis=1).to_numpy() if medidas else True
+
+        posiciones = [headers.index(c) for c in prevision]
+        recibidas = _a_numeros(pd.DataFrame([[fila[i] for i in posiciones] for fila in rows_data], columns=prevision))
+        guardadas = historico.leer_rango(url_tipo, day, day, columnas=prevision).reindex(index=horas, columns=prevision)
+        # Una hora sin previsión guardada también cuenta como cambiada (NaN != valor)
+        cambian |= (recibidas.to_numpy(dtype=float) != guardadas.to_numpy(dtype=float)).any(axis=1)
+
+    return tabla_a_dataframe(headers, [fila for fila, cambia in zip(rows_data, cambian) if cambia])
+
+
+def _guardar_tabla(url_tipo: int, day, headers: list, rows_data: list) -> int:
+    """
+    Guarda la tabla descargada de un día. El día en curso, si ya estaba guardado,
+    se refresca de forma incremental (ver _cambios_hoy); el resto se guarda entero.
+    """
+    if day == historico.hoy_local():
+        cambios = _cambios_hoy(url_tipo, day, headers, rows_data)
+        if cambios is not None:
+            return historico.guardar_cambios(url_tipo, day, cambios)
+    return historico.guardar_dia(url_tipo, day, tabla_a_dataframe(headers, rows_data))
+
+
+def scrap_tabla(fecha: str, url_tipo: int = 1) -> pd.DataFrame:
+    """
+    Scraping de una tabla para una fecha concreta (yyyy-mm-dd).
+    url_tipo: 1 = demanda, 2 = generacion, 4 = almacenamiento
+    El nombre de las columnas se toma de la segunda fila de la tabla.
+    El navegador no se lanza aquí: se reutiliza el del pool del proceso.
+    """
+    headers, rows_data = enviar_tabla(fecha, url_tipo).result()
+    return tabla_a_dataframe(headers, rows_data)
+
+
+def _dias_a_descargar(url_tipo: int, start_date, end_date) -> list:
+    """
+    Días del rango que hay que pedir a REE: los pendientes del histórico, salvo el
+    día en curso si se refrescó hace menos de SCRAP_REFRESCO_HOY segundos.
+    """
+    hoy = historico.hoy_local()
+    refresco = getattr(settings, "SCRAP_REFRESCO_HOY", 60)
+    return [
+        day for day in historico.dias_pendientes(url_tipo, start_date, end_date)
+        if day != hoy or not historico.recien_actualizado(url_tipo, day, refresco)
+    ]
+
+
+def guardar_copias(copias: dict):
+    """
+    Escribe en la caché Parquet los días apuntados por _leer_guardado ({tipo: [DataFrame]}),
+    una vez por tipo, y vacía `copias`.
+    """
+    for tipo, partes in copias.items():
+        if partes:
+            columnar.guardar(tipo, pd.concat(partes))
+    copias.clear()
+
+
+def _leer_guardado(url_tipo: int, start_date, end_date, columnas: list = None, copias: dict = None) -> pd.DataFrame:
+    """
+    Filas guardadas del rango. Los días que ya están en la caché Parquet se leen de
+    ahí (solo las columnas pedidas); el resto, del histórico, y los que ya están
+    completos se copian a la caché para la próxima vez. Con `copias` esos días no se
+    escriben aquí sino que se apuntan ({tipo: [DataFrame]}) para guardar_copias.
+    """
+    tipo = historico.NOMBRES_REE[url_tipo]
+    en_cache = columnar.dias_guardados(tipo, start_date, end_date)
+    partes = [columnar.leer(tipo, start_date, end_date, columnas)] if en_cache else []
+
+    resto = [
+        start_date + timedelta(days=i)
+        for i in range((end_date - start_date).days + 1)
+        if start_date + timedelta(days=i) not in en_cache
+    ]
+    if resto:
+        # Para copiar los días a la caché hacen falta todas las columnas
+        copiar = columnar.disponible()
+        df = historico.leer_rango(url_tipo, resto[0], resto[-1], columnas=None if copiar else columnas)
+        if not df.empty:
+            dia = historico.dias_locales(df.index)
+            en_resto = dia.isin(pd.DatetimeIndex(resto))
+            df, dia = df[en_resto], dia[en_resto]
+            if copiar:
+                # El día de hoy (o uno que no se pudo completar) no va a la caché
+                pendientes = historico.dias_pendientes(url_tipo, resto[0], resto[-1])
+                completos = df[~dia.isin(pd.DatetimeIndex(pendientes))]
+                if copias is None:
+                    columnar.guardar(tipo, completos)
+                else:
+                    copias.setdefault(tipo, []).append(completos)
+            if columnas is not None:
+                df = df[[c for c in columnas if c in df.columns]]
+            partes.append(df)
+
+    partes = [p for p in partes if not p.empty]
+    if not partes:
+        return historico.marco_vacio()
+    if len(partes) == 1:
+        return partes[0]
+    return pd.concat(partes).sort_index(kind="stable")
+
+
+def scrap_rango_parcial(fecha_inicio: str, fecha_fin: str, url_tipo: int = 1, concurrencia: int = None,
+                        progreso=None, columnas: list = None, presupuesto: float = None, copias: dict = None):
+    """
+    Devuelve (DataFrame, días que faltan) con todas las filas entre fecha_inicio y
+    fecha_fin (yyyy-mm-dd). Los días ya guardados se leen del histórico local; solo
+    se scrapean los que faltan y el día actual, que todavía no está cerrado (como
+    mucho cada SCRAP_REFRESCO_HOY segundos y guardando solo sus filas nuevas).
+
+    Se descargan hasta `concurrencia` días a la vez (por defecto SCRAP_CONCURRENCIA).
+    Un día que falla se reintenta hasta SCRAP_REINTENTOS veces con esperas crecientes
+    y, si no sale, se salta sin perder el resto. Con `presupuesto` (segundos) la
+    función vuelve como mucho en ese tiempo con lo que haya: cada día tiene
+    SCRAP_TIMEOUT_DIA segundos sin pasar del plazo total. Si REE falla seguido
+    se corta (ver plazos.Interruptor) y los días que quedan se dan por faltantes.
+
+    `progreso(dia)` se llama cada vez que termina un día, bien o mal.
+    El resultado es un DataFrame canónico (índice FechaHora con la zona peninsular);
+    con `columnas` solo se devuelven esas columnas. Con `copias` los días que hay que
+    copiar a la caché Parquet se apuntan en lugar de escribirse (ver guardar_copias).
+    """
+    start_date = datetime.strptime(fecha_inicio, "%Y-%m-%d").date()
+    end_date = datetime.strptime(fecha_fin, "%Y-%m-%d").date()
+    if concurrencia is None:
+        concurrencia = getattr(settings, "SCRAP_CONCURRENCIA", 1)
+    reintentos = getattr(settings, "SCRAP_REINTENTOS", 2)
+    plazo = plazos.Plazo(presupuesto)
+
+    pendientes = deque((day, 0) for day in _dias_a_descargar(url_tipo, start_date, end_date))
+    en_espera = []
+    en_curso = {}
+    errores = []
+    faltan = []
+
+    def terminar(day):
+        if progreso:
+            progreso(day)
+
+    while pendientes or en_curso or en_espera:
+        # Reintentos cuya espera ya ha pasado
+        ahora = time.monotonic()
+        pendientes.extend((day, intento) for listo, day, intento in en_espera if listo <= ahora)
+        en_espera = [e for e in en_espera if e[0] > ahora]
+
+        while pendientes and len(en_curso) < max(1, concurrencia):
+            day, intento = pendientes.popleft()
+            if plazo.agotado() or not interruptor_ree.permitir():
+                faltan.append(day)
+                terminar(day)
+                continue
+            en_curso[enviar_tabla(day.strftime("%Y-%m-%d"), url_tipo, fin=plazo.fin)] = (day, intento)
+
+        if plazo.agotado() or (not en_curso and not en_espera and not pendientes):
+            if plazo.agotado():
+                # Sin tiempo: lo que no ha empezado se cancela y lo que queda falta
+                for futuro in en_curso:
+                    futuro.cancel()
+                resto = [day for day, _ in en_curso.values()] + [day for _, day, _ in en_espera] + [day for day, _ in pendientes]
+                for day in resto:
+                    faltan.append(day)
+                    terminar(day)
+            break
+
+        espera = plazo.restante()
+        if en_espera:
+            espera = min(espera, max(0.0, min(e[0] for e in en_espera) - time.monotonic()))
+        if not en_curso:
+            time.sleep(espera)
+            continue
+        hechos, _ = wait(en_curso, timeout=None if espera == math.inf else espera, return_when=FIRST_COMPLETED)
+        for futuro in hechos:
+            day, intento = en_curso.pop(futuro)
+            try:
+                headers, rows_data = futuro.result()
+            except Exception as e:
+                if not isinstance(e, plazos.PlazoAgotado):
+                    interruptor_ree.fallo()
+                errores.append(e)
+                if intento < reintentos and not plazo.agotado():
+                    logger.info(
+                        "Reintento %s de %s (tipo %s): %s", intento + 1, day, url_tipo, e,
+                        extra={"fecha": day.isoformat(), "url_tipo": url_tipo, "intento": intento + 1},
+                    )
+                    en_espera.append((time.monotonic() + plazos.espera_reintento(intento), day, intento + 1))
+                    continue
+                logger.error(
+                    "No se pudo scrapear %s (tipo %s): %s", day, url_tipo, e,
+                    extra={"fecha": day.isoformat(), "url_tipo": url_tipo},
+                )
+                faltan.append(day)
+                terminar(day)
+                continue
+            interruptor_ree.exito()
+            try:
+                _guardar_tabla(url_tipo, day, headers, rows_data)
+            except Exception as e:
+                logger.exception(
+                    "No se pudo guardar %s (tipo %s): %s", day, url_tipo, e,
+                    extra={"fecha": day.isoformat(), "url_tipo": url_tipo},
+                )
+                errores.append(e)
+                faltan.append(day)
+            terminar(day)
+
+    with metricas.etapa("historico"):
+        df = _leer_guardado(url_tipo, start_date, end_date, columnas, copias)
+    if df.empty and errores:
+        # Sin ningún dato: mejor mostrar el error que un rango vacío
+        raise errores[0]
+    return df, sorted(faltan)
+
+
+def scrap_rango(fecha_inicio: str, fecha_fin: str, url_tipo: int = 1, concurrencia: int = None,
+                progreso=None, columnas: list = None, presupuesto: float = None) -> pd.DataFrame:
+    """
+    Como scrap_rango_parcial, pero solo devuelve el DataFrame.
+    """
+    return scrap_rango_parcial(fecha_inicio, fecha_fin, url_tipo, concurrencia, progreso, columnas, presupuesto)[0]
 
 
-def scrap_rango(fecha_inicio: str, fecha_fin: str, url_tipo: int = 1) -> pd.DataFrame:
+def iterar_rango(fecha_inicio: str, fecha_fin: str, url_tipo: int = 1):
     """
-    Scrapea todas las fechas entre fecha_inicio y fecha_fin (yyyy-mm-dd)
-    y filtra solo las filas dentro del rango exacto.
+    Como scrap_rango, pero devuelve un generador con un DataFrame por día,
+    para recorrer rangos largos sin tenerlos enteros en memoria.
+    Los días que faltan en el histórico se scrapean al llegar a ellos, y los que
+    se copian a la caché Parquet se escriben de una vez al acabar cada mes (cada
+    escritura reescribe el archivo del mes entero).
     """
     start_date = datetime.strptime(fecha_inicio, "%Y-%m-%d").date()
     end_date = datetime.strptime(fecha_fin, "%Y-%m-%d").date()
+    pendientes = set(_dias_a_descargar(url_tipo, start_date, end_date))
 
-    all_data = []
-    day = start_date
-    while day <= end_date:
-        df_day = scrap_tabla(day.strftime("%Y-%m-%d"), url_tipo=url_tipo)
-        if not df_day.empty:
-            # Filtrar por Fecha si existe
-            if "Fecha" in df_day.columns:
-                df_day["Fecha_dt"] = pd.to_datetime(df_day["Fecha"], format="%d/%m/%Y", errors="coerce").dt.date
-                mask = (df_day["Fecha_dt"] >= start_date) & (df_day["Fecha_dt"] <= end_date)
-                df_day = df_day.loc[mask].drop(columns=["Fecha_dt"])
-            if not df_day.empty:
-                all_data.append(df_day)
-        day += timedelta(days=1)
+    def dias():
+        copias = {}
+        day = start_date
+        try:
+            while day <= end_date:
+                if day.day == 1:
+                    guardar_copias(copias)
+                if day in pendientes:
+                    try:
+                        _guardar_tabla(url_tipo, day, *enviar_tabla(day.strftime("%Y-%m-%d"), url_tipo).result())
+                    except Exception as e:
+                        logger.error(
+                            "No se pudo scrapear %s (tipo %s): %s", day, url_tipo, e,
+                            extra={"fecha": day.isoformat(), "url_tipo": url_tipo},
+                        )
+                yield _leer_guardado(url_tipo, day, day, copias=copias)
+                day += timedelta(days=1)
+        finally:
+            # También si se deja de recorrer a medias (p. ej. se corta la descarga)
+            guardar_copias(copias)
 
-    if not all_data:
-        return pd.DataFrame()
+    return dias()
 
-    return pd.concat(all_data, ignore_index=True).reset_index(drop=True)
 
+OMIE_URL = "https://www.omie.es/es/file-download?parents=marginalpdbc&filename=marginalpdbc_{}.1"
 
-def scrap_rango_precio_omie(fecha_inicio, fecha_fin):
+_sesion_omie = None
+_sesion_omie_lock = threading.Lock()
+
+
+def obtener_sesion_omie() -> requests.Session:
     """
-    Descarga los archivos de OMIE para un rango de fechas y devuelve un DataFrame
-    con columnas: Fecha (dd/mm/aaaa), Hora (HH:MM), PrecioZonaEspañola (float).
+    Sesión HTTP compartida para OMIE: mantiene las conexiones abiertas (keep-alive)
+    entre descargas y reintenta los errores transitorios del servidor.
     """
-    df_total = pd.DataFrame()
-    fechas = pd.date_range(fecha_inicio, fecha_fin)
+    global _sesion_omie
+    with _sesion_omie_lock:
+        if _sesion_omie is None:
+            descargas = getattr(settings, "OMIE_DESCARGAS", 8)
+            adapter = HTTPAdapter(
+                pool_connections=1,
+                pool_maxsize=descargas,
+                max_retries=Retry(total=2, backoff_factor=0.5, status_forcelist=[502, 503, 504]),
+            )
+            _sesion_omie = requests.Session()
+            _sesion_omie.mount("https://", adapter)
+            _sesion_omie.mount("http://", adapter)
+    return _sesion_omie
+
+
+_COLUMNAS_OMIE = ["Año", "Mes", "Día", "Periodo", "PrecioZonaPortuguesa", "PrecioZonaEspañola"]
+
+# Duración de cada periodo según cuántos tiene el día: hasta 25 son horas
+# (23 y 25 en los días de cambio de hora) y a partir de ahí cuartos de hora (92, 96 o 100)
+_PERIODO_HORA_NS = 3600 * 10**9
+_PERIODO_CUARTO_NS = 900 * 10**9
+
+
+def parsear_marginalpdbc(texto: str) -> pd.DataFrame:
+    """
+    DataFrame canónico (columna PrecioZonaEspañola) del texto de un archivo marginalpdbc.
+    Los instantes se calculan sin pasar por cadenas: el inicio del día en UTC más
+    (Periodo - 1) periodos, con la duración del periodo deducida del número de
+    periodos del día. Así los días de cambio de hora y los de cuartos de hora salen bien.
+    """
+    lineas = texto.splitlines()
+    if lineas and lineas[0].startswith("MARGINALPDBC;"):
+        lineas = lineas[1:]
+    if not lineas:
+        return historico.marco_vacio(["PrecioZonaEspañola"])
 
-    for fecha in fechas:
-        fecha_str = fecha.strftime("%Y%m%d")
-        url = f"https://www.omie.es/es/file-download?parents=marginalpdbc&filename=marginalpdbc_{fecha_str}.1"
-        print(f"\n[DEBUG] Intentando descargar URL: {url}")
+    df = pd.read_csv(io.StringIO("\n".join(lineas)), sep=";", header=None)
 
-        try:
-            resp = requests.get(url)
-            print(f"[DEBUG] Estado HTTP: {resp.status_code} para fecha {fecha_str}")
-            resp.raise_for_status()
+    # Eliminar columnas completamente vacías y comprobar que hay al menos 6
+    df = df.dropna(axis=1, how="all")
+    if df.shape[1] < 6:
+        raise ValueError("el archivo tiene menos de 6 columnas")
+    df = df.iloc[:, :6]
+    df.columns = _COLUMNAS_OMIE
 
-            contenido = resp.text.splitlines()
-            if contenido and contenido[0].startswith("MARGINALPDBC;"):
-                contenido = contenido[1:]
-                print(f"[DEBUG] Primera línea 'MARGINALPDBC;' eliminada")
+    # La última línea ("*") y cualquier otra sin fecha o periodo se descartan
+    df = df.apply(pd.to_numeric, errors="coerce").dropna(subset=["Año", "Mes", "Día", "Periodo"])
+    if df.empty:
+        return historico.marco_vacio(["PrecioZonaEspañola"])
 
-            if not contenido:
-                print(f"[DEBUG] No hay datos para la fecha {fecha_str}")
-                continue
+    # Si PrecioZonaEspañola está vacío, usar PrecioZonaPortuguesa
+    precio = df["PrecioZonaEspañola"].fillna(df["PrecioZonaPortuguesa"]).astype("float64")
 
-            df = pd.read_csv(io.StringIO("\n".join(contenido)), sep=';', header=None)
+    # Medianoche peninsular de cada día (siempre existe y es única) en nanosegundos UTC
+    dias = pd.to_datetime(df[["Año", "Mes", "Día"]].astype(int).set_axis(["year", "month", "day"], axis=1))
+    inicio = historico.localizar(dias).asi8
+    periodo = df["Periodo"].to_numpy(dtype=np.int64)
+    periodos_dia = df.groupby(dias.to_numpy())["Periodo"].transform("max").to_numpy()
+    paso = np.where(periodos_dia > 25, _PERIODO_CUARTO_NS, _PERIODO_HORA_NS)
 
-            # Eliminar columnas completamente vacías
-            df = df.dropna(axis=1, how='all')
+    return pd.DataFrame(
+        {"PrecioZonaEspañola": precio.to_numpy()},
+        index=historico.indice(inicio + (periodo - 1) * paso),
+    )
 
-            # Comprobar que hay al menos 6 columnas
-            if df.shape[1] < 6:
-                print(f"[ERROR] CSV de {fecha_str} tiene menos de 6 columnas, se salta")
-                continue
 
-            # Asignar nombres correctos
-            df.columns = ["Año", "Mes", "Día", "Periodo", "PrecioZonaPortuguesa", "PrecioZonaEspañola"]
+def _ruta_archivo_omie(fecha_str: str) -> str:
+    directorio = getattr(settings, "OMIE_ARCHIVOS_DIR", settings.CACHE_DIR / "omie")
+    return os.path.join(directorio, f"marginalpdbc_{fecha_str}.1")
+
+
+def escribir_atomico(ruta: str, datos: bytes):
+    """
+    Escribe el archivo entero o nada: primero a un temporal y luego se renombra.
+    """
+    temporal = f"{ruta}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(temporal, "wb") as f:
+        f.write(datos)
+    os.replace(temporal, ruta)
+
+
+def archivo_omie(fecha) -> str:
+    """
+    Texto del archivo marginalpdbc de un día, con una copia en disco de cada archivo
+    descargado y sus validadores (ETag y Last-Modified).
+
+    Los días de hace más de OMIE_REVALIDAR_DIAS se sirven del disco sin tocar la red:
+    OMIE ya no los cambia. Los recientes se piden con una petición condicional y, si
+    no han cambiado (304), también se leen del disco.
+    """
+    fecha_str = fecha.strftime("%Y%m%d")
+    ruta = _ruta_archivo_omie(fecha_str)
+    validadores = {}
+    if os.path.exists(ruta) and os.path.exists(ruta + ".json"):
+        with open(ruta + ".json", encoding="utf-8") as f:
+            validadores = json.load(f)
+        antiguedad = (historico.hoy_local() - fecha.date()).days
+        if antiguedad > getattr(settings, "OMIE_REVALIDAR_DIAS", 2):
+            with open(ruta, "rb") as f:
+                return f.read().decode(validadores.get("encoding") or "latin-1")
+
+    url = OMIE_URL.format(fecha_str)
+    logger.debug("Descargando %s", url, extra={"fecha": fecha.date().isoformat()})
+    cabeceras = {}
+    if validadores.get("etag"):
+        cabeceras["If-None-Match"] = validadores["etag"]
+    if validadores.get("last_modified"):
+        cabeceras["If-Modified-Since"] = validadores["last_modified"]
+
+    with metricas.etapa("omie"):
+        resp = obtener_sesion_omie().get(url, headers=cabeceras, timeout=getattr(settings, "OMIE_TIMEOUT", (5, 30)))
+    logger.debug(
+        "Estado HTTP %s para %s", resp.status_code, fecha_str,
+        extra={"fecha": fecha.date().isoformat(), "estado": resp.status_code},
+    )
+    if resp.status_code == 304:
+        with open(ruta, "rb") as f:
+            return f.read().decode(validadores.get("encoding") or "latin-1")
+    resp.raise_for_status()
+
+    # El JSON se escribe después del archivo: sin él, la copia no se da por buena
+    os.makedirs(os.path.dirname(ruta), exist_ok=True)
+    escribir_atomico(ruta, resp.content)
+    escribir_atomico(ruta + ".json", json.dumps({
+        "etag": resp.headers.get("ETag"),
+        "last_modified": resp.headers.get("Last-Modified"),
+        "encoding": resp.encoding,
+    }).encode("utf-8"))
+    return resp.text
+
+
+def _descargar_precio_omie(fecha) -> pd.DataFrame:
+    """
+    Descarga (o lee de la copia en disco) y procesa el archivo marginalpdbc de un día.
+    Devuelve un DataFrame canónico con la columna PrecioZonaEspañola,
+    o None si no hay datos o la descarga falla.
+    """
+    fecha_str = fecha.strftime("%Y%m%d")
+    try:
+        texto = archivo_omie(fecha)
+        with metricas.etapa("parseo_omie"):
+            df = parsear_marginalpdbc(texto)
+        if df.empty:
+            logger.debug("No hay datos de OMIE para %s", fecha_str, extra={"fecha": fecha.date().isoformat()})
+            return None
+        return df
+
+    except Exception as e:
+        logger.error("No se pudo procesar el archivo de OMIE de %s: %s", fecha_str, e, extra={"fecha": fecha.date().isoformat()})
+        return None
+
+
+def guardar_precio(df: pd.DataFrame):
+    """
+    Guarda los precios descargados en la caché Parquet y actualiza sus resúmenes diarios.
+    """
+    columnar.guardar("precio", df)
+    agregados.actualizar("precio", df[["PrecioZonaEspañola"]])
+
 
-            # Si PrecioZonaEspañola está vacío, usar PrecioZonaPortuguesa
-            df["PrecioZonaEspañola"] = df["PrecioZonaEspañola"].fillna(df["PrecioZonaPortuguesa"])
+def _precios_cerrados(fechas) -> tuple:
+    """
+    (último día que se puede servir de la caché Parquet, días del rango que están en ella).
+    Los días de los últimos OMIE_REVALIDAR_DIAS nunca cuentan como guardados: se
+    vuelven a pedir a archivo_omie, que los revalida con OMIE.
+    """
+    if fechas.empty:
+        return None, set()
+    limite = historico.hoy_local() - timedelta(days=getattr(settings, "OMIE_REVALIDAR_DIAS", 2) + 1)
+    hasta = min(fechas[-1].date(), limite)
+    if hasta < fechas[0].date():
+        return None, set()
+    return hasta, columnar.dias_guardados("precio", fechas[0].date(), hasta)
 
-            # Convertir PrecioZonaEspañola a float
-            df["PrecioZonaEspañola"] = pd.to_numeric(df["PrecioZonaEspañola"], errors='coerce')
 
-            # Convertir Periodo a entero y crear columna Hora
-            df["Periodo"] = pd.to_numeric(df["Periodo"], errors='coerce')
-            df = df.dropna(subset=["Periodo"])
-            df["Hora"] = df["Periodo"].astype(int).apply(lambda x: f"{x-1:02d}:00")
+def _precio_omie_dia(fecha, en_cache: set) -> pd.DataFrame:
+    """
+    Precios de un día: de la caché Parquet si ya están, si no de OMIE (y se guardan).
+    Se ejecuta en los hilos de iterar_precio_omie: la conexión a la base de datos que
+    abre al guardar los resúmenes se cierra al terminar.
+    """
+    if fecha.date() in en_cache:
+        return columnar.leer("precio", fecha.date(), fecha.date())
+    df = _descargar_precio_omie(fecha)
+    if df is not None:
+        close_old_connections()
+        try:
+            guardar_precio(df)
+        finally:
+            close_old_connections()
+    return df
 
-            # Crear columna Fecha en formato dd/mm/aaaa
-            df["Fecha"] = df.apply(lambda row: f"{int(row['Día']):02d}/{int(row['Mes']):02d}/{int(row['Año'])}", axis=1)
 
-            # Seleccionar columnas finales
-            df = df[["Fecha", "Hora", "PrecioZonaEspañola"]]
+def iterar_precio_omie(fecha_inicio, fecha_fin):
+    """
+    Generador con el DataFrame de precios de cada día del rango, en orden
+    (None para los días sin datos). Los días que no están en la caché, y los
+    recientes que hay que revalidar, se descargan, hasta OMIE_DESCARGAS a la vez
+    sobre la misma sesión HTTP.
+    """
+    fechas = pd.date_range(fecha_inicio, fecha_fin)
+    descargas = max(1, min(getattr(settings, "OMIE_DESCARGAS", 8), len(fechas)))
 
-            df_total = pd.concat([df_total, df], ignore_index=True)
-            print(f"[DEBUG] Filas acumuladas hasta ahora: {len(df_total)}")
+    def dias():
+        if fechas.empty:
+            return
+        _, en_cache = _precios_cerrados(fechas)
+        # map conserva el orden de las fechas, así que el resultado ya sale ordenado
+        with ThreadPoolExecutor(max_workers=descargas) as executor:
+            yield from executor.map(_precio_omie_dia, fechas, [en_cache] * len(fechas))
 
-        except Exception as e:
-            print(f"[ERROR] No se pudo procesar {fecha_str}: {e}")
+    return dias()
 
-    # Ordenar por Fecha y Hora
-    if not df_total.empty:
-        df_total = df_total.sort_values(["Fecha", "Hora"]).reset_index(drop=True)
 
-    print(f"[DEBUG] DataFrame final listo con {len(df_total)} filas")
+def scrap_rango_precio_omie(fecha_inicio, fecha_fin):
+    """
+    Descarga los archivos de OMIE para un rango de fechas y devuelve un DataFrame
+    canónico (índice FechaHora con zona) con la columna PrecioZonaEspañola (float).
+    Los días que ya están en la caché Parquet no se vuelven a descargar, salvo los
+    más recientes, que se revalidan (ver _precios_cerrados).
+    """
+    fechas = pd.date_range(fecha_inicio, fecha_fin)
+    hasta, en_cache = _precios_cerrados(fechas)
+    partes = [columnar.leer("precio", fechas[0].date(), hasta, ["PrecioZonaEspañola"])] if en_cache else []
+
+    faltan = [f for f in fechas if f.date() not in en_cache]
+    if faltan:
+        descargas = max(1, min(getattr(settings, "OMIE_DESCARGAS", 8), len(faltan)))
+        with ThreadPoolExecutor(max_workers=descargas) as executor:
+            descargar = metricas.propagar(_descargar_precio_omie)
+            descargados = [df for df in executor.map(descargar, faltan) if df is not None]
+        if descargados:
+            nuevos = pd.concat(descargados)
+            guardar_precio(nuevos)
+            partes.append(nuevos)
+
+    partes = [p for p in partes if not p.empty]
+    if not partes:
+        df_total = historico.marco_vacio()
+    elif len(partes) == 1:
+        df_total = partes[0]
+    else:
+        df_total = pd.concat(partes).sort_index(kind="stable")
+
+    logger.debug("Precios de OMIE listos: %s filas", len(df_total), extra={"filas": len(df_total)})
     return df_total
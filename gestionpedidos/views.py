@@ -1,49 +1,204 @@
-from django.shortcuts import render
-from django.http import HttpResponse
-from .utils_scrap import scrap_rango, scrap_rango_precio_omie
+from django.conf import settings
+from django.shortcuts import get_object_or_404, redirect, render
+from django.http import Http404, HttpResponse, JsonResponse, StreamingHttpResponse
+from django.urls import reverse
+from django.utils.cache import patch_cache_control
+from urllib.parse import urlencode
+from . import agregados, alineacion, columnar, datasets, graficas, historico, metricas, trabajos
+from .models import TrabajoScrap
+from .utils_scrap import guardar_copias, iterar_precio_omie, iterar_rango, scrap_rango_parcial, scrap_rango_precio_omie
 import pandas as pd
-import matplotlib.pyplot as plt
-import io
-import base64
 import matplotlib.dates as mdates
-from datetime import datetime
-import numpy as np
+from datetime import datetime, timedelta
 
 
 def home(request):
     return render(request, "home.html")
 
+
+def _encolar_si_faltan_dias(tipo, url_tipos, parametros):
+    """
+    Si alguno de los días pedidos no está en el histórico, encola el scraping
+    y devuelve la redirección a la página de progreso. Si no, devuelve None.
+    """
+    trabajo = _trabajo_si_faltan_dias(tipo, url_tipos, parametros)
+    if trabajo is None:
+        return None
+    return redirect("trabajo_estado", pk=trabajo.pk)
+
+
+def _trabajo_si_faltan_dias(tipo, url_tipos, parametros):
+    """
+    TrabajoScrap encolado si faltan días ya cerrados en el histórico, o None.
+    El día de hoy se scrapea en la propia petición, y si un trabajo igual acaba
+    de terminar se sirve lo que haya aunque algún día no se haya podido descargar.
+    """
+    try:
+        faltan = trabajos.dias_pendientes(
+            url_tipos, parametros["fecha_inicio"], parametros["fecha_fin"], solo_cerrados=True
+        )
+    except (TypeError, ValueError):
+        # Fechas no válidas: la vista mostrará el error como siempre
+        return None
+    if not faltan or trabajos.hecho_hace_poco(tipo, parametros):
+        return None
+    return trabajos.encolar(tipo, url_tipos, parametros)
+
+
+def _respuesta_csv(filename, bloques, sep=","):
+    """
+    Descarga CSV que se escribe bloque a bloque (un DataFrame canónico por día) según
+    se leen o descargan los días, sin tener el rango entero en memoria.
+    Las columnas las fija el primer bloque con datos; la fecha y la hora van en texto.
+    """
+    def lineas():
+        cabecera = None
+        for df in bloques:
+            if df is None or df.empty:
+                continue
+            df = historico.con_fecha_hora(df)
+            if cabecera is None:
+                cabecera = df.columns.tolist()
+                yield df.to_csv(index=False, sep=sep)
+            else:
+                yield df.reindex(columns=cabecera).to_csv(index=False, header=False, sep=sep)
+
+    response = StreamingHttpResponse(lineas(), content_type="text/csv")
+    response["Content-Disposition"] = f'attachment; filename="{filename}"'
+    return response
+
+
+def _presupuesto():
+    """
+    Segundos que puede dedicar una petición a scrapear los días que falten (SCRAP_PRESUPUESTO).
+    """
+    return getattr(settings, "SCRAP_PRESUPUESTO", 90)
+
+
+def _texto_dias(dias):
+    return [dia.strftime("%d/%m/%Y") for dia in dias]
+
+
+def _quiere_descarga(datos):
+    return "download_csv" in datos or "download_parquet" in datos
+
+
+def _respuesta_descarga(datos, nombre, bloques, sep=","):
+    """
+    Descarga en CSV o en Parquet según el botón pulsado. `nombre` va sin extensión.
+    """
+    if "download_parquet" in datos:
+        return columnar.respuesta_parquet(f"{nombre}.parquet", bloques)
+    return _respuesta_csv(f"{nombre}.csv", bloques, sep=sep)
+
+
+# Columnas por tipo de energía
+RENOVABLES_COLS = ["Eólica", "Solar fotovoltaica", "Solar térmica", "Biocombustible", "Hidráulica"]
+NO_RENOVABLES_COLS = ["Nuclear", "Carbón", "Ciclo combinado", "Motor diésel",
+                      "Turbina de gas", "Turbina de vapor", "Cogeneración y residuos"]
+
+
+def _filtrar_generacion(df, tipo_generacion):
+    """
+    Columnas del tipo de energía elegido ("todos" deja todas).
+    """
+    if tipo_generacion == "renovables":
+        return df[[col for col in RENOVABLES_COLS if col in df.columns]]
+    if tipo_generacion == "no_renovables":
+        return df[[col for col in NO_RENOVABLES_COLS if col in df.columns]]
+    return df
+
+def _fuente_columna(columna):
+    """
+    De qué datos sale cada columna de la comparativa.
+    """
+    if columna == "PrecioZonaEspañola":
+        return "precio"
+    if columna == "Real":
+        return "demanda"
+    return "generacion"
+
+
+def _estadisticas(df, referencia, fuentes, formato):
+    """
+    Máximo y mínimo (con su hora) y media de cada columna de `fuentes` ({columna: fuente}).
+    Cada columna sale de los resúmenes diarios si cubren exactamente las filas del
+    dataset; las que no, se calculan sobre las filas. Los resúmenes solo se escriben al
+    guardar los datos de origen (o con manage.py recalcular_agregados), nunca desde una vista.
+    """
+    parametros = referencia.get("parametros", {}) if isinstance(referencia, dict) else {}
+    try:
+        start_date = datetime.strptime(parametros["fecha_inicio"], "%Y-%m-%d").date()
+        end_date = datetime.strptime(parametros["fecha_fin"], "%Y-%m-%d").date()
+    except (KeyError, TypeError, ValueError):
+        start_date = end_date = None
+
+    combinadas = agregados.estadisticas(fuentes, start_date, end_date, len(df)) if start_date else {}
+    stats = {}
+    for col in fuentes:
+        s = combinadas.get(col)
+        if s is None:
+            stats[col] = {
+                "max_val": round(df[col].max(), 2),
+                "hora_max": df[col].idxmax().strftime(formato),
+                "min_val": round(df[col].min(), 2),
+                "hora_min": df[col].idxmin().strftime(formato),
+                "mean_val": round(df[col].mean(), 2),
+            }
+        else:
+            stats[col] = {
+                "max_val": round(s["max"], 2),
+                "hora_max": s["hora_max"].astimezone(historico.ZONA_REE).strftime(formato),
+                "min_val": round(s["min"], 2),
+                "hora_min": s["hora_min"].astimezone(historico.ZONA_REE).strftime(formato),
+                "mean_val": round(s["mean"], 2),
+            }
+    return stats
+
+
+def _marco_grafica(df):
+    """
+    Copia ordenada con la columna FechaHora en hora peninsular sin zona, que es
+    como matplotlib y los límites del eje X (de 00:00 a 23:55) la esperan.
+    """
+    df = df.sort_index(kind="stable").rename_axis(historico.INDICE).reset_index()
+    df["FechaHora"] = df["FechaHora"].dt.tz_localize(None)
+    return df
+
+
 # -----------------------------
 # Vista para DEMANDA
 # -----------------------------
 def scrap_demanda_view(request):
     context = {"data": None, "error": None, "fecha_inicio": "", "fecha_fin": "", "total_rows": 0, "titulo": "Scraping de Demanda eléctrica"}
 
-    if request.method == "POST":
-        fecha_inicio = request.POST.get("fecha_inicio")
-        fecha_fin = request.POST.get("fecha_fin")
+    # GET con fechas: resultado de un trabajo en segundo plano
+    datos = request.POST if request.method == "POST" else request.GET
+    if "fecha_inicio" in datos:
+        fecha_inicio = datos.get("fecha_inicio")
+        fecha_fin = datos.get("fecha_fin")
         context["fecha_inicio"] = fecha_inicio
         context["fecha_fin"] = fecha_fin
 
+        pendiente = _encolar_si_faltan_dias("demanda", [1], {"fecha_inicio": fecha_inicio, "fecha_fin": fecha_fin})
+        if pendiente:
+            return pendiente
+
         try:
-            df = scrap_rango(fecha_inicio, fecha_fin, url_tipo=1)
+            if _quiere_descarga(datos):
+                return _respuesta_descarga(datos, f"Demanda-{fecha_inicio}_{fecha_fin}", iterar_rango(fecha_inicio, fecha_fin, url_tipo=1))
+
+            df, faltan = scrap_rango_parcial(fecha_inicio, fecha_fin, url_tipo=1, presupuesto=_presupuesto())
+            context["faltan"] = _texto_dias(faltan)
 
             if df.empty:
                 context["error"] = "No se encontraron datos en el rango seleccionado."
             else:
                 context["total_rows"] = len(df)
-                request.session["scrap_data"] = df.to_dict("records")
-                request.session["scrap_columns"] = df.columns.tolist()
+                request.session["scrap_data"] = datasets.guardar("demanda", df, fecha_inicio=fecha_inicio, fecha_fin=fecha_fin)
                 request.session["scrap_tipo"] = "demanda"
 
-                if "download_csv" in request.POST:
-                    response = HttpResponse(content_type="text/csv")
-                    filename = f"Demanda-{fecha_inicio}_{fecha_fin}.csv"
-                    response["Content-Disposition"] = f'attachment; filename="{filename}"'
-                    df.to_csv(path_or_buf=response, index=False)
-                    return response
-
-                context["data"] = df.head(10).to_html(
+                context["data"] = historico.con_fecha_hora(df.head(10)).to_html(
                     classes="table table-striped table-bordered text-start",
                     index=False,
                     justify="left"
@@ -69,53 +224,45 @@ def scrap_generacion_view(request):
         "tipo_generacion": "todos"  # valor por defecto
     }
 
-    # Columnas por tipo de energía
-    renovables_cols = ["Eólica", "Solar fotovoltaica", "Solar térmica", "Biocombustible", "Hidráulica"]
-    no_renovables_cols = ["Nuclear", "Carbón", "Ciclo combinado", "Motor diésel", 
-                          "Turbina de gas", "Turbina de vapor", "Cogeneración y residuos"]
-    
-    # Columnas que siempre deben mostrarse
-    columnas_fijas = ["Fecha", "Hora"]
-
-    if request.method == "POST":
-        fecha_inicio = request.POST.get("fecha_inicio")
-        fecha_fin = request.POST.get("fecha_fin")
-        tipo_generacion = request.POST.get("tipo_generacion", "todos")
+    # GET con fechas: resultado de un trabajo en segundo plano
+    datos = request.POST if request.method == "POST" else request.GET
+    if "fecha_inicio" in datos:
+        fecha_inicio = datos.get("fecha_inicio")
+        fecha_fin = datos.get("fecha_fin")
+        tipo_generacion = datos.get("tipo_generacion", "todos")
         context["fecha_inicio"] = fecha_inicio
         context["fecha_fin"] = fecha_fin
         context["tipo_generacion"] = tipo_generacion
 
+        pendiente = _encolar_si_faltan_dias(
+            "generacion", [2],
+            {"fecha_inicio": fecha_inicio, "fecha_fin": fecha_fin, "tipo_generacion": tipo_generacion},
+        )
+        if pendiente:
+            return pendiente
+
         try:
-            df = scrap_rango(fecha_inicio, fecha_fin, url_tipo=2)
+            if _quiere_descarga(datos):
+                bloques = (_filtrar_generacion(df_dia, tipo_generacion) for df_dia in iterar_rango(fecha_inicio, fecha_fin, url_tipo=2))
+                return _respuesta_descarga(datos, f"Generacion-{fecha_inicio}_{fecha_fin}", bloques)
+
+            df, faltan = scrap_rango_parcial(fecha_inicio, fecha_fin, url_tipo=2, presupuesto=_presupuesto())
+            context["faltan"] = _texto_dias(faltan)
 
             if df.empty:
                 context["error"] = "No se encontraron datos en el rango seleccionado."
             else:
-
-
                 # Selección de columnas según tipo de energía
-                if tipo_generacion == "renovables":
-                    cols_a_mostrar = columnas_fijas + [col for col in renovables_cols if col in df.columns]
-                elif tipo_generacion == "no_renovables":
-                    cols_a_mostrar = columnas_fijas + [col for col in no_renovables_cols if col in df.columns]
-                else:  # "todos"
-                    cols_a_mostrar = df.columns.tolist()
-
-                df_filtrado = df[cols_a_mostrar]
+                df_filtrado = _filtrar_generacion(df, tipo_generacion)
 
                 context["total_rows"] = len(df_filtrado)
-                request.session["scrap_data"] = df_filtrado.to_dict("records")
-                request.session["scrap_columns"] = df_filtrado.columns.tolist()
+                request.session["scrap_data"] = datasets.guardar(
+                    "generacion", df_filtrado,
+                    fecha_inicio=fecha_inicio, fecha_fin=fecha_fin, tipo_generacion=tipo_generacion,
+                )
                 request.session["scrap_tipo"] = "generacion"
 
-                if "download_csv" in request.POST:
-                    response = HttpResponse(content_type="text/csv")
-                    filename = f"Generacion-{fecha_inicio}_{fecha_fin}.csv"
-                    response["Content-Disposition"] = f'attachment; filename="{filename}"'
-                    df_filtrado.to_csv(path_or_buf=response, index=False)
-                    return response
-
-                context["data"] = df_filtrado.head(10).to_html(
+                context["data"] = historico.con_fecha_hora(df_filtrado.head(10)).to_html(
                     classes="table table-striped table-bordered text-start",
                     index=False,
                     justify="left"
@@ -132,33 +279,37 @@ def scrap_generacion_view(request):
 def scrap_almacenamiento_view(request):
     context = {"data": None, "error": None, "fecha_inicio": "", "fecha_fin": "", "total_rows": 0, "titulo": "Scraping de Almacenamiento eléctrico"}
 
-    if request.method == "POST":
-        fecha_inicio = request.POST.get("fecha_inicio")
-        fecha_fin = request.POST.get("fecha_fin")
+    # GET con fechas: resultado de un trabajo en segundo plano
+    datos = request.POST if request.method == "POST" else request.GET
+    if "fecha_inicio" in datos:
+        fecha_inicio = datos.get("fecha_inicio")
+        fecha_fin = datos.get("fecha_fin")
         context["fecha_inicio"] = fecha_inicio
         context["fecha_fin"] = fecha_fin
 
+        pendiente = _encolar_si_faltan_dias("almacenamiento", [4], {"fecha_inicio": fecha_inicio, "fecha_fin": fecha_fin})
+        if pendiente:
+            return pendiente
+
         try:
-            df = scrap_rango(fecha_inicio, fecha_fin, url_tipo=4)
+            # Descargar CSV o Parquet
+            if _quiere_descarga(datos):
+                return _respuesta_descarga(
+                    datos, f"Almacenamiento-{fecha_inicio}_{fecha_fin}", iterar_rango(fecha_inicio, fecha_fin, url_tipo=4)
+                )
+
+            df, faltan = scrap_rango_parcial(fecha_inicio, fecha_fin, url_tipo=4, presupuesto=_presupuesto())
+            context["faltan"] = _texto_dias(faltan)
 
             if df.empty:
                 context["error"] = "No se encontraron datos en el rango seleccionado."
             else:
                 context["total_rows"] = len(df)
-                request.session["scrap_data"] = df.to_dict("records")
-                request.session["scrap_columns"] = df.columns.tolist()
+                request.session["scrap_data"] = datasets.guardar("almacenamiento", df, fecha_inicio=fecha_inicio, fecha_fin=fecha_fin)
                 request.session["scrap_tipo"] = "almacenamiento"
 
-                # Descargar CSV
-                if "download_csv" in request.POST:
-                    response = HttpResponse(content_type="text/csv")
-                    filename = f"Almacenamiento-{fecha_inicio}_{fecha_fin}.csv"
-                    response["Content-Disposition"] = f'attachment; filename="{filename}"'
-                    df.to_csv(path_or_buf=response, index=False)
-                    return response
-
                 # Mostrar solo 10 primeras filas
-                context["data"] = df.head(10).to_html(
+                context["data"] = historico.con_fecha_hora(df.head(10)).to_html(
                     classes="table table-striped table-bordered text-start",
                     index=False,
                     justify="left"
@@ -179,101 +330,87 @@ def scrap_view_graph(request):
     Demanda → scrap_graph_demanda.html con estadísticas.
     Generación y almacenamiento → scrap_graph.html con gráfico.
     """
-    data = request.session.get("scrap_data")
-    columns = request.session.get("scrap_columns")
+    referencia = request.session.get("scrap_data")
     tipo = request.session.get("scrap_tipo", "demanda")
 
-    if not data or not columns:
-        return render(request, "scrap_page.html", {"error": "No hay datos para visualizar."})
-
-    df = pd.DataFrame(data, columns=columns)
+    contexto = graficas.leer_cache(referencia, tipo)
+    if contexto is not None:
+        plantilla = "scrap_graph_demanda.html" if tipo == "demanda" else "scrap_graph.html"
+        return render(request, plantilla, contexto)
 
-    if "Fecha" not in df.columns or "Hora" not in df.columns:
-        return render(request, "scrap_page.html", {"error": "No se pueden generar gráficos sin columnas Fecha y Hora."})
+    datos = datasets.cargar(referencia)
+    if datos is None or datos.empty:
+        return render(request, "scrap_page.html", {"error": "No hay datos para visualizar."})
 
-    # Construir columna FechaHora
-    df["FechaHora"] = pd.to_datetime(df["Fecha"] + " " + df["Hora"], format="%d/%m/%Y %H:%M")
-    df = df.sort_values("FechaHora")
+    df = _marco_grafica(datos)
 
     # --- DEMANDA ---
     if tipo == "demanda":
-        fig, ax = plt.subplots(figsize=(12, 5))
-        if "Real" in df.columns:
-            ax.bar(df["FechaHora"], df["Real"], color="skyblue", label="Real")
-        if "Prevista" in df.columns:
-            ax.plot(df["FechaHora"], df["Prevista"], color="green", marker="o", label="Prevista")
-        if "Programada" in df.columns:
-            ax.plot(df["FechaHora"], df["Programada"], color="red", marker="o", label="Programada")
-
-        # Configuración eje X
-        start = df["FechaHora"].iloc[0].replace(hour=0, minute=0)
-        end = df["FechaHora"].iloc[-1].replace(hour=23, minute=55)
-        rango_dias = (end.date() - start.date()).days + 1
-        freq = "3H" if rango_dias <= 3 else "12H"
-        ax.set_xlim(start, end)
-        ax.set_xticks(pd.date_range(start=start, end=end, freq=freq))
-        ax.xaxis.set_major_formatter(mdates.DateFormatter("%d-%m-%Y %H:%M"))
-
-        ax.set_xlabel("Tiempo")
-        ax.set_ylabel("Potencia (MW)")
-        ax.legend()
-        fig.autofmt_xdate(rotation=45)
+        with metricas.etapa("figura"):
+            fig, ax = graficas.nueva_figura()
+            # Series reducidas a lo que cabe en el ancho de la figura
+            if "Real" in df.columns:
+                barras = graficas.reducir_medias(df, ["Real"])
+                ax.bar(barras["FechaHora"], barras["Real"], width=graficas.ancho_barras(barras["FechaHora"]),
+                       color="skyblue", label="Real")
+            if "Prevista" in df.columns:
+                ax.plot(*graficas.reducir_min_max(df["FechaHora"], df["Prevista"]), color="green", marker="o", label="Prevista")
+            if "Programada" in df.columns:
+                ax.plot(*graficas.reducir_min_max(df["FechaHora"], df["Programada"]), color="red", marker="o", label="Programada")
+
+            # Configuración eje X
+            start = df["FechaHora"].iloc[0].replace(hour=0, minute=0)
+            end = df["FechaHora"].iloc[-1].replace(hour=23, minute=55)
+            rango_dias = (end.date() - start.date()).days + 1
+            freq = "3H" if rango_dias <= 3 else "12H"
+            ax.set_xlim(start, end)
+            ax.set_xticks(pd.date_range(start=start, end=end, freq=freq))
+            ax.xaxis.set_major_formatter(mdates.DateFormatter("%d-%m-%Y %H:%M"))
+
+            ax.set_xlabel("Tiempo")
+            ax.set_ylabel("Potencia (MW)")
+            ax.legend()
+            fig.autofmt_xdate(rotation=45)
 
         # Guardar gráfico
-        buf = io.BytesIO()
-        plt.tight_layout()
-        plt.savefig(buf, format="png")
-        buf.seek(0)
-        graph_base64 = base64.b64encode(buf.getvalue()).decode("utf-8")
-        buf.close()
-        plt.close(fig)
+        graph_base64 = graficas.png_base64(fig)
 
         # Calcular estadísticas
         stats = {}
         if "Real" in df.columns:
-            max_val = df["Real"].max()
-            min_val = df["Real"].min()
-            mean_val = df["Real"].mean()
-
-            stats = {
-                "max_val": round(max_val, 2),
-                "hora_max": df.loc[df["Real"].idxmax(), "FechaHora"].strftime("%d-%m-%Y %H:%M"),
-                "min_val": round(min_val, 2),
-                "hora_min": df.loc[df["Real"].idxmin(), "FechaHora"].strftime("%d-%m-%Y %H:%M"),
-                "mean_val": round(mean_val, 2),
-            }
+            stats = _estadisticas(datos, referencia, {"Real": "demanda"}, "%d-%m-%Y %H:%M")["Real"]
 
-        return render(request, "scrap_graph_demanda.html", {"graph": graph_base64, "stats": stats})
+        contexto = {"graph": graph_base64, "stats": stats}
+        graficas.guardar_cache(referencia, tipo, contexto)
+        return render(request, "scrap_graph_demanda.html", contexto)
 
     # --- GENERACIÓN ---
     elif tipo == "generacion":
         # Usar directamente las columnas seleccionadas por el usuario
-        # excluyendo 'Fecha', 'Hora' y 'FechaHora' si ya existen
-        columnas_a_graficar = [col for col in df.columns if col not in ["Fecha", "Hora", "FechaHora"]]
+        columnas_a_graficar = list(datos.columns)
 
         # Asegurarse de que las columnas existan en el DataFrame
         for col in columnas_a_graficar:
             if col not in df.columns:
                 df[col] = 0
 
-        fig, ax = plt.subplots(figsize=(12, 5))
-        bottom = pd.Series([0] * len(df))
-        for col in columnas_a_graficar:
-            ax.bar(df["FechaHora"], df[col], bottom=bottom, label=col)
-            bottom += df[col]
+        with metricas.etapa("figura"):
+            fig, ax = graficas.nueva_figura()
+            barras = graficas.reducir_medias(df, columnas_a_graficar)
+            leyenda = graficas.apilar(ax, barras["FechaHora"], barras, columnas_a_graficar)
 
-        start = df["FechaHora"].iloc[0].replace(hour=0, minute=0)
-        end = df["FechaHora"].iloc[-1].replace(hour=23, minute=55)
-        rango_dias = (end.date() - start.date()).days + 1
-        freq = "3H" if rango_dias <= 3 else "12H"
-        ax.set_xlim(start, end)
-        ax.set_xticks(pd.date_range(start=start, end=end, freq=freq))
-        ax.xaxis.set_major_formatter(mdates.DateFormatter("%d-%m-%Y %H:%M"))
+            start = df["FechaHora"].iloc[0].replace(hour=0, minute=0)
+            end = df["FechaHora"].iloc[-1].replace(hour=23, minute=55)
+            rango_dias = (end.date() - start.date()).days + 1
+            freq = "3H" if rango_dias <= 3 else "12H"
+            ax.set_xlim(start, end)
+            ax.set_xticks(pd.date_range(start=start, end=end, freq=freq))
+            ax.xaxis.set_major_formatter(mdates.DateFormatter("%d-%m-%Y %H:%M"))
 
-        ax.set_xlabel("Tiempo")
-        ax.set_ylabel("Potencia (MW)")
-        ax.legend(loc="upper left", bbox_to_anchor=(1, 1))
-        fig.autofmt_xdate(rotation=45)
+            ax.set_xlabel("Tiempo")
+            ax.set_ylabel("Potencia (MW)")
+            ax.legend(handles=leyenda, loc="upper left", bbox_to_anchor=(1, 1))
+            fig.autofmt_xdate(rotation=45)
 
 
     # --- ALMACENAMIENTO ---
@@ -283,33 +420,32 @@ def scrap_view_graph(request):
             if col not in df.columns:
                 df[col] = 0
 
-        fig, ax = plt.subplots(figsize=(12, 5))
-        for col in cols:
-            ax.bar(df["FechaHora"], df[col], label=col, alpha=0.7)
-
-        start = df["FechaHora"].iloc[0].replace(hour=0, minute=0)
-        end = df["FechaHora"].iloc[-1].replace(hour=23, minute=55)
-        rango_dias = (end.date() - start.date()).days + 1
-        freq = "3H" if rango_dias <= 3 else "12H"
-        ax.set_xlim(start, end)
-        ax.set_xticks(pd.date_range(start=start, end=end, freq=freq))
-        ax.xaxis.set_major_formatter(mdates.DateFormatter("%d-%m-%Y %H:%M"))
-
-        ax.set_xlabel("Tiempo")
-        ax.set_ylabel("Potencia (MW)")
-        ax.legend(loc="upper left", bbox_to_anchor=(1, 1))
-        fig.autofmt_xdate(rotation=45)
+        with metricas.etapa("figura"):
+            fig, ax = graficas.nueva_figura()
+            barras = graficas.reducir_medias(df, cols)
+            ancho = graficas.ancho_barras(barras["FechaHora"])
+            for col in cols:
+                ax.bar(barras["FechaHora"], barras[col], width=ancho, label=col, alpha=0.7)
+
+            start = df["FechaHora"].iloc[0].replace(hour=0, minute=0)
+            end = df["FechaHora"].iloc[-1].replace(hour=23, minute=55)
+            rango_dias = (end.date() - start.date()).days + 1
+            freq = "3H" if rango_dias <= 3 else "12H"
+            ax.set_xlim(start, end)
+            ax.set_xticks(pd.date_range(start=start, end=end, freq=freq))
+            ax.xaxis.set_major_formatter(mdates.DateFormatter("%d-%m-%Y %H:%M"))
+
+            ax.set_xlabel("Tiempo")
+            ax.set_ylabel("Potencia (MW)")
+            ax.legend(loc="upper left", bbox_to_anchor=(1, 1))
+            fig.autofmt_xdate(rotation=45)
 
     # --- Generar gráfico en memoria y renderizar ---
-    buf = io.BytesIO()
-    plt.tight_layout()
-    plt.savefig(buf, format="png")
-    buf.seek(0)
-    graph_base64 = base64.b64encode(buf.getvalue()).decode("utf-8")
-    buf.close()
-    plt.close(fig)
+    graph_base64 = graficas.png_base64(fig)
 
-    return render(request, "scrap_graph.html", {"graph": graph_base64})
+    contexto = {"graph": graph_base64}
+    graficas.guardar_cache(referencia, tipo, contexto)
+    return render(request, "scrap_graph.html", contexto)
 
 
 # -----------------------------
@@ -346,6 +482,12 @@ def scrap_precio_view(request):
             return render(request, "scrap_page_precio.html", context)
 
         try:
+            # Descargar CSV o Parquet
+            if _quiere_descarga(request.POST):
+                return _respuesta_descarga(
+                    request.POST, f"Precios_{fecha_inicio}_{fecha_fin}", iterar_precio_omie(fecha_inicio, fecha_fin), sep=";"
+                )
+
             df = scrap_rango_precio_omie(fecha_inicio, fecha_fin)
 
             if df.empty:
@@ -353,19 +495,13 @@ def scrap_precio_view(request):
             else:
                 context["total_rows"] = len(df)
 
-                # Guardar solo columnas necesarias en sesión (sin Timestamp)
-                request.session["scrap_data_precio"] = df[["Fecha", "Hora", "PrecioZonaEspañola"]].to_dict("records")
+                # En la sesión solo va la referencia al dataset guardado en la caché
+                request.session["scrap_data_precio"] = datasets.guardar(
+                    "precio", df[["PrecioZonaEspañola"]], fecha_inicio=fecha_inicio, fecha_fin=fecha_fin
+                )
 
                 # Mostrar tabla en la página
-                context["data"] = df[["Fecha", "Hora", "PrecioZonaEspañola"]].to_dict("records")
-
-                # Descargar CSV
-                if "download_csv" in request.POST:
-                    response = HttpResponse(content_type="text/csv")
-                    filename = f"Precios_{fecha_inicio}_{fecha_fin}.csv"
-                    response["Content-Disposition"] = f'attachment; filename="{filename}"'
-                    df.to_csv(path_or_buf=response, index=False, sep=';')
-                    return response
+                context["data"] = historico.con_fecha_hora(df[["PrecioZonaEspañola"]]).to_dict("records")
 
         except Exception as e:
             context["error"] = f"Error en el scraping de precios: {e}"
@@ -377,58 +513,152 @@ def scrap_precio_view(request):
 # Vista para mostrar gráfico
 # -----------------------------
 def scrap_graph_precio_view(request):
-    data = request.session.get("scrap_data_precio")
+    referencia = request.session.get("scrap_data_precio")
+
+    contexto = graficas.leer_cache(referencia, "precio")
+    if contexto is not None:
+        return render(request, "scrap_graph_precio.html", contexto)
 
-    if not data:
+    datos = datasets.cargar(referencia)
+    if datos is None or datos.empty:
         return render(request, "scrap_page_precio.html", {"error": "No hay datos para visualizar."})
 
-    df = pd.DataFrame(data)
-    df["FechaHora"] = pd.to_datetime(df["Fecha"] + " " + df["Hora"], format="%d/%m/%Y %H:%M")
-    df = df.sort_values("FechaHora")
+    df = _marco_grafica(datos)
 
     # Estadísticas
-    max_val = df["PrecioZonaEspañola"].max()
-    min_val = df["PrecioZonaEspañola"].min()
-    mean_val = df["PrecioZonaEspañola"].mean()
-    stats = {
-        "max_val": round(max_val, 2),
-        "hora_max": df.loc[df["PrecioZonaEspañola"].idxmax(), "FechaHora"].strftime("%d/%m/%Y %H:%M"),
-        "min_val": round(min_val, 2),
-        "hora_min": df.loc[df["PrecioZonaEspañola"].idxmin(), "FechaHora"].strftime("%d/%m/%Y %H:%M"),
-        "mean_val": round(mean_val, 2),
-    }
+    stats = _estadisticas(datos, referencia, {"PrecioZonaEspañola": "precio"}, "%d/%m/%Y %H:%M")["PrecioZonaEspañola"]
 
     # Gráfico
-    fig, ax = plt.subplots(figsize=(12,5))
-    ax.plot(df["FechaHora"], df["PrecioZonaEspañola"], color="blue", marker="o", linestyle="-")
+    with metricas.etapa("figura"):
+        fig, ax = graficas.nueva_figura()
+        ax.plot(*graficas.reducir_min_max(df["FechaHora"], df["PrecioZonaEspañola"]), color="blue", marker="o", linestyle="-")
 
-    start = df["FechaHora"].iloc[0].replace(hour=0, minute=0)
-    end = df["FechaHora"].iloc[-1].replace(hour=23, minute=55)
-    rango_dias = (end.date() - start.date()).days + 1
-    freq = "3H" if rango_dias <= 3 else "12H"
-    ax.set_xlim(start, end)
-    ax.set_xticks(pd.date_range(start=start, end=end, freq=freq))
-    ax.xaxis.set_major_formatter(mdates.DateFormatter("%d-%m-%Y %H:%M"))
+        start = df["FechaHora"].iloc[0].replace(hour=0, minute=0)
+        end = df["FechaHora"].iloc[-1].replace(hour=23, minute=55)
+        rango_dias = (end.date() - start.date()).days + 1
+        freq = "3H" if rango_dias <= 3 else "12H"
+        ax.set_xlim(start, end)
+        ax.set_xticks(pd.date_range(start=start, end=end, freq=freq))
+        ax.xaxis.set_major_formatter(mdates.DateFormatter("%d-%m-%Y %H:%M"))
 
-    ax.set_xlabel("Tiempo")
-    ax.set_ylabel("Precio Zona Española (€/MWh)")
-    ax.set_title("Precio OMIE")
-    fig.autofmt_xdate(rotation=45)
+        ax.set_xlabel("Tiempo")
+        ax.set_ylabel("Precio Zona Española (€/MWh)")
+        ax.set_title("Precio OMIE")
+        fig.autofmt_xdate(rotation=45)
 
-    buf = io.BytesIO()
-    plt.tight_layout()
-    plt.savefig(buf, format="png")
-    buf.seek(0)
-    graph_base64 = base64.b64encode(buf.getvalue()).decode("utf-8")
-    buf.close()
-    plt.close(fig)
+    graph_base64 = graficas.png_base64(fig)
 
-    return render(request, "scrap_graph_precio.html", {"graph": graph_base64, "stats": stats})
+    contexto = {"graph": graph_base64, "stats": stats}
+    graficas.guardar_cache(referencia, "precio", contexto)
+    return render(request, "scrap_graph_precio.html", contexto)
 
 
 # -----------------------------
 # Vista para la página de comparativa
 # -----------------------------
+def _dias(fecha_inicio, fecha_fin):
+    dia = datetime.strptime(fecha_inicio, "%Y-%m-%d").date()
+    fin = datetime.strptime(fecha_fin, "%Y-%m-%d").date()
+    while dia <= fin:
+        yield dia.strftime("%Y-%m-%d")
+        dia += timedelta(days=1)
+
+
+# Valores de dato1 y dato2 en la comparativa
+DATOS_COMPARATIVA = ["demanda", "generacion-renovables", "generacion-no_renovables", "generacion-todos", "precio"]
+
+
+def _columnas_dato(dato):
+    """
+    Fuente y columnas que se comparan de cada dato del formulario.
+    """
+    if dato == "precio":
+        return "precio", ["PrecioZonaEspañola"]
+    if dato and "generacion" in dato:
+        tipo_gen = {"generacion-renovables": "renovables",
+                    "generacion-no_renovables": "no_renovables",
+                    "generacion-todos": "todos"}[dato]
+        if tipo_gen == "renovables":
+            return "generacion", RENOVABLES_COLS
+        if tipo_gen == "no_renovables":
+            return "generacion", NO_RENOVABLES_COLS
+        return "generacion", RENOVABLES_COLS + NO_RENOVABLES_COLS
+    return "demanda", ["Real"]
+
+
+def _planificar_comparativa(datos):
+    """
+    Agrupa los datos pedidos por fuente ({fuente: columnas}, en orden de aparición)
+    para leer cada fuente una sola vez y solo con las columnas que se van a mostrar.
+    """
+    plan = {}
+    for dato in datos:
+        fuente, columnas = _columnas_dato(dato)
+        pedidas = plan.setdefault(fuente, [])
+        pedidas.extend(c for c in columnas if c not in pedidas)
+    return plan
+
+
+def _partes_comparativa(plan, fecha_inicio, fecha_fin, copias=None):
+    """
+    (DataFrame canónico de cada fuente del plan con sus columnas, días que faltan en REE).
+    `copias` se pasa a scrap_rango_parcial.
+    """
+    partes = []
+    faltan = set()
+    for fuente, columnas in plan.items():
+        if fuente == "precio":
+            df = scrap_rango_precio_omie(fecha_inicio, fecha_fin)
+        else:
+            url_tipo = 1 if fuente == "demanda" else 2
+            df, faltan_fuente = scrap_rango_parcial(
+                fecha_inicio, fecha_fin, url_tipo=url_tipo, columnas=columnas, presupuesto=_presupuesto(),
+                copias=copias,
+            )
+            faltan.update(faltan_fuente)
+        partes.append(df[[c for c in columnas if c in df.columns]])
+    return partes, faltan
+
+
+def _datos_comparativa(dato1, dato2, fecha_inicio, fecha_fin, modo="asof"):
+    """
+    (DataFrame canónico de la comparativa con las columnas de los dos datos, días
+    que faltan en REE), alineadas en el tiempo según `modo` (ver alineacion.py).
+    Cada fuente (demanda, generación, precio) se lee una vez aunque la usen los dos datos.
+    """
+    partes, faltan = _partes_comparativa(_planificar_comparativa([dato1, dato2]), fecha_inicio, fecha_fin)
+    return alineacion.alinear(partes, modo), sorted(faltan)
+
+
+def _bloques_comparativa(dato1, dato2, fecha_inicio, fecha_fin, modo="asof"):
+    """
+    Generador con la comparativa de cada día del rango (para las descargas), leyendo
+    cada día una sola vez. Cada día se alinea junto con el anterior y el siguiente y
+    luego se recorta: así sus últimos instantes se cruzan con las primeras muestras
+    del día siguiente y el resultado es el mismo que con el rango entero.
+    Los días que se copian a la caché Parquet se escriben de una vez por mes.
+    """
+    plan = _planificar_comparativa([dato1, dato2])
+    dias = list(_dias(fecha_inicio, fecha_fin))
+    leidos = {}
+    copias = {}
+    try:
+        for i, dia in enumerate(dias):
+            for j in (i - 1, i, i + 1):
+                if 0 <= j < len(dias) and j not in leidos:
+                    if dias[j].endswith("-01"):
+                        guardar_copias(copias)
+                    leidos[j] = _partes_comparativa(plan, dias[j], dias[j], copias)[0]
+            leidos.pop(i - 2, None)
+            ventana = [leidos[j] for j in (i - 1, i, i + 1) if j in leidos]
+            df = alineacion.alinear([pd.concat([partes[k] for partes in ventana]) for k in range(len(plan))], modo)
+
+            fecha = datetime.strptime(dia, "%Y-%m-%d").date()
+            inicio, fin = historico.inicio_dia(fecha), historico.inicio_dia(fecha + timedelta(days=1))
+            yield df[(df.index >= inicio) & (df.index < fin)]
+    finally:
+        guardar_copias(copias)
+
 
 def scrap_comparativa_view(request):
     context = {
@@ -438,18 +668,28 @@ def scrap_comparativa_view(request):
         "fecha_fin": "",
         "dato1": "",
         "dato2": "",
+        "alineacion": "asof",
+        "modos_alineacion": alineacion.MODOS,
         "titulo": "Comparativa de datos energéticos y precio"
     }
 
-    if request.method == "POST":
-        fecha_inicio = request.POST.get("fecha_inicio")
-        fecha_fin = request.POST.get("fecha_fin")
-        dato1 = request.POST.get("dato1")
-        dato2 = request.POST.get("dato2")
+    # GET con fechas: resultado de un trabajo en segundo plano
+    datos = request.POST if request.method == "POST" else request.GET
+    if "fecha_inicio" in datos:
+        fecha_inicio = datos.get("fecha_inicio")
+        fecha_fin = datos.get("fecha_fin")
+        dato1 = datos.get("dato1")
+        dato2 = datos.get("dato2")
+        modo = datos.get("alineacion") or "asof"
         context["fecha_inicio"] = fecha_inicio
         context["fecha_fin"] = fecha_fin
         context["dato1"] = dato1
         context["dato2"] = dato2
+        context["alineacion"] = modo
+
+        if modo not in alineacion.MODOS:
+            context["error"] = "Modo de alineación no válido."
+            return render(request, "scrap_comparativa.html", context)
 
         # Validación de fechas
         if not fecha_inicio or not fecha_fin:
@@ -465,81 +705,28 @@ def scrap_comparativa_view(request):
             context["error"] = "Formato de fecha no válido."
             return render(request, "scrap_comparativa.html", context)
 
+        url_tipos = sorted({2 if "generacion" in d else 1 for d in (dato1, dato2) if d and d != "precio"})
+        pendiente = _encolar_si_faltan_dias(
+            "comparativa", url_tipos,
+            {"fecha_inicio": fecha_inicio, "fecha_fin": fecha_fin, "dato1": dato1, "dato2": dato2, "alineacion": modo},
+        )
+        if pendiente:
+            return pendiente
+
         try:
-            # Scrap para dato1
-            if dato1 == "precio":
-                df1 = scrap_rango_precio_omie(fecha_inicio, fecha_fin)
-            elif "generacion" in dato1:
-                tipo_gen = {"generacion-renovables": "renovables",
-                            "generacion-no_renovables": "no_renovables",
-                            "generacion-todos": "todos"}[dato1]
-                df1 = scrap_rango(fecha_inicio, fecha_fin, url_tipo=2)
-                # Filtrar columnas según tipo de generación
-                renovables_cols = ["Eólica", "Solar fotovoltaica", "Solar térmica", "Biocombustible", "Hidráulica"]
-                no_renovables_cols = ["Nuclear", "Carbón", "Ciclo combinado", "Motor diésel",
-                                      "Turbina de gas", "Turbina de vapor", "Cogeneración y residuos"]
-                columnas_fijas = ["Fecha", "Hora"]
-                todos = ["Eólica", "Solar fotovoltaica", "Solar térmica", "Biocombustible", "Hidráulica", "Nuclear", "Carbón", "Ciclo combinado", "Motor diésel",
-                                      "Turbina de gas", "Turbina de vapor", "Cogeneración y residuos"]
-                if tipo_gen == "renovables":
-                    cols_a_mostrar = columnas_fijas + [col for col in renovables_cols if col in df1.columns]
-                elif tipo_gen == "no_renovables":
-                    cols_a_mostrar = columnas_fijas + [col for col in no_renovables_cols if col in df1.columns]
-                else:
-                    cols_a_mostrar = columnas_fijas + [col for col in todos if col in df1.columns]
-                df1 = df1[cols_a_mostrar]
-            else:  # demanda
-                df1 = scrap_rango(fecha_inicio, fecha_fin, url_tipo=1)
-                if "Real" in df1.columns:
-                    df1 = df1[["Fecha","Hora","Real"]]
-
-            # Scrap para dato2
-            if dato2 == "precio":
-                df2 = scrap_rango_precio_omie(fecha_inicio, fecha_fin)
-            elif "generacion" in dato2:
-                tipo_gen = {"generacion-renovables": "renovables",
-                            "generacion-no_renovables": "no_renovables",
-                            "generacion-todos": "todos"}[dato2]
-                df2 = scrap_rango(fecha_inicio, fecha_fin, url_tipo=2)
-                renovables_cols = ["Eólica", "Solar fotovoltaica", "Solar térmica", "Biocombustible", "Hidráulica"]
-                no_renovables_cols = ["Nuclear", "Carbón", "Ciclo combinado", "Motor diésel",
-                                      "Turbina de gas", "Turbina de vapor", "Cogeneración y residuos"]
-                columnas_fijas = ["Fecha", "Hora"]
-                todos = ["Eólica", "Solar fotovoltaica", "Solar térmica", "Biocombustible", "Hidráulica", "Nuclear", "Carbón", "Ciclo combinado", "Motor diésel",
-                                      "Turbina de gas", "Turbina de vapor", "Cogeneración y residuos"]
-                if tipo_gen == "renovables":
-                    cols_a_mostrar = columnas_fijas + [col for col in renovables_cols if col in df2.columns]
-                elif tipo_gen == "no_renovables":
-                    cols_a_mostrar = columnas_fijas + [col for col in no_renovables_cols if col in df2.columns]
-                else:
-                    cols_a_mostrar = columnas_fijas + [col for col in todos if col in df2.columns]
-                df2 = df2[cols_a_mostrar]
-            else:  # demanda
-                df2 = scrap_rango(fecha_inicio, fecha_fin, url_tipo=1)
-                if "Real" in df2.columns:
-                    df2 = df2[["Fecha","Hora","Real"]]
-
-            # Unificar datasets
-            if not df1.empty and not df2.empty:
-                df_merged = pd.merge(df1, df2, on=["Fecha","Hora"], how="inner")
-            elif not df1.empty:
-                df_merged = df1.copy()
-            elif not df2.empty:
-                df_merged = df2.copy()
-            else:
-                df_merged = pd.DataFrame()
+            # Descargar CSV o Parquet: se calcula y se escribe día a día
+            if _quiere_descarga(datos):
+                bloques = _bloques_comparativa(dato1, dato2, fecha_inicio, fecha_fin, modo)
+                return _respuesta_descarga(datos, f"Comparativa-{fecha_inicio}_{fecha_fin}", bloques, sep=";")
 
-            context["data"] = df_merged.head(10).to_dict("records")
-            request.session["comparativa_merged"] = df_merged.to_dict("records")
-            request.session["comparativa_merged_columns"] = df_merged.columns.tolist()
+            df_merged, faltan = _datos_comparativa(dato1, dato2, fecha_inicio, fecha_fin, modo)
+            context["faltan"] = _texto_dias(faltan)
 
-            # Descargar CSV
-            if "download_csv" in request.POST:
-                response = HttpResponse(content_type="text/csv")
-                filename = f"Comparativa-{fecha_inicio}_{fecha_fin}.csv"
-                response["Content-Disposition"] = f'attachment; filename="{filename}"'
-                df_merged.to_csv(path_or_buf=response, index=False, sep=';')
-                return response
+            context["data"] = historico.con_fecha_hora(df_merged.head(10)).to_dict("records")
+            request.session["comparativa_merged"] = datasets.guardar(
+                "comparativa", df_merged,
+                fecha_inicio=fecha_inicio, fecha_fin=fecha_fin, dato1=dato1, dato2=dato2, alineacion=modo,
+            )
 
         except Exception as e:
             context["error"] = f"Error durante el scraping o la unión de datos: {e}"
@@ -551,87 +738,275 @@ def scrap_comparativa_view(request):
 # -----------------------------
 # Vista para la gráfica comparativa
 # -----------------------------
-from django.shortcuts import render
-import pandas as pd
-import matplotlib.pyplot as plt
-import io
-import base64
-import matplotlib.dates as mdates
-
 def scrap_comparativa_graph_view(request):
-    data = request.session.get("comparativa_merged")
-    columns = request.session.get("comparativa_merged_columns")
+    referencia = request.session.get("comparativa_merged")
 
-    if not data or not columns:
+    contexto = graficas.leer_cache(referencia, "comparativa")
+    if contexto is not None:
+        return render(request, "scrap_comparativa_graph.html", contexto)
+
+    datos = datasets.cargar(referencia)
+    if datos is None or datos.empty:
         return render(request, "scrap_comparativa.html", {"error": "No hay datos para visualizar."})
 
-    df = pd.DataFrame(data, columns=columns)
+    df = _marco_grafica(datos)
 
-    if "Fecha" not in df.columns or "Hora" not in df.columns:
-        return render(request, "scrap_comparativa.html", {"error": "No se pueden generar gráficos sin columnas Fecha y Hora."})
+    with metricas.etapa("figura"):
+        fig, ax1 = graficas.nueva_figura()
+        ax2 = ax1.twinx()  # segundo eje Y para precio
 
-    # Crear columna FechaHora
-    df["FechaHora"] = pd.to_datetime(df["Fecha"] + " " + df["Hora"], format="%d/%m/%Y %H:%M")
-    df = df.sort_values("FechaHora")
+        energia_cols = [c for c in datos.columns if c != "PrecioZonaEspañola"]
+        precio_col = "PrecioZonaEspañola" if "PrecioZonaEspañola" in df.columns else None
 
-    fig, ax1 = plt.subplots(figsize=(12, 5))
-    ax2 = ax1.twinx()  # segundo eje Y para precio
+        # Dibujar barras/columnas para datos energéticos
+        leyenda = None
+        if energia_cols:
+            # Si es solo demanda (columna Real)
+            barras = graficas.reducir_medias(df, energia_cols)
+            if energia_cols == ["Real"]:
+                ax1.bar(barras["FechaHora"], barras["Real"], width=graficas.ancho_barras(barras["FechaHora"]),
+                        color="skyblue", label="Demanda Real")
+            else:
+                # Generación apilada
+                leyenda = graficas.apilar(ax1, barras["FechaHora"], barras, energia_cols)
 
-    energia_cols = [c for c in df.columns if c not in ["Fecha","Hora","FechaHora","PrecioZonaEspañola"]]
-    precio_col = "PrecioZonaEspañola" if "PrecioZonaEspañola" in df.columns else None
+        # Dibujar línea de precio si existe
+        if precio_col:
+            ax2.plot(*graficas.reducir_min_max(df["FechaHora"], df[precio_col]), color="red", marker="o", label="Precio")
+            ax2.set_ylabel("Precio (€/MWh)")
 
-    # Dibujar barras/columnas para datos energéticos
-    if energia_cols:
-        # Si es solo demanda (columna Real)
-        if energia_cols == ["Real"]:
-            ax1.bar(df["FechaHora"], df["Real"], color="skyblue", label="Demanda Real")
-        else:
-            # Generación apilada
-            bottom = pd.Series([0]*len(df))
-            for col in energia_cols:
-                ax1.bar(df["FechaHora"], df[col], bottom=bottom, label=col)
-                bottom += df[col]
-
-    # Dibujar línea de precio si existe
-    if precio_col:
-        ax2.plot(df["FechaHora"], df[precio_col], color="red", marker="o", label="Precio")
-        ax2.set_ylabel("Precio (€/MWh)")
-
-    # Eje X
-    start = df["FechaHora"].iloc[0].replace(hour=0, minute=0)
-    end = df["FechaHora"].iloc[-1].replace(hour=23, minute=55)
-    rango_dias = (end.date() - start.date()).days + 1
-    freq = "3H" if rango_dias <= 3 else "12H"
-    ax1.set_xlim(start, end)
-    ax1.set_xticks(pd.date_range(start=start, end=end, freq=freq))
-    ax1.xaxis.set_major_formatter(mdates.DateFormatter("%d-%m-%Y %H:%M"))
-
-    ax1.set_xlabel("Tiempo")
-    ax1.set_ylabel("Potencia (MW)")
-    ax1.legend(loc="upper left", bbox_to_anchor=(1,1))
-    fig.autofmt_xdate(rotation=45)
+        # Eje X
+        start = df["FechaHora"].iloc[0].replace(hour=0, minute=0)
+        end = df["FechaHora"].iloc[-1].replace(hour=23, minute=55)
+        rango_dias = (end.date() - start.date()).days + 1
+        freq = "3H" if rango_dias <= 3 else "12H"
+        ax1.set_xlim(start, end)
+        ax1.set_xticks(pd.date_range(start=start, end=end, freq=freq))
+        ax1.xaxis.set_major_formatter(mdates.DateFormatter("%d-%m-%Y %H:%M"))
+
+        ax1.set_xlabel("Tiempo")
+        ax1.set_ylabel("Potencia (MW)")
+        ax1.legend(handles=leyenda, loc="upper left", bbox_to_anchor=(1,1))
+        fig.autofmt_xdate(rotation=45)
 
     # Guardar gráfico en memoria
-    buf = io.BytesIO()
-    plt.tight_layout()
-    plt.savefig(buf, format="png")
-    buf.seek(0)
-    graph_base64 = base64.b64encode(buf.getvalue()).decode("utf-8")
-    buf.close()
-    plt.close(fig)
+    graph_base64 = graficas.png_base64(fig)
 
     # Calcular estadísticas por columna de energía y precio
-    stats = {}
-    for col in energia_cols + ([precio_col] if precio_col else []):
-        max_val = df[col].max()
-        min_val = df[col].min()
-        mean_val = df[col].mean()
-        stats[col] = {
-            "max_val": round(max_val,2),
-            "hora_max": df.loc[df[col].idxmax(), "FechaHora"].strftime("%d-%m-%Y %H:%M"),
-            "min_val": round(min_val,2),
-            "hora_min": df.loc[df[col].idxmin(), "FechaHora"].strftime("%d-%m-%Y %H:%M"),
-            "mean_val": round(mean_val,2)
+    columnas_stats = energia_cols + ([precio_col] if precio_col else [])
+    stats = _estadisticas(datos, referencia, {col: _fuente_columna(col) for col in columnas_stats}, "%d-%m-%Y %H:%M")
+
+    contexto = {"graph": graph_base64, "stats": stats}
+    graficas.guardar_cache(referencia, "comparativa", contexto)
+    return render(request, "scrap_comparativa_graph.html", contexto)
+
+
+# -----------------------------
+# Vistas de trabajos en segundo plano
+# -----------------------------
+_VISTAS_TRABAJO = {
+    "demanda": "scrap_demanda",
+    "generacion": "scrap_generacion",
+    "almacenamiento": "scrap_almacenamiento",
+    "comparativa": "scrap_comparativa",
+}
+
+
+def trabajo_estado_view(request, pk):
+    trabajo = get_object_or_404(TrabajoScrap, pk=pk)
+    return render(request, "trabajo_estado.html", {"trabajo": trabajo})
+
+
+def trabajo_estado_json(request, pk):
+    trabajos.abandonar_sin_latido()
+    trabajo = get_object_or_404(TrabajoScrap, pk=pk)
+    terminado = trabajo.estado == TrabajoScrap.TERMINADO
+    return JsonResponse({
+        "estado": trabajo.estado,
+        "dias_total": trabajo.dias_total,
+        "dias_hechos": trabajo.dias_hechos,
+        "error": trabajo.error,
+        "resultado": reverse("trabajo_resultado", args=[trabajo.pk]) if terminado else None,
+    })
+
+
+def trabajo_resultado_view(request, pk):
+    """
+    Vuelve a la vista original con los parámetros del trabajo; los datos ya están en el histórico.
+    """
+    trabajo = get_object_or_404(TrabajoScrap, pk=pk)
+    if trabajo.estado != TrabajoScrap.TERMINADO:
+        return redirect("trabajo_estado", pk=trabajo.pk)
+    return redirect(f"{reverse(_VISTAS_TRABAJO[trabajo.tipo])}?{urlencode(trabajo.parametros)}")
+
+
+# -----------------------------
+# API JSON de solo lectura
+# -----------------------------
+# Resoluciones que admite el parámetro ?resolucion= (regla de pandas para resample)
+RESOLUCIONES_API = {"5min": "5min", "15min": "15min", "1h": "h", "1d": "D"}
+
+# Tipos de REE que necesita cada serie (para encolar el scraping de los días que falten)
+_URL_TIPOS_API = {
+    "demanda": [1],
+    "generacion": [2],
+    "almacenamiento": [4],
+    "precio": [],
+}
+
+
+def _error_api(mensaje, status=400):
+    return JsonResponse({"error": mensaje}, status=status)
+
+
+def _datos_api(serie, datos, fecha_inicio, fecha_fin):
+    """
+    (DataFrame canónico, días que faltan) de la serie pedida.
+    """
+    if serie in ("demanda", "generacion", "almacenamiento"):
+        url_tipo = _URL_TIPOS_API[serie][0]
+        df, faltan = scrap_rango_parcial(fecha_inicio, fecha_fin, url_tipo=url_tipo, presupuesto=_presupuesto())
+        if serie == "generacion":
+            df = _filtrar_generacion(df, datos.get("tipo_generacion", "todos"))
+        return df, faltan
+    if serie == "precio":
+        return scrap_rango_precio_omie(fecha_inicio, fecha_fin), []
+    return _datos_comparativa(datos.get("dato1"), datos.get("dato2"), fecha_inicio, fecha_fin, datos.get("alineacion") or "asof")
+
+
+def _columnas_api(df, resolucion=None, columnas=None):
+    """
+    Columnas numéricas del DataFrame canónico (solo `columnas` si se indican),
+    agregadas con la media a la resolución pedida.
+    """
+    valores = df
+    if columnas:
+        valores = valores[[c for c in columnas if c in valores.columns]]
+    valores = valores.apply(pd.to_numeric, errors="coerce").astype("float64")
+    if resolucion:
+        valores = valores.resample(RESOLUCIONES_API[resolucion]).mean().dropna(how="all")
+    return valores
+
+
+def api_serie(request, serie):
+    """
+    Series en formato columnar para dibujarlas en el cliente:
+    {"t": [segundos desde 1970...], "series": {"Real": [...], ...}, "siguiente": url o null,
+    "faltan": [días aaaa-mm-dd que no se pudieron descargar a tiempo]}.
+
+    Parámetros: fecha_inicio y fecha_fin (aaaa-mm-dd), resolucion (5min, 15min, 1h, 1d;
+    por defecto la de origen), columnas (separadas por comas), limite (puntos por página)
+    y cursor (el que devuelve "siguiente"). generacion admite tipo_generacion y
+    comparativa dato1 y dato2, como en sus páginas.
+    Si faltan días en el histórico se encola el scraping y se responde 202 con el trabajo.
+    """
+    if serie not in _URL_TIPOS_API and serie != "comparativa":
+        return _error_api(f"Serie desconocida: {serie}", status=404)
+
+    datos = request.GET
+    fecha_inicio = datos.get("fecha_inicio")
+    fecha_fin = datos.get("fecha_fin")
+    try:
+        start_date = datetime.strptime(fecha_inicio or "", "%Y-%m-%d").date()
+        end_date = datetime.strptime(fecha_fin or "", "%Y-%m-%d").date()
+    except ValueError:
+        return _error_api("fecha_inicio y fecha_fin son obligatorias con formato aaaa-mm-dd.")
+    if end_date < start_date:
+        return _error_api("La fecha fin no puede ser anterior a la fecha inicio.")
+
+    resolucion = datos.get("resolucion") or None
+    if resolucion is not None and resolucion not in RESOLUCIONES_API:
+        return _error_api(f"resolucion debe ser una de: {', '.join(RESOLUCIONES_API)}.")
+
+    limite_max = getattr(settings, "API_LIMITE", 5000)
+    try:
+        limite = min(int(datos.get("limite", limite_max)), limite_max)
+        cursor = int(datos["cursor"]) if datos.get("cursor") else None
+    except ValueError:
+        return _error_api("limite y cursor deben ser números enteros.")
+    if limite < 1:
+        return _error_api("limite debe ser mayor que 0.")
+    dia_cursor = None
+    if cursor is not None:
+        try:
+            dia_cursor = datetime.fromtimestamp(cursor, historico.ZONA_REE).date()
+        except (ValueError, OverflowError, OSError):
+            return _error_api("cursor fuera de rango.")
+    columnas = [c for c in datos.get("columnas", "").split(",") if c] or None
+
+    if serie == "comparativa":
+        if datos.get("dato1") not in DATOS_COMPARATIVA or datos.get("dato2") not in DATOS_COMPARATIVA:
+            return _error_api(f"dato1 y dato2 deben ser uno de: {', '.join(DATOS_COMPARATIVA)}.")
+        url_tipos = sorted({2 if "generacion" in d else 1 for d in (datos.get("dato1"), datos.get("dato2")) if d and d != "precio"})
+        parametros = {
+            "fecha_inicio": fecha_inicio, "fecha_fin": fecha_fin,
+            "dato1": datos.get("dato1"), "dato2": datos.get("dato2"), "alineacion": datos.get("alineacion") or "asof",
         }
+        if parametros["alineacion"] not in alineacion.MODOS:
+            return _error_api(f"alineacion debe ser una de: {', '.join(alineacion.MODOS)}.")
+    else:
+        url_tipos = _URL_TIPOS_API[serie]
+        parametros = {"fecha_inicio": fecha_inicio, "fecha_fin": fecha_fin}
+        if serie == "generacion":
+            parametros["tipo_generacion"] = datos.get("tipo_generacion", "todos")
+
+    if url_tipos:
+        trabajo = _trabajo_si_faltan_dias(serie, url_tipos, parametros)
+        if trabajo is not None:
+            return JsonResponse({
+                "trabajo": str(trabajo.pk),
+                "estado": reverse("trabajo_estado_json", args=[trabajo.pk]),
+            }, status=202)
+
+    # Con cursor solo hace falta leer desde el día en que empieza la página
+    # (los tramos de cualquier resolución empiezan y acaban dentro del mismo día)
+    desde = start_date
+    if dia_cursor is not None:
+        desde = min(max(start_date, dia_cursor), end_date)
+
+    try:
+        df, faltan = _datos_api(serie, datos, desde.strftime("%Y-%m-%d"), fecha_fin)
+    except Exception as e:
+        return _error_api(f"Error al obtener los datos: {e}", status=502)
+
+    valores = _columnas_api(df, resolucion, columnas)
+    t = valores.index.asi8 // 10**9
+    if cursor is not None:
+        valores, t = valores[t >= cursor], t[t >= cursor]
+
+    siguiente = None
+    if len(t) > limite:
+        siguiente = request.path + "?" + urlencode({**datos.dict(), "cursor": int(t[limite])})
+        valores, t = valores.iloc[:limite], t[:limite]
+
+    response = JsonResponse({
+        "serie": serie,
+        "fecha_inicio": fecha_inicio,
+        "fecha_fin": fecha_fin,
+        "resolucion": resolucion,
+        "zona": str(historico.ZONA_REE),
+        "t": t.tolist(),
+        "series": {col: valores[col].astype(object).where(valores[col].notna(), None).tolist() for col in valores.columns},
+        "siguiente": siguiente,
+        "faltan": [dia.isoformat() for dia in faltan],
+    }, json_dumps_params={"ensure_ascii": False})
+
+    # Los días cerrados ya no cambian: el cliente puede guardar la respuesta (si está completa)
+    if end_date < historico.hoy_local() and not faltan:
+        patch_cache_control(response, public=True, max_age=24 * 3600)
+    else:
+        patch_cache_control(response, public=True, max_age=60)
+    return response
+
 
-    return render(request, "scrap_comparativa_graph.html", {"graph": graph_base64, "stats": stats})
+# -----------------------------
+# Métricas
+# -----------------------------
+def metricas_view(request):
+    """
+    Histogramas de tiempos de las etapas y de las peticiones de este proceso, en
+    formato de texto de Prometheus. Solo se sirven a las direcciones de METRICAS_IPS.
+    """
+    if request.META.get("REMOTE_ADDR") not in getattr(settings, "METRICAS_IPS", ["127.0.0.1", "::1"]):
+        raise Http404
+    return HttpResponse(metricas.exposicion(), content_type="text/plain; version=0.0.4; charset=utf-8")
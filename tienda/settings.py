@@ -41,6 +41,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'gestionpedidos.metricas.MiddlewareTiempos',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -81,6 +82,37 @@ DATABASES = {
 }
 
 
+# Cache
+# https://docs.djangoproject.com/en/5.2/topics/cache/
+# "datasets" guarda en disco los resultados de scraping que usan las gráficas;
+# en la sesión solo queda una referencia a la entrada. "graficas" guarda las
+# imágenes ya renderizadas.
+
+CACHE_DIR = BASE_DIR / 'cache'
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'datasets': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': CACHE_DIR / 'datasets',
+        'TIMEOUT': 24 * 3600,
+        'OPTIONS': {
+            'MAX_ENTRIES': 200,
+        },
+    },
+    'graficas': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': CACHE_DIR / 'graficas',
+        'TIMEOUT': 7 * 24 * 3600,
+        'OPTIONS': {
+            'MAX_ENTRIES': 500,
+        },
+    },
+}
+
+
 # Password validation
 # https://docs.djangoproject.com/en/5.2/ref/settings/#auth-password-validators
 
@@ -121,3 +153,126 @@ STATIC_URL = 'static/'
 # https://docs.djangoproject.com/en/5.2/ref/settings/#default-auto-field
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
+
+
+# Scraping de REE
+# Navegadores Firefox que mantiene abiertos cada proceso y páginas que sirve
+# cada uno antes de reiniciarlo. SCRAP_CONCURRENCIA limita los días que
+# scrap_rango descarga a la vez (nunca más que navegadores haya en el pool).
+
+SCRAP_NAVEGADORES = 3
+
+SCRAP_PAGINAS_POR_NAVEGADOR = 50
+
+SCRAP_CONCURRENCIA = 3
+
+# "red": construir las tablas desde las respuestas de datos que carga la página
+# (las URLs que contienen SCRAP_PATRON_DATOS), leyendo el DOM solo como respaldo.
+# "dom": leer siempre la tabla ya pintada.
+
+SCRAP_MODO = "red"
+
+SCRAP_PATRON_DATOS = "WSvisiona"
+
+# Segundos que puede esperar una petición a los días que falten (después responde
+# con lo que tenga y la lista de días que faltan), máximo por día, reintentos de
+# un día fallido y corte tras SCRAP_CORTE_FALLOS fallos seguidos durante
+# SCRAP_CORTE_SEGUNDOS segundos.
+
+SCRAP_PRESUPUESTO = 90
+
+SCRAP_TIMEOUT_DIA = 60
+
+SCRAP_REINTENTOS = 2
+
+SCRAP_CORTE_FALLOS = 5
+
+SCRAP_CORTE_SEGUNDOS = 60
+
+# El día en curso se refresca de forma incremental (solo filas nuevas y previsiones
+# revisadas) y como mucho una vez cada SCRAP_REFRESCO_HOY segundos; REE publica
+# una fila nueva cada cinco minutos.
+
+SCRAP_REFRESCO_HOY = 60
+
+
+# Descargas de precios de OMIE
+# Archivos que se descargan a la vez y timeout (conexión, lectura) en segundos.
+
+OMIE_DESCARGAS = 8
+
+OMIE_TIMEOUT = (5, 30)
+
+# Copia en disco de los archivos diarios descargados. Los de hace más de
+# OMIE_REVALIDAR_DIAS días se leen de ahí sin preguntar a OMIE; los recientes
+# se revalidan con una petición condicional (ETag / Last-Modified).
+
+OMIE_ARCHIVOS_DIR = CACHE_DIR / 'omie'
+
+OMIE_REVALIDAR_DIAS = 2
+
+# Días que se guardan de cada vez al cargar un zip de OMIE (manage.py importar_omie).
+
+OMIE_ARCHIVO_LOTE = 92
+
+
+# Trabajos de scraping en segundo plano que se ejecutan a la vez en cada proceso,
+# segundos durante los que no se repite un trabajo que acaba de terminar, segundos
+# sin latido tras los que un trabajo en curso se da por abandonado y segundos que
+# puede esperar turno un trabajo pendiente antes de darlo también por abandonado.
+
+SCRAP_TRABAJOS = 2
+
+SCRAP_TRABAJO_VIGENCIA = 600
+
+SCRAP_TRABAJO_LATIDO = 120
+
+SCRAP_TRABAJO_ESPERA = 3600
+
+
+# Caché columnar (Parquet) de las tablas de REE y los precios de OMIE, un archivo
+# por tipo de dato y mes. Necesita pyarrow; sin él los datos se leen como siempre.
+
+PARQUET_DIR = CACHE_DIR / 'parquet'
+
+
+# Precarga del histórico (manage.py precargar): días que se guardan de cada vez y
+# carpeta de los puntos de control para seguir una precarga interrumpida.
+
+PRECARGA_LOTE = 31
+
+PRECARGA_DIR = CACHE_DIR / 'precarga'
+
+
+# Puntos por página (máximo) de la API JSON; con más, la respuesta trae un cursor.
+
+API_LIMITE = 5000
+
+
+# Métricas: cabecera Server-Timing con el tiempo de cada etapa de la petición y
+# direcciones desde las que se puede leer /metricas/ (histogramas del proceso).
+
+METRICAS_SERVER_TIMING = True
+
+METRICAS_IPS = ["127.0.0.1", "::1"]
+
+
+# Registro: una línea JSON por mensaje (ver gestionpedidos.metricas.FormatoJSON).
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'formatters': {
+        'json': {'()': 'gestionpedidos.metricas.FormatoJSON'},
+    },
+    'handlers': {
+        'consola': {'class': 'logging.StreamHandler', 'formatter': 'json'},
+    },
+    'loggers': {
+        'gestionpedidos': {
+            'handlers': ['consola'],
+            'level': 'DEBUG' if DEBUG else 'INFO',
+            'propagate': False,
+        },
+    },
+}
@@ -29,5 +29,10 @@ urlpatterns = [
     path("scrap_view_graph_precio/", views.scrap_graph_precio_view, name="scrap_view_graph_precio"),
     path("scrap_comparativa/", views.scrap_comparativa_view, name="scrap_comparativa"),
     path("scrap_view_graph_comparativa/", views.scrap_comparativa_graph_view, name="scrap_comparativa_graph_view"),
+    path("trabajos/<uuid:pk>/", views.trabajo_estado_view, name="trabajo_estado"),
+    path("trabajos/<uuid:pk>/estado/", views.trabajo_estado_json, name="trabajo_estado_json"),
+    path("trabajos/<uuid:pk>/resultado/", views.trabajo_resultado_view, name="trabajo_resultado"),
+    path("api/<str:serie>/", views.api_serie, name="api_serie"),
+    path("metricas/", views.metricas_view, name="metricas"),
 ]
 